@@ -0,0 +1,74 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional
+
+import metrics
+from config import LOGGER
+from sync_pipeline import spawn
+
+'''
+按用户聚合连续消息
+
+用户经常连发三四条短消息，如果每条都单独调用一次 Coze、单独回复一次，既浪费调用，回复还容易乱序。
+同一个 key (external_userid, open_kfid) 在静默期 quiet_ms 内连续到达的消息合并为一批，
+静默期结束后一次性交给 on_flush；最长等待 max_wait_ms、最多 max_items 条，保证延迟可控。
+'''
+
+FlushCallback = Callable[[Hashable, List[Any]], Awaitable[None]]
+
+
+class _Batch:
+    __slots__ = ("items", "first_at", "handle")
+
+    def __init__(self, first_at: float):
+        self.items: List[Any] = []
+        self.first_at = first_at
+        self.handle: Optional[asyncio.TimerHandle] = None
+
+
+class MessageAggregator:
+    def __init__(self, on_flush: FlushCallback, quiet_ms: int, max_wait_ms: int, max_items: int):
+        self.on_flush = on_flush
+        self.quiet_ms = quiet_ms
+        self.max_wait_ms = max_wait_ms
+        self.max_items = max_items
+        self._batches: Dict[Hashable, _Batch] = {}
+
+    def add(self, key: Hashable, item: Any):
+        """加入一条消息 (非阻塞)，静默期为 0 时立即交给 on_flush"""
+        if self.quiet_ms <= 0:
+            spawn(self.on_flush(key, [item]))
+            return
+
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        batch = self._batches.get(key)
+        if batch is None:
+            batch = self._batches[key] = _Batch(now)
+        else:
+            batch.handle.cancel()
+        batch.items.append(item)
+
+        if len(batch.items) >= self.max_items:
+            self._flush(key)
+            return
+        # 每来一条重新计时，但不超过最长等待时长
+        delay = min(self.quiet_ms, batch.first_at * 1000 + self.max_wait_ms - now * 1000)
+        batch.handle = loop.call_later(max(delay, 0) / 1000, self._flush, key)
+
+    def _flush(self, key: Hashable):
+        batch = self._batches.pop(key, None)
+        if batch is None:
+            return
+        if len(batch.items) > 1:
+            LOGGER.info(f"[聚合] 合并 {len(batch.items)} 条消息为一次调用: {key}")
+            metrics.incr("aggregated_msgs_merged_total", len(batch.items) - 1)
+        metrics.incr("aggregated_batches_total")
+        spawn(self.on_flush(key, batch.items))
+
+    async def flush_all(self):
+        """立即提交所有未到期的批次 (进程退出前调用，避免丢消息)"""
+        batches, self._batches = self._batches, {}
+        for batch in batches.values():
+            batch.handle.cancel()
+        await asyncio.gather(*(self.on_flush(key, batch.items) for key, batch in batches.items()),
+                             return_exceptions=True)
@@ -1,37 +1,22 @@
-from openai import OpenAI
+from typing import Awaitable, Callable, Optional
 
 from call_coze_api import call_coze_workflow,async_call_coze_workflow
-from config import OPENAI_API_KEY
 
-client = OpenAI(
-    api_key=OPENAI_API_KEY,
-    base_url="https://openai.apifast.org/v1"
-)
 
-
-def ai_reply(content):
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",  # 或其他适合的模型
-        messages=[
-            {"role": "system", "content": "You are a helpful assistant."},
-            {"role": "user", "content": content}
-        ]
-    )
-    return response.choices[0].message.content
-
-
-def ai_reply_coze(content: str, user_id: str, conversation_id: str):
+def ai_reply_coze(content: str, user_id: str, conversation_id: str, open_kfid: str = None):
     """
     用 Coze Workflow 替代 OpenAI 调用
     content(questions): 用户消息
     user_id: 企微 external_userid
     conversation_id: 对话ID（如果你有多轮上下文）
+    open_kfid: 客服账号ID，用于选择 Coze 机器人 (不传使用默认配置)
     """
     if conversation_id:
         assistant_reply = call_coze_workflow(
             user_id=user_id,
             conversation_id=conversation_id,
-            questions=content
+            questions=content,
+            open_kfid=open_kfid
         )
         if assistant_reply:
             reply = assistant_reply
@@ -42,9 +27,14 @@ def ai_reply_coze(content: str, user_id: str, conversation_id: str):
 
     return reply
 
-async def async_ai_reply_coze(content: str, user_id: str, conversation_id: str, open_kfid: str):
+async def async_ai_reply_coze(content: str, user_id: str, conversation_id: str, open_kfid: str,
+                              on_segment: Optional[Callable[[str], Awaitable[None]]] = None,
+                              deadline: float = None):
     """
     用 Coze Workflow 替代 OpenAI 调用 (异步版)
+    Coze 熔断 / 超时时自动降级到机器人配置的 OpenAI 兼容模型 (llm_fallback)，见 async_call_coze_workflow
+    on_segment: 渐进式回复回调，见 async_call_coze_workflow
+    deadline: 回复截止时间 (time.time() 时间戳)，见 async_call_coze_workflow
     """
     if conversation_id:
         # ✅ 添加 await
@@ -52,7 +42,9 @@ async def async_ai_reply_coze(content: str, user_id: str, conversation_id: str,
             user_id=user_id,
             conversation_id=conversation_id,
             questions=content,
-            open_kfid=open_kfid
+            open_kfid=open_kfid,
+            on_segment=on_segment,
+            deadline=deadline
         )
         if assistant_reply:
             reply = assistant_reply
@@ -62,6 +62,7 @@ CREATE TABLE `message_record` (
   `user_device_id` varchar(64) COLLATE utf8mb4_unicode_ci DEFAULT NULL COMMENT '用户设备号',
   `conversation_id` varchar(64) COLLATE utf8mb4_unicode_ci NOT NULL COMMENT '会话ID',
   `comments` varchar(64) COLLATE utf8mb4_unicode_ci DEFAULT NULL COMMENT '备注',
+  `reply_backend` varchar(32) COLLATE utf8mb4_unicode_ci DEFAULT NULL COMMENT '回复来源 (coze / cache / llm:<model>)',
   `sorting` bigint DEFAULT NULL COMMENT '排序',
   `created_time` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP COMMENT '创建时间',
   PRIMARY KEY (`id`),
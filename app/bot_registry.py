@@ -0,0 +1,263 @@
+import asyncio
+import json
+import os
+import threading
+from types import MappingProxyType
+from typing import Dict, Mapping, NamedTuple, Optional, Tuple
+
+import metrics
+from config import LOGGER, COZE_BOT_CONFIGS, COZE_BOT_CONFIG_SOURCE, COZE_BOT_CONFIG_FILE, COZE_BOT_CONFIG_CHECK_S
+from coze_client import AsyncCozeClient
+from kv import get_bot_configs, async_get_bot_configs, async_get_bot_config_version, publish_bot_configs
+
+'''
+机器人配置注册表
+
+客服账号 (OpenKfId) 到 Coze 机器人的映射原本只能写死在 config.py 的 COZE_BOT_CONFIGS 中，新增一个客服账号就要重新部署、
+重启所有 Worker。这里把配置编译成只读快照：
+- 来源 (COZE_BOT_CONFIG_SOURCE)：static 为 COZE_BOT_CONFIGS；file 为 JSON 文件；redis 为 HASH + 版本号
+- 编译：整份配置先校验 (必填项、各可选项的类型)，再为每个机器人构建一次 AsyncCozeClient (请求头、回复缓存规则、舱壁、
+  降级模型都在这里准备好)。任何一项不合法时整份新配置作废，继续使用旧快照
+- 查找：get_coze_client / bot_key 只读当前快照中的字典，不做 I/O，也不打印日志 (未知客服账号只告警一次)
+- 热更新：后台协程每 COZE_BOT_CONFIG_CHECK_S 秒检查一次版本号 (文件的修改时间与大小 / Redis 中的版本号)，
+  变化时重新加载并整体替换快照。每个 Worker 各自检查，修改文件或发布到 Redis 后全部 Worker 在一个检查周期内生效
+- 不中断处理中的请求：已取到旧客户端的调用照常用它完成；配置未变化的机器人沿用原客户端，舱壁计数与预热不受影响。
+  配置变化的机器人换用新客户端，新旧客户端的舱壁名额在过渡期内各自计数
+'''
+
+SOURCE_STATIC = "static"
+SOURCE_FILE = "file"
+SOURCE_REDIS = "redis"
+
+DEFAULT_BOT_KEY = "default"
+_REQUIRED_FIELDS = ("token", "workflow_id", "app_id")
+_OPTIONAL_DICT_FIELDS = ("reply_cache", "bulkhead", "llm_fallback")
+_OPTIONAL_STR_FIELDS = ("name", "fallback_reply")
+
+
+class BotConfigError(ValueError):
+    pass
+
+
+class _Snapshot(NamedTuple):
+    version: Optional[str]
+    # 校验后的原始配置，重新加载时用于判断哪些机器人的配置发生了变化
+    configs: Mapping[str, dict]
+    clients: Mapping[str, AsyncCozeClient]
+
+
+def validate(raw) -> Dict[str, dict]:
+    """校验整份配置，返回规范化后的副本；缺少 default 时沿用 COZE_BOT_CONFIGS 中的 default"""
+    if not isinstance(raw, dict):
+        raise BotConfigError("机器人配置必须是 {key: 配置} 的对象")
+    configs = json.loads(json.dumps(raw))  # 深拷贝，之后外部对原对象的修改不影响快照
+    if DEFAULT_BOT_KEY not in configs:
+        configs[DEFAULT_BOT_KEY] = json.loads(json.dumps(COZE_BOT_CONFIGS[DEFAULT_BOT_KEY]))
+    for key, config in configs.items():
+        if not isinstance(config, dict):
+            raise BotConfigError(f"[{key}] 配置必须是对象")
+        missing = [f for f in _REQUIRED_FIELDS if not isinstance(config.get(f), str) or not config[f].strip()]
+        if missing:
+            raise BotConfigError(f"[{key}] 缺少关键参数: {', '.join(missing)}")
+        for field in _OPTIONAL_DICT_FIELDS:
+            if config.get(field) is not None and not isinstance(config[field], dict):
+                raise BotConfigError(f"[{key}] {field} 必须是对象")
+        for field in _OPTIONAL_STR_FIELDS:
+            if config.get(field) is not None and not isinstance(config[field], str):
+                raise BotConfigError(f"[{key}] {field} 必须是字符串")
+    return configs
+
+
+def compile_snapshot(version: Optional[str], raw, previous: Optional[_Snapshot] = None) -> _Snapshot:
+    """校验并为每个机器人构建客户端；与上一个快照相比配置未变化的机器人沿用原客户端"""
+    configs = validate(raw)
+    clients = {}
+    for key, config in configs.items():
+        if previous is not None and previous.configs.get(key) == config:
+            clients[key] = previous.clients[key]
+            continue
+        try:
+            clients[key] = AsyncCozeClient.from_config(key, config)
+        except (TypeError, ValueError) as e:
+            raise BotConfigError(f"[{key}] 配置无效: {e}") from e
+    return _Snapshot(version, MappingProxyType(configs), MappingProxyType(clients))
+
+
+def _file_version() -> Optional[str]:
+    try:
+        stat = os.stat(COZE_BOT_CONFIG_FILE)
+    except FileNotFoundError:
+        return None
+    return f"{stat.st_mtime_ns}:{stat.st_size}"
+
+
+def _read_file() -> Tuple[Optional[str], dict]:
+    # 先取版本号再读内容：读取期间文件被修改时，下一次检查会看到新的版本号并重新加载
+    version = _file_version()
+    with open(COZE_BOT_CONFIG_FILE, encoding="utf-8") as f:
+        return version, json.load(f)
+
+
+def _decode_redis(version: Optional[str], configs: Dict[str, str]) -> Tuple[Optional[str], dict]:
+    if not configs:
+        raise BotConfigError(f"Redis 中没有机器人配置 (版本 {version})")
+    return version, {key: json.loads(value) for key, value in configs.items()}
+
+
+def _load() -> Tuple[Optional[str], dict]:
+    if COZE_BOT_CONFIG_SOURCE == SOURCE_FILE:
+        return _read_file()
+    if COZE_BOT_CONFIG_SOURCE == SOURCE_REDIS:
+        return _decode_redis(*get_bot_configs())
+    return None, COZE_BOT_CONFIGS
+
+
+async def _async_load() -> Tuple[Optional[str], dict]:
+    if COZE_BOT_CONFIG_SOURCE == SOURCE_FILE:
+        return await asyncio.to_thread(_read_file)
+    return _decode_redis(*await async_get_bot_configs())
+
+
+async def _current_version() -> Optional[str]:
+    if COZE_BOT_CONFIG_SOURCE == SOURCE_FILE:
+        return _file_version()  # 一次 stat，不读文件
+    return await async_get_bot_config_version()
+
+
+_snapshot: Optional[_Snapshot] = None
+_snapshot_lock = threading.Lock()
+# 加载失败的版本：同一个坏版本不重复加载和报错，直到版本号再次变化
+_failed_version: Optional[str] = None
+_warned_kfids = set()
+_task: Optional[asyncio.Task] = None
+
+
+def _get_snapshot() -> _Snapshot:
+    global _snapshot
+    snapshot = _snapshot
+    if snapshot is None:
+        with _snapshot_lock:
+            if _snapshot is None:
+                _snapshot = _initial_snapshot()
+            snapshot = _snapshot
+    return snapshot
+
+
+def _initial_snapshot() -> _Snapshot:
+    """首次加载 (同步)；配置来源不可用或配置不合法时退回 COZE_BOT_CONFIGS，服务照常启动"""
+    if COZE_BOT_CONFIG_SOURCE in (SOURCE_FILE, SOURCE_REDIS):
+        try:
+            snapshot = compile_snapshot(*_load())
+            _record_loaded(snapshot)
+            return snapshot
+        except Exception as e:
+            LOGGER.error(f"❌ [Config] 从 {COZE_BOT_CONFIG_SOURCE} 加载机器人配置失败，暂用 COZE_BOT_CONFIGS: {e}")
+            metrics.incr("coze_bot_config_reloads_total", result="error")
+    elif COZE_BOT_CONFIG_SOURCE != SOURCE_STATIC:
+        LOGGER.error(f"❌ [Config] 未知的 COZE_BOT_CONFIG_SOURCE={COZE_BOT_CONFIG_SOURCE}，使用 COZE_BOT_CONFIGS")
+    snapshot = compile_snapshot(None, COZE_BOT_CONFIGS)
+    _record_loaded(snapshot)
+    return snapshot
+
+
+def _record_loaded(snapshot: _Snapshot):
+    metrics.set_gauge("coze_bot_configs", len(snapshot.clients))
+    LOGGER.info(f"[Config] 已加载 {len(snapshot.clients)} 个机器人配置 (来源 {COZE_BOT_CONFIG_SOURCE}，版本 {snapshot.version})")
+
+
+def bot_key(open_kfid: Optional[str]) -> str:
+    """客服账号对应的机器人配置 key，未知或未指定时为 default"""
+    clients = _get_snapshot().clients
+    if open_kfid in clients:
+        return open_kfid
+    if open_kfid and open_kfid not in _warned_kfids:
+        _warned_kfids.add(open_kfid)
+        LOGGER.warning(f"⚠️ [Config] 未知客服ID [{open_kfid}]，使用默认配置: {clients[DEFAULT_BOT_KEY].name}")
+    return DEFAULT_BOT_KEY
+
+
+def get_coze_client(open_kfid: Optional[str] = None) -> AsyncCozeClient:
+    """客服账号对应的 Coze 客户端 (当前快照中预先构建好的)"""
+    clients = _get_snapshot().clients
+    return clients.get(open_kfid) or clients[bot_key(open_kfid)]
+
+
+def bot_keys() -> Tuple[str, ...]:
+    return tuple(_get_snapshot().clients)
+
+
+async def refresh() -> bool:
+    """版本号变化时重新加载配置并替换快照，返回是否替换"""
+    global _snapshot, _failed_version
+    current = _get_snapshot()
+    if COZE_BOT_CONFIG_SOURCE not in (SOURCE_FILE, SOURCE_REDIS):
+        return False
+    try:
+        version = await _current_version()
+    except Exception as e:
+        LOGGER.warning(f"[Config] 读取机器人配置版本失败，继续使用当前配置: {e}")
+        return False
+    if version is None or version == current.version or version == _failed_version:
+        return False
+    try:
+        version, raw = await _async_load()
+        snapshot = compile_snapshot(version, raw, current)
+    except Exception as e:
+        _failed_version = version
+        metrics.incr("coze_bot_config_reloads_total", result="error")
+        LOGGER.error(f"❌ [Config] 机器人配置 (版本 {version}) 无效，继续使用版本 {current.version}: {e}")
+        return False
+    changed = sorted(k for k in set(snapshot.configs) | set(current.configs)
+                     if snapshot.configs.get(k) != current.configs.get(k))
+    _snapshot, _failed_version = snapshot, None
+    metrics.incr("coze_bot_config_reloads_total", result="ok")
+    _record_loaded(snapshot)
+    LOGGER.info(f"[Config] 机器人配置已更新: {current.version} -> {version}，变化: {', '.join(changed) or '无'}")
+    return True
+
+
+async def _watch_loop():
+    while True:
+        await asyncio.sleep(COZE_BOT_CONFIG_CHECK_S)
+        try:
+            await refresh()
+        except Exception as e:
+            LOGGER.error(f"[Config] 检查机器人配置异常: {e!r}")
+
+
+def start():
+    """加载配置并启动热更新检查 (lifespan 启动时调用；static 来源只加载不检查)"""
+    global _task
+    _get_snapshot()
+    if COZE_BOT_CONFIG_SOURCE not in (SOURCE_FILE, SOURCE_REDIS) or _task is not None:
+        return
+    _task = asyncio.create_task(_watch_loop())
+
+
+async def stop():
+    global _task
+    task, _task = _task, None
+    if task is not None:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+if __name__ == "__main__":
+    # 校验 / 发布机器人配置 (JSON 文件，结构同 COZE_BOT_CONFIGS)：
+    #   python bot_registry.py check bot_configs.json
+    #   python bot_registry.py publish bot_configs.json   (COZE_BOT_CONFIG_SOURCE=redis 时，各 Worker 在一个检查周期内生效)
+    import sys
+
+    if len(sys.argv) != 3 or sys.argv[1] not in ("check", "publish"):
+        sys.exit("用法: python bot_registry.py check|publish <配置文件.json>")
+    with open(sys.argv[2], encoding="utf-8") as f:
+        raw_configs = json.load(f)
+    try:
+        validate(raw_configs)
+    except BotConfigError as e:
+        sys.exit(f"❌ 配置无效: {e}")
+    print(f"✅ 配置有效: {', '.join(raw_configs)}")
+    if sys.argv[1] == "publish":
+        # 发布文件中的原始内容 (不写入补全的 default，default 仍以各 Worker 的 .env 为准)
+        new_version = publish_bot_configs({k: json.dumps(v, ensure_ascii=False) for k, v in raw_configs.items()})
+        print(f"✅ 已发布到 Redis，版本 {new_version}")
@@ -0,0 +1,118 @@
+import asyncio
+import random
+import time
+import uuid
+from contextlib import asynccontextmanager
+
+import metrics
+from config import LOGGER, COZE_BULKHEAD_MAX_CONCURRENT, COZE_BULKHEAD_MAX_QUEUE, COZE_BULKHEAD_CLUSTER_MAX_CONCURRENT, \
+    COZE_REPLY_DEADLINE_S
+from kv import async_acquire_bulkhead_slot, async_release_bulkhead_slot
+
+'''
+Coze 并发舱壁 (按机器人配置)
+
+所有机器人原本共用同一批后台任务和连接，一个慢工作流 (例如图片分析) 就能占满全部并发，其他机器人的回复跟着排队。
+这里给每个机器人配置 (COZE_BOT_CONFIGS 的 key) 独立的名额：
+- Worker 内：最多 max_concurrent 个调用同时进行，最多 max_queue 个排队等待；队列已满或等到截止时间仍未轮到时
+  抛出 BulkheadFull，调用方立即回复兜底文案
+- 全集群 (可选，cluster_max_concurrent > 0)：拿到 Worker 内名额后再到 Redis 领取租约，领不到则短暂退避重试直到截止时间；
+  Redis 不可用时只按 Worker 内名额限制
+/metrics 中的 coze_bulkhead_in_flight / coze_bulkhead_queued 按机器人反映各客服账号占用的容量。
+'''
+
+# 集群租约时长：覆盖一次调用的最长耗时，Worker 崩溃时未释放的名额到期后回收
+_CLUSTER_LEASE_MS = int((COZE_REPLY_DEADLINE_S + 30) * 1000)
+_CLUSTER_RETRY_S = (0.05, 0.2)
+
+
+class BulkheadFull(Exception):
+    def __init__(self, name: str, reason: str):
+        super().__init__(f"{name}: {reason}")
+        self.reason = reason
+
+
+class Bulkhead:
+    def __init__(self, name: str, max_concurrent: int = COZE_BULKHEAD_MAX_CONCURRENT,
+                 max_queue: int = COZE_BULKHEAD_MAX_QUEUE,
+                 cluster_max_concurrent: int = COZE_BULKHEAD_CLUSTER_MAX_CONCURRENT):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.cluster_max_concurrent = cluster_max_concurrent
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        # 已进入舱壁的调用数 (执行中 + 排队中)，在进入时同步计数，不依赖信号量的内部状态
+        self._admitted = 0
+        self._in_flight = 0
+
+    @classmethod
+    def from_config(cls, name: str, config: dict = None) -> "Bulkhead":
+        config = config or {}
+        return cls(name,
+                   int(config.get("max_concurrent", COZE_BULKHEAD_MAX_CONCURRENT)),
+                   int(config.get("max_queue", COZE_BULKHEAD_MAX_QUEUE)),
+                   int(config.get("cluster_max_concurrent", COZE_BULKHEAD_CLUSTER_MAX_CONCURRENT)))
+
+    @asynccontextmanager
+    async def slot(self, deadline: float):
+        """
+        占用一个名额直到退出 with 块；deadline 为 time.time() 时间戳，排队超过截止时间抛出 BulkheadFull
+        """
+        if self._admitted >= self.max_concurrent + self.max_queue:
+            self._reject("queue_full")
+        self._admitted += 1
+        self._update_gauges()
+        owner = None
+        try:
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), max(deadline - time.time(), 0))
+            except asyncio.TimeoutError:
+                self._reject("timeout")
+            try:
+                if self.cluster_max_concurrent > 0:
+                    owner = await self._acquire_cluster(deadline)
+            except BaseException:
+                self._semaphore.release()
+                raise
+        except BaseException:
+            self._admitted -= 1
+            self._update_gauges()
+            raise
+
+        self._in_flight += 1
+        self._update_gauges()
+        try:
+            yield
+        finally:
+            self._in_flight -= 1
+            self._admitted -= 1
+            self._semaphore.release()
+            self._update_gauges()
+            if owner:
+                try:
+                    await async_release_bulkhead_slot(self.name, owner)
+                except Exception as e:
+                    LOGGER.warning(f"[舱壁] {self.name} 释放集群名额失败 (租约到期后自动回收): {e}")
+
+    async def _acquire_cluster(self, deadline: float):
+        owner = uuid.uuid4().hex
+        while True:
+            try:
+                if await async_acquire_bulkhead_slot(self.name, owner, int(time.time() * 1000), _CLUSTER_LEASE_MS,
+                                                     self.cluster_max_concurrent):
+                    return owner
+            except Exception as e:
+                LOGGER.warning(f"[舱壁] {self.name} Redis 不可用，仅按 Worker 内名额限制: {e}")
+                return None
+            delay = random.uniform(*_CLUSTER_RETRY_S)
+            if time.time() + delay >= deadline:
+                self._reject("cluster_timeout")
+            await asyncio.sleep(delay)
+
+    def _reject(self, reason: str):
+        metrics.incr("coze_bulkhead_rejected_total", bot=self.name, reason=reason)
+        raise BulkheadFull(self.name, reason)
+
+    def _update_gauges(self):
+        metrics.set_gauge("coze_bulkhead_in_flight", self._in_flight, bot=self.name)
+        metrics.set_gauge("coze_bulkhead_queued", self._admitted - self._in_flight, bot=self.name)
@@ -1,63 +1,23 @@
-import json
-import timeit
-import httpx
-import requests
-from dotenv import load_dotenv
-import os
 import asyncio
 import time
-from database_operation import get_conversations_by_user, create_conversation, create_message, \
-    get_conversations_by_user_and_open_kfid, get_user_by_external_id, create_user
-from config import get_coze_config, generate_internal_uid, REDIS_CLIENT, LOGGER
-
-
-def init_config():
-    env_path = "./.env"
-    load_dotenv(dotenv_path=env_path)
-    config = {
-        "token": "Bearer " + os.getenv("COZE_PAT", "").strip(),
-        "workflow_id": os.getenv("COZE_WORKFLOW_ID", "7522357917102800930"),
-        "app_id": os.getenv("COZE_APP_ID", "7522316251134771240")
-    }
-    # 校验配置完整性
-    missing = [k for k, v in config.items() if not v]
-    if missing:
-        raise ValueError(f"❌ 缺少关键配置项: {', '.join(missing)}")
-    print("🚀 初始化Coze环境变量")
-    return config
-
-
-def create_conversation_cozeAPI(conversation_name, open_kfid=None):
-    if open_kfid:
-        # ✅ 关键点：根据 open_kfid 动态获取配置
-        config = get_coze_config(open_kfid)
-    else:
-        config = init_config()
-    '''
-    会话 -> 创建会话
-    '''
-    headers = {
-        'Authorization': config.get('token', ''),
-        'Content-Type': 'application/json',
-    }
-
-    json_data = {
-        'name': conversation_name
-    }
-
-    response = requests.post('https://api.coze.cn/v1/conversation/create', headers=headers, json=json_data, timeout=60)
-    if response.status_code != 200:
-        print("❌ 创建会话失败，状态码:", response.status_code)
-        print("响应内容:", response.text)
-        return None
-
-    info = response.json()
-    if "data" not in info or "id" not in info["data"]:
-        print("❌ 响应格式异常:", info)
-        return None
-    conversation_id = info["data"]["id"]
-    print("✅ 新会话创建成功，会话ID:", conversation_id)
-    return conversation_id
+from typing import Awaitable, Callable, Optional
+
+import metrics
+from database_operation import create_conversation, create_message, get_latest_conversation_id, \
+    get_user_by_external_id, create_user, get_recent_messages
+from coze_client import build_messages
+from bot_registry import get_coze_client
+from reply_segmenter import split_text
+import reply_cache
+import conversation_pool
+import conversation_cache
+import conversation_singleflight
+from http_clients import run_sync
+from config import generate_internal_uid, REDIS_CLIENT, LOGGER, COZE_REPLY_DEADLINE_S, LLM_FALLBACK_REASONS
+
+# message_record.reply_backend：回复来源 (降级模型为 llm:<model>)
+BACKEND_COZE = "coze"
+BACKEND_CACHE = "cache"
 
 
 def insert_new_conversation(user_id, new_conversation_id, open_kfid=None):
@@ -70,20 +30,22 @@ def insert_new_conversation(user_id, new_conversation_id, open_kfid=None):
         "open_kfid": open_kfid
     }
     new_conv = create_conversation(conv_data)
+    conversation_cache.put(user_id, open_kfid, new_conversation_id)
     if open_kfid:
         print(f"✅ 新会话创建成功: {new_conv.conversation_id} 对应用户🐧 ：{new_conv.user_id} 客服ID💬 ：{open_kfid}")
     else:
         print(f"✅ 新会话创建成功: {new_conv.conversation_id} 对应用户🐧 ：{new_conv.user_id} 客服ID💬  ：【默认】")
 
 
-def insert_new_message(user_latest_question, bot_reply, user_id, conversation_id):
+def insert_new_message(user_latest_question, bot_reply, user_id, conversation_id, reply_backend=BACKEND_COZE):
     msg_data = {
         'user_question': user_latest_question,
         'bot_reply': bot_reply,
         'user_id': user_id,
         "user_device_id": None,
         'conversation_id': conversation_id,
-        "comments": None
+        "comments": None,
+        "reply_backend": reply_backend
     }
     new_message = create_message(msg_data)
     print(f"✅ 新消息创建成功: {new_message.id} 对应问题：{new_message.user_question}")
@@ -184,450 +146,170 @@ def get_or_create_latest_conversation(user_id, open_kfid=None):
     user_id: 要查询的用户ID
     open_kfid: 企微客服账号ID，用于选择Coze配置
     """
-    # 查询该用户是否已有会话
+    # ✅ 先查会话缓存 (进程内 LRU -> Redis)，稳定状态下不访问数据库
+    conversation_id = conversation_cache.get(user_id, open_kfid)
+    if conversation_id:
+        return conversation_id
+    # 查询该用户是否已有会话 (只取最新一条的 ID)
+    conversation_id = get_latest_conversation_id(user_id, open_kfid)
     if open_kfid:
-        conversations = get_conversations_by_user_and_open_kfid(user_id, open_kfid)
         print(f"👤 用户ID：{user_id}，🙋 客服ID：{open_kfid}")
     else:
-        conversations = get_conversations_by_user(user_id)
         print(f"👤 用户ID：{user_id}，🙋 客服ID：【默认】")
     # 有会话则返回最新一条的会话ID
-    if conversations:
-        # 返回最新一条会话的 ID
-        conversation_id = conversations[0].conversation_id
+    if conversation_id:
         print(f"✅ 已找到用户ID：{user_id} 的最新会话：{conversation_id}")
+        conversation_cache.put(user_id, open_kfid, conversation_id)
     else:
         print(f"⚠️  该用户({user_id})没有会话，尝试创建新的会话...")
-        new_conversation_id = create_conversation_cozeAPI(user_id, open_kfid)
-        if new_conversation_id:
-            conv_data = {
-                "conversation_id": new_conversation_id,
-                "user_id": user_id,
-                "user_device_id": None,
-                "conversation_name": user_id,
-                "comments": None,
-                "open_kfid": open_kfid
-            }
-            new_conv = create_conversation(conv_data)
-            if open_kfid:
-                print(f"✅ 新会话创建成功: {new_conv.conversation_id} 对应用户🧑 {new_conv.user_id} 客服ID🎧 {open_kfid}")
-            else:
-                print(f"✅ 新会话创建成功: {new_conv.conversation_id} 对应用户🧑 {new_conv.user_id} 客服ID🎧 【默认】")
-            conversation_id = new_conv.conversation_id
-        else:
+        conversation_id = create_latest_conversation(user_id, open_kfid)
+        if not conversation_id:
             print("❌ 新会话创建失败")
-            conversation_id = None
     return conversation_id
 
 
-# 异常问题判断和解决
-def error_judge_handling(error_code, error_msg, response, user_id, headers, json_data, conversation_id):
-    assistant_reply = ''
-    if error_msg:
-        if error_code == 4002:
-            print(f"⚠️ 会话：「{conversation_id}」 失效，尝试创建新的会话...")
-            # 重新创建新的会话
-            new_conversation_id = create_conversation_cozeAPI(user_id)
-            if new_conversation_id:
-                insert_new_conversation(user_id, new_conversation_id)
-                json_data['conversation_id'] = new_conversation_id
-                start = timeit.default_timer()
-                response = requests.post('https://api.coze.cn/v1/workflows/chat', headers=headers, json=json_data,
-                                         timeout=60)
-                end = timeit.default_timer()
-                print(f"⏳ Coze API二次调用耗时: {end - start:.2f}s")
-                if response.status_code != 200:
-                    print(f"❌ 请求失败：{response.status_code}")
-                    print("❌ 响应内容：", response.text)
-                else:
-                    for line in response.iter_lines(decode_unicode=True):
-                        if line.startswith("data:"):
-                            data_str_retry = line[5:].strip()
-                            try:
-                                data_json_retry = json.loads(data_str_retry)
-                                # 检查是否为错误信息
-                                if "msg" in data_json_retry and "code" in data_json_retry:
-                                    error_code = data_json_retry.get("code")
-                                    error_msg = data_json_retry.get("msg")
-                                    print(f"❌ [错误代码 {error_code}] [错误信息 {error_msg}]")
-                                    break
-                                # 检查是否为 assistant 回复
-                                elif data_json_retry.get("role") == "assistant" and "content" in data_json_retry:
-                                    assistant_reply = data_json_retry["content"].strip()
-                                    break
-                            except json.JSONDecodeError:
-                                continue
-        else:
-            print(f"❌ [错误代码 {error_code}] [错误信息 {error_msg}]")
-        return assistant_reply
-    elif assistant_reply:
-        return assistant_reply
-    else:
-        try:
-            error_info = json.loads(response.text)
-            if "msg" in error_info and "code" in error_info:
-                error_msg = error_info.get("msg")
-                error_code = error_info.get("code")
-                print(f"❌ [错误代码 {error_code}] [错误信息 {error_msg}]")
-        except json.JSONDecodeError:
-            print("❌ 未检测到助手回复或错误信息")
-        return assistant_reply
-
-
-def call_coze_workflow(user_id, conversation_id, questions):
-    config = init_config()
+def create_latest_conversation(user_id, open_kfid=None, stale_conversation_id=None):
     """
-    调用Coze API
+    为用户新建会话 (单飞：同一用户 + 客服账号同时只创建一次，并发调用方共享结果)
+    优先取预热池中已创建好的会话，省掉一次 Coze 往返；只有最终胜出的创建者写入数据库
+    stale_conversation_id: 4002 失效的旧会话
     """
-    headers = {
-        'Authorization': config.get('token', ''),
-        'Content-Type': 'application/json',
-    }
-    json_data = {
-        'additional_messages': [],
-        'parameters': {
-            'user_id': user_id
-        },
-        'app_id': config.get('app_id', ''),
-        'workflow_id': config.get('workflow_id', ''),
-        'conversation_id': conversation_id,
-    }
-    # 根据questions类型构建相应的json_data
-    user_latest_question = None
-    if isinstance(questions, str) or isinstance(questions, int) or isinstance(questions, float):
-        json_data['additional_messages'] = [
-            {
-                'content_type': 'text',
-                'role': 'user',
-                'content': questions
-            }
-        ]
-        user_latest_question = questions
-    elif isinstance(questions, list):
-        if len(questions) == 0:
-            print("❌ 问题列表为空，请输入问题")
-            return ""
-        elif len(questions) == 1:
-            json_data['additional_messages'] = [
-                {
-                    'content_type': 'text',
-                    'role': 'user',
-                    'content': questions[0]
-                }
-            ]
-            user_latest_question = questions[0]
-        else:
-            json_data['additional_messages'] = [
-                {
-                    'content_type': 'text',
-                    'role': 'user',
-                    'content': msg
-                }
-                for msg in questions
-            ]
-            user_latest_question = questions[-1]
+    def create():
+        # 单飞的创建在线程池中执行，Coze 请求提交回事件循环，走共享连接池
+        return conversation_pool.take(open_kfid) or run_sync(get_coze_client(open_kfid).create_conversation(user_id))
+
+    return conversation_singleflight.create_once(
+        user_id,
+        open_kfid,
+        create=create,
+        persist=lambda conversation_id: insert_new_conversation(user_id, conversation_id, open_kfid),
+        stale_conversation_id=stale_conversation_id,
+    )
+
+
+async def _renew_conversation(user_id, open_kfid, stale_conversation_id) -> Optional[str]:
+    """会话失效 (4002)：作废缓存并新建会话 (单飞：并发发现同一失效会话的请求共享同一个新会话，创建与入库在线程池中执行)"""
+    print(f"⚠️ 会话：「{stale_conversation_id}」 失效，尝试创建新的会话...")
+    await asyncio.to_thread(conversation_cache.invalidate, user_id, open_kfid, stale_conversation_id)
+    try:
+        new_conversation_id = await asyncio.to_thread(create_latest_conversation, user_id, open_kfid,
+                                                      stale_conversation_id)
+    except Exception as e:
+        print(f"❌ 创建会话异常: {e}")
+        return None
+    if not new_conversation_id:
+        print("❌ 创建新会话失败，无法重试")
+    return new_conversation_id
 
-    else:
-        print("❌ 请输入问题字符串或问题列表")
-        return ""
 
-    if conversation_id:
-        try:
-            start = timeit.default_timer()
-            response = requests.post('https://api.coze.cn/v1/workflows/chat', headers=headers, json=json_data,
-                                     timeout=60)
-            end = timeit.default_timer()
-            print(f"⏳ Coze API 响应耗时: {end - start:.2f}s")
-
-            if response.status_code != 200:
-                try:
-                    error_info_json = json.loads(response.text)
-                    if "msg" in error_info_json and "code" in error_info_json:
-                        error_msg = error_info_json.get("msg")
-                        error_code = error_info_json.get("code")
-                        print(f"❌ ❌ ❌ [错误代码 {error_code}] [错误信息 {error_msg}]")
-                    return ""
-                except json.JSONDecodeError:
-                    print(f"❌ ❌ ❌ 请求失败：{response.status_code}")
-                    print("❌ ❌ ❌ 响应内容：", response.text)
-                    return ""
-
-            response.encoding = 'utf-8'
-            assistant_reply = ""
-            error_msg = None
-            error_code = None
-            # print(response.text)
-
-            for line in response.iter_lines(decode_unicode=True):
-                if line.startswith("data:"):
-                    data_str = line[5:].strip()
-                    try:
-                        data_json = json.loads(data_str)
-                        # 检查是否为 assistant 回复
-                        if data_json.get("role") == "assistant" and "content" in data_json:
-                            assistant_reply = data_json["content"].strip()
-                            break
-                        # 检查是否为错误信息
-                        elif "msg" in data_json and "code" in data_json:
-                            error_msg = data_json.get("msg")
-                            error_code = data_json.get("code")
-                            break
-                    except json.JSONDecodeError:
-                        continue
-
-            if assistant_reply:
-                insert_new_message(user_latest_question, assistant_reply, user_id, conversation_id)
-                print("🤖 bot回复：", assistant_reply)
-                return assistant_reply
-            else:
-                error_reply = error_judge_handling(error_code, error_msg, response, user_id, headers, json_data,
-                                                   conversation_id)
-                if error_reply:
-                    insert_new_message(user_latest_question, error_reply, user_id, conversation_id)
-                    print("🤖 bot二次请求回复：", error_reply)
-                return error_reply
-        except requests.RequestException as e:
-            print("❌ 网络异常：", e)
-            return ""
-    else:
-        print("❌ 未检测到会话ID")
-        return ""
+async def _record_reply(question, reply, user_id, conversation_id, reply_backend=BACKEND_COZE):
+    # ✅ 数据库写入放入线程池，彻底解放 Event Loop
+    try:
+        await asyncio.to_thread(insert_new_message, question, reply, user_id, conversation_id, reply_backend)
+    except Exception as e:
+        print(f"❌ 数据库写入异常【insert_new_message】: {e}")  # 记录日志但不影响回复用户
 
 
-'''
-异步的错误处理和Coze工作流调用
-'''
+async def _emit_whole(on_segment, text, raw_deltas):
+    # 非流式得到的完整回复 (缓存 / 降级 / 兜底) 同样按段落发送
+    if on_segment:
+        for segment in ([text] if raw_deltas else split_text(text)):
+            await on_segment(segment)
 
 
-async def async_error_judge_handling(error_code, error_msg, user_id, headers, json_data, conversation_id, open_kfid):
-    """
-    [异步版] 错误处理与重试逻辑
-    """
-    assistant_reply = ''
-    if error_msg:
-        # -------------------------------------------------------------
-        # Case 1: 会话失效 (4002)，尝试新建会话并重试
-        # -------------------------------------------------------------
-        if error_code == 4002:
-            print(f"⚠️ 会话：「{conversation_id}」 失效，尝试创建新的会话...")
-            # 1. 创建新会话
-            # ✅ 优化：将同步的创建会话操作放入线程池，避免阻塞主循环
-            try:
-                new_conversation_id = await asyncio.to_thread(create_conversation_cozeAPI, user_id, open_kfid)
-            except Exception as e:
-                print(f"❌ 创建会话异常: {e}")
-                new_conversation_id = None
-            # new_conversation_id = create_conversation_cozeAPI(user_id)
-            if new_conversation_id:
-                # ✅ 优化：数据库写入放入线程池
-                try:
-                    await asyncio.to_thread(insert_new_conversation, user_id, new_conversation_id, open_kfid)
-                except Exception as e:
-                    print(f"❌ 数据库写入异常【insert_new_conversation】: {e}")
-                # insert_new_conversation(user_id, new_conversation_id)
-                # 更新请求体中的 conversation_id
-                json_data['conversation_id'] = new_conversation_id
-
-                # 2. 发起二次请求 (异步 httpx)
-                try:
-                    start = timeit.default_timer()
-                    timeout = httpx.Timeout(60.0, connect=10.0)
-                    async with httpx.AsyncClient(timeout=timeout) as client:
-                        async with client.stream('POST', 'https://api.coze.cn/v1/workflows/chat', headers=headers,
-                                                 json=json_data) as response:
-                            if response.status_code != 200:
-                                resp_text = await response.aread()
-                                print(f"❌ [重试] 请求失败：{response.status_code}")
-                                print(f"❌ [重试] 响应内容：{resp_text.decode('utf-8')}")
-                            else:
-                                # 异步解析流式数据
-                                async for line in response.aiter_lines():
-                                    if line.startswith("data:"):
-                                        data_str = line[5:].strip()
-                                        try:
-                                            data_json = json.loads(data_str)
-                                            # 检查是否为 assistant 回复
-                                            if data_json.get("role") == "assistant" and "content" in data_json:
-                                                assistant_reply = data_json["content"].strip()
-                                                break
-                                            # 检查是否依然报错
-                                            elif "msg" in data_json and "code" in data_json:
-                                                e_code = data_json.get("code")
-                                                e_msg = data_json.get("msg")
-                                                print(f"❌ [重试失败] [错误代码:{e_code}] [错误信息:{e_msg}]")
-                                                break
-                                        except json.JSONDecodeError:
-                                            continue
-
-                            end = timeit.default_timer()
-                            print(f"⏳ [重试] Coze API调用耗时: {end - start:.2f}s")
-
-                except Exception as e:
-                    print(f"❌ [重试] 网络异常: {e}")
-            else:
-                print("❌ 创建新会话失败，无法重试")
-        else:
-            print(f"❌ [错误代码 {error_code}] [错误信息 {error_msg}]")
-        return assistant_reply
-    else:
-        print("❌ 未知错误：未检测到回复，也未检测到明确错误码。")
-        return assistant_reply
+async def _llm_fallback_reply(llm, question, conversation_id, deadline) -> Optional[str]:
+    """降级到 OpenAI 兼容模型，带上该会话最近几轮问答；失败返回 None"""
+    history = []
+    if llm.history_turns > 0:
+        try:
+            history = await asyncio.to_thread(get_recent_messages, conversation_id, llm.history_turns)
+        except Exception as e:
+            print(f"❌ 数据库查询异常【get_recent_messages】: {e}")  # 没有上下文也照常回答
+    return await llm.reply(question, history, deadline)
 
 
-async def async_call_coze_workflow(user_id, conversation_id, questions, open_kfid):
-    # ✅ 关键点：根据 open_kfid 动态获取配置
-    config = get_coze_config(open_kfid)
+async def async_call_coze_workflow(user_id, conversation_id, questions, open_kfid,
+                                   on_segment: Optional[Callable[[str], Awaitable[None]]] = None,
+                                   raw_deltas: bool = False, deadline: float = None):
     """
-    调用Coze API (异步版)
+    调用Coze API (异步版)，使用客服账号对应机器人的 AsyncCozeClient
+    on_segment: 渐进式回复。传入时边读取流式增量边按段落 / 句子切分，每段完整后立即 await on_segment(段落)，
+                返回值仍为完整回复 (只在最后入库一次)；不传时保持原行为，只取第一条 assistant 消息
+    raw_deltas: 为 True 时不切分，Coze 的每个增量原样交给 on_segment (用于 SSE 透传)
+    deadline: 回复截止时间 (time.time() 时间戳)。熔断打开、超时或舱壁已满时先降级到机器人的大模型 (llm_fallback，入库)，
+              未开启降级、降级失败或其他 Coze 故障时返回兜底文案 (不入库)
     """
-    headers = {
-        'Authorization': config.get('token', ''),
-        'Content-Type': 'application/json',
-    }
-    json_data = {
-        'additional_messages': [],
-        'parameters': {
-            'user_id': user_id
-        },
-        'app_id': config.get('app_id', ''),
-        'workflow_id': config.get('workflow_id', ''),
-        'conversation_id': conversation_id,
-    }
-
-    # --- 构建消息体逻辑 (保持不变) ---
-    user_latest_question = None
-    if isinstance(questions, (str, int, float)):
-        json_data['additional_messages'] = [
-            {
-                'content_type': 'text',
-                'role': 'user',
-                'content': str(questions)
-            }
-        ]
-        user_latest_question = str(questions)
-    elif isinstance(questions, list):
-        if len(questions) == 0:
-            print("❌ 问题列表为空，请输入问题")
-            return ""
-        elif len(questions) == 1:
-            json_data['additional_messages'] = [
-                {'content_type': 'text', 'role': 'user', 'content': questions[0]}
-            ]
-            user_latest_question = questions[0]
-        else:
-            json_data['additional_messages'] = [
-                {'content_type': 'text', 'role': 'user', 'content': msg}
-                for msg in questions
-            ]
-            user_latest_question = questions[-1]
-    else:
+    messages, user_latest_question = build_messages(questions)
+    if not messages:
         print("❌ 请输入问题字符串或问题列表")
         return ""
-
     if not conversation_id:
         print("❌ 未检测到会话ID")
         return ""
 
-    # --- ✅ 核心修改：使用 httpx 异步请求 ---
+    client = get_coze_client(open_kfid)
+    # FAQ 回复缓存：命中时不调用 Coze，照常发送和入库
+    cache_question = client.reply_cache.question_key(messages) if client.reply_cache else None
+    if cache_question:
+        cached_reply = await reply_cache.get(client.reply_cache, cache_question)
+        if cached_reply:
+            await _emit_whole(on_segment, cached_reply, raw_deltas)
+            await _record_reply(user_latest_question, cached_reply, user_id, conversation_id, BACKEND_CACHE)
+            print("🤖 bot回复 (缓存)：", cached_reply)
+            return cached_reply
+
+    llm = client.llm_fallback
+    coze_deadline = deadline
+    if llm:
+        # 为降级模型预留时间：Coze 提前放弃，降级后仍在回复截止时间内完成
+        if deadline is None:
+            deadline = time.time() + COZE_REPLY_DEADLINE_S
+        coze_deadline = deadline - llm.timeout_s
+
     try:
-        # [1] 计时开始
-        start_time = timeit.default_timer()
-
-        # 设置超时：连接10秒，读取60秒
-        timeout = httpx.Timeout(60.0, connect=10.0)
-
-        async with httpx.AsyncClient(timeout=timeout) as client:
-            # 使用 stream=True 处理流式响应 (SSE)
-            # 注意：API 地址保持不变
-            async with client.stream('POST', 'https://api.coze.cn/v1/workflows/chat', headers=headers,
-                                     json=json_data) as response:
-
-                # [2] 这里测量的是“连接耗时” (TTFB)
-                # ttfb_time = timeit.default_timer()
-                # print(f"⚡️ Coze 连接建立耗时: {ttfb_time - start_time:.2f}s")
-
-                # 1. 处理 HTTP 错误状态码
-                if response.status_code != 200:
-                    # 获取完整响应内容
-                    response_text = await response.aread()
-                    try:
-                        error_info_json = json.loads(response_text)
-                        if "msg" in error_info_json and "code" in error_info_json:
-                            error_msg = error_info_json.get("msg")
-                            error_code = error_info_json.get("code")
-                            print(f"❌ ❌ ❌ [错误代码 {error_code}] [错误信息 {error_msg}]")
-                        return ""
-                    except json.JSONDecodeError:
-                        print(f"❌ ❌ ❌ 请求失败：{response.status_code}")
-                        print("❌ ❌ ❌ 响应内容：", response_text.decode('utf-8'))
-                        return ""
-
-                # 2. 处理流式数据
-                assistant_reply = ""
-                error_msg = None
-                error_code = None
-
-                # ✅ 使用 aiter_lines 异步迭代行
-                async for line in response.aiter_lines():
-                    if line.startswith("data:"):
-                        data_str = line[5:].strip()
-                        try:
-                            data_json = json.loads(data_str)
-
-                            # 检查是否为 assistant 回复
-                            if data_json.get("role") == "assistant" and "content" in data_json:
-                                assistant_reply = data_json["content"].strip()
-                                # 找到回复后，通常可以 break，除非你需要拼接流
-                                # 如果 Coze 返回的是全量数据，break 即可；如果是 token 流，需要拼接
-                                # 根据你之前的代码逻辑，看起来是直接取 content，假定是一次性返回或最后一条
-                                break
-
-                                # 检查是否为错误信息
-                            elif "msg" in data_json and "code" in data_json:
-                                error_msg = data_json.get("msg")
-                                error_code = data_json.get("code")
-                                break
-
-                        except json.JSONDecodeError:
-                            continue
-
-                # [3] 循环结束后，才是真正的“总耗时”
-                end_time = timeit.default_timer()
-                total_duration = end_time - start_time
-                print(f"⏳ Coze API 响应耗时: {total_duration:.2f}s")
-                # 3. 处理结果
-                if assistant_reply:
-                    # ✅ 优化：数据库写入放入线程池，彻底解放 Event Loop
-                    try:
-                        await asyncio.to_thread(insert_new_message, user_latest_question, assistant_reply, user_id,
-                                                conversation_id)
-                    except Exception as e:
-                        print(f"❌ 数据库写入异常【insert_new_message】: {e}")  # 记录日志但不影响回复用户
-                    # insert_new_message(user_latest_question, assistant_reply, user_id, conversation_id)
-                    print("🤖 bot回复：", assistant_reply)
-                    return assistant_reply
-                else:
-                    # ⚠️ 注意：如果 error_judge_handling 内部使用了 response.json() 等同步方法，可能会报错
-                    # 这里我们传入了 httpx 的 response 对象，需确保 helper 函数兼容
-                    # 或者我们在这里读取完 body 再传进去
-                    # 简单起见，这里假设 logic 还能复用
-                    error_reply = await async_error_judge_handling(
-                        error_code, error_msg, user_id, headers, json_data, conversation_id, open_kfid
-                    )
-                    if error_reply:
-                        # ✅ 优化：数据库写入放入线程池
-                        try:
-                            await asyncio.to_thread(insert_new_message, user_latest_question, error_reply, user_id,
-                                                    conversation_id)
-                        except Exception as e:
-                            print(f"❌ 数据库写入异常【insert_new_message】: {e}")
-                        # insert_new_message(user_latest_question, error_reply, user_id, conversation_id)
-                        print("🤖 bot二次请求回复：", error_reply)
-                    return error_reply
-
-    except httpx.RequestError as e:
-        print(f"❌ 网络异常：{e}")
-        return ""
+        start_time = time.perf_counter()
+        reply = await client.run_workflow(
+            user_id, conversation_id, messages, on_segment=on_segment, raw_deltas=raw_deltas,
+            renew_conversation=lambda stale: _renew_conversation(user_id, open_kfid, stale), deadline=coze_deadline,
+        )
+        print(f"⏳ Coze API 响应耗时: {time.perf_counter() - start_time:.2f}s")
     except Exception as e:
         print(f"❌ 未知异常：{e}")
         return ""
+
+    if reply.unavailable and not reply.text:
+        # ✅ 快速失败：熔断 / 超时 / Coze 故障时立即回复兜底文案，不让用户等到超时
+        metrics.incr("coze_fallback_total", bot=client.bot_key, reason=reply.unavailable)
+        if llm and reply.unavailable in LLM_FALLBACK_REASONS:
+            llm_reply = await _llm_fallback_reply(llm, user_latest_question, conversation_id, deadline)
+            if llm_reply:
+                print(f"⚠️ Coze 不可用 ({reply.unavailable})，已降级到 {llm.model}")
+                await _emit_whole(on_segment, llm_reply, raw_deltas)
+                await _record_reply(user_latest_question, llm_reply, user_id, conversation_id, llm.backend)
+                print("🤖 bot回复 (降级)：", llm_reply)
+                return llm_reply
+        print(f"⚠️ Coze 不可用 ({reply.unavailable})，回复兜底文案")
+        await _emit_whole(on_segment, client.fallback_reply, raw_deltas)
+        return client.fallback_reply
+
+    if not reply.text:
+        if reply.error_msg:
+            print(f"❌ [错误代码 {reply.error_code}] [错误信息 {reply.error_msg}]")
+        else:
+            print("❌ 未知错误：未检测到回复，也未检测到明确错误码。")
+        return ""
+
+    if cache_question and not reply.unavailable:
+        await reply_cache.put(client.reply_cache, cache_question, reply.text)
+    # 4002 恢复后记录到新会话
+    await _record_reply(user_latest_question, reply.text, user_id, reply.conversation_id)
+    print("🤖 bot回复：", reply.text)
+    return reply.text
+
+
+def call_coze_workflow(user_id, conversation_id, questions, open_kfid=None):
+    """
+    调用Coze API (同步版，供线程池中的旧同步路径使用)
+    与异步版共用同一个客户端，协程提交到服务的事件循环执行
+    """
+    return run_sync(async_call_coze_workflow(user_id, conversation_id, questions, open_kfid))
@@ -0,0 +1,107 @@
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, List
+
+import metrics
+from config import LOGGER, COZE_BREAKER_WINDOW_S, COZE_BREAKER_MIN_REQUESTS, COZE_BREAKER_FAILURE_RATIO, \
+    COZE_BREAKER_OPEN_S
+
+'''
+熔断器 (按 Coze workflow_id，进程内)
+
+Coze 故障或变慢时，每条消息都要等到超时，大量挂起的任务占满连接和事件循环。熔断器统计最近
+COZE_BREAKER_WINDOW_S 秒内的调用结果 (按秒分桶的滚动窗口)：
+- closed：正常放行；窗口内调用数不少于 COZE_BREAKER_MIN_REQUESTS 且失败比例达到 COZE_BREAKER_FAILURE_RATIO 时打开
+- open：直接拒绝 (调用方立即回复兜底文案)，COZE_BREAKER_OPEN_S 秒后进入半开
+- half_open：只放行一个探测请求，成功则关闭并清空窗口，失败则重新打开
+失败指网络异常、超过截止时间、5xx 与限流；业务错误 (如 4002) 说明上游可用，按成功计。
+'''
+
+CLOSED = "closed"
+HALF_OPEN = "half_open"
+OPEN = "open"
+_STATE_GAUGE = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, window_s: int = COZE_BREAKER_WINDOW_S, min_requests: int = COZE_BREAKER_MIN_REQUESTS,
+                 failure_ratio: float = COZE_BREAKER_FAILURE_RATIO, open_s: float = COZE_BREAKER_OPEN_S):
+        self.name = name
+        self.window_s = window_s
+        self.min_requests = min_requests
+        self.failure_ratio = failure_ratio
+        self.open_s = open_s
+        self.state = CLOSED
+        self._opened_at = 0.0
+        self._probing = False
+        # [秒, 成功数, 失败数]
+        self._buckets: Deque[List[int]] = deque()
+        # 同步路径 (run_sync) 与事件循环可能在不同线程中使用同一个熔断器
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """是否放行本次调用；放行后必须调用 record 或 release"""
+        with self._lock:
+            if self.state == OPEN:
+                if time.monotonic() - self._opened_at < self.open_s:
+                    return False
+                self._set_state(HALF_OPEN)
+            if self.state == HALF_OPEN:
+                if self._probing:
+                    return False
+                self._probing = True
+            return True
+
+    def record(self, success: bool):
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._probing = False
+                if success:
+                    self._buckets.clear()
+                    self._set_state(CLOSED)
+                else:
+                    self._open()
+                return
+            now = int(time.monotonic())
+            self._evict(now)
+            if not self._buckets or self._buckets[-1][0] != now:
+                self._buckets.append([now, 0, 0])
+            self._buckets[-1][1 if success else 2] += 1
+            if self.state == CLOSED and not success:
+                total = sum(b[1] + b[2] for b in self._buckets)
+                failures = sum(b[2] for b in self._buckets)
+                if total >= self.min_requests and failures >= total * self.failure_ratio:
+                    self._open()
+
+    def release(self):
+        """放行后调用被取消 (客户端断开等)，不计入结果"""
+        with self._lock:
+            self._probing = False
+
+    def _evict(self, now: int):
+        while self._buckets and self._buckets[0][0] <= now - self.window_s:
+            self._buckets.popleft()
+
+    def _open(self):
+        self._opened_at = time.monotonic()
+        self._set_state(OPEN)
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            LOGGER.warning(f"[熔断] {self.name}: {self.state} -> {state}")
+            self.state = state
+        metrics.set_gauge("coze_breaker_state", _STATE_GAUGE[state], workflow=self.name)
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    """按名称 (workflow_id) 共享的熔断器，多个客服账号使用同一工作流时共用"""
+    breaker = _breakers.get(name)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.setdefault(name, CircuitBreaker(name))
+    return breaker
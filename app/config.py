@@ -2,6 +2,7 @@ import logging
 import os
 from dotenv import load_dotenv
 import redis
+import redis.asyncio as aioredis
 import uuid
 import base64
 import struct
@@ -34,6 +35,117 @@ REDIS_DB = int(os.getenv("REDIS_DB", 0))
 REDIS_PASSWORD = os.getenv("REDIS_PASSWORD", "redis")
 
 REDIS_CLIENT = redis.Redis(host=REDISHOST, port=REDISPORT, db=REDIS_DB, password=REDIS_PASSWORD)
+# 异步 Redis 客户端 (供 Event Loop 内的协程使用，连接在首次使用时按 Worker 建立)
+ASYNC_REDIS_CLIENT = aioredis.Redis(host=REDISHOST, port=REDISPORT, db=REDIS_DB, password=REDIS_PASSWORD)
+
+# 微信回调入口配置
+# queue : 回调只做验签解密并投递 Token，sync_msg 由后台协程异步拉取 (默认)
+# inline: 旧模式，在回调请求内同步拉取消息
+WECHAT_INGRESS_MODE = os.getenv("WECHAT_INGRESS_MODE", "queue").lower()
+SYNC_QUEUE_MAXSIZE = int(os.getenv("SYNC_QUEUE_MAXSIZE", 1000))  # 待拉取 Token 队列上限
+WECHAT_MAX_BODY_BYTES = int(os.getenv("WECHAT_MAX_BODY_BYTES", 16 * 1024))  # 回调请求体上限，超出直接拒绝
+SYNC_WORKER_COUNT = int(os.getenv("SYNC_WORKER_COUNT", 2))  # 每个 Worker 内的拉取协程数
+WEWORK_HTTP_TIMEOUT = float(os.getenv("WEWORK_HTTP_TIMEOUT", 10))  # 企业微信接口超时(秒)
+SYNC_PAGE_LIMIT = int(os.getenv("SYNC_PAGE_LIMIT", 200))  # sync_msg 每页条数 (最大 1000)
+SYNC_MAX_MSG_AGE = int(os.getenv("SYNC_MAX_MSG_AGE", 600))  # 超过该时长(秒)的历史消息不再回复，0 表示不限制
+SYNC_LEASE_TTL_MS = int(os.getenv("SYNC_LEASE_TTL_MS", 30000))  # 单客服账号拉取租约时长(毫秒)，拉取期间自动续期
+MSG_DEDUP_TTL = int(os.getenv("MSG_DEDUP_TTL", 3 * 24 * 3600))  # 消息去重状态保留时长(秒)，覆盖 sync_msg 可拉取的 3 天
+SYNC_COALESCE_WINDOW_MS = int(os.getenv("SYNC_COALESCE_WINDOW_MS", 200))  # 回调合并窗口(毫秒)，0 表示不合并
+SYNC_COALESCE_MAX_DELAY_MS = int(os.getenv("SYNC_COALESCE_MAX_DELAY_MS", 1000))  # 合并最长等待(毫秒)
+SYNC_DRAIN_RETRIES = int(os.getenv("SYNC_DRAIN_RETRIES", 3))  # sync_msg 失败后的重试次数，用完后保留标记等下一次回调
+SYNC_DRAIN_BACKOFF_MS = int(os.getenv("SYNC_DRAIN_BACKOFF_MS", 500))  # 重试退避基数(毫秒)，第 n 次在 [0, 基数 * 2^(n-1)] 内随机
+
+# 上游 HTTP 连接池 (企业微信 / Coze 各一个，进程内共享)
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "True").lower() == "true"  # 需要安装 h2，上游不支持时自动回退 HTTP/1.1
+HTTP_WARMUP = os.getenv("HTTP_WARMUP", "True").lower() == "true"  # 启动时预先建立连接
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", 60))  # 空闲连接保留时长(秒)
+WEWORK_HTTP_MAX_CONNECTIONS = int(os.getenv("WEWORK_HTTP_MAX_CONNECTIONS", 50))
+COZE_HTTP_MAX_CONNECTIONS = int(os.getenv("COZE_HTTP_MAX_CONNECTIONS", 100))
+
+# access_token 刷新：过期前多少秒后台提前刷新；跨 Worker 刷新租约时长(毫秒)
+WEWORK_TOKEN_REFRESH_AHEAD = int(os.getenv("WEWORK_TOKEN_REFRESH_AHEAD", 300))
+WEWORK_TOKEN_LEASE_MS = int(os.getenv("WEWORK_TOKEN_LEASE_MS", 10000))
+
+# kf/send_msg 发送调度：Redis 令牌桶限流 (企业级 + 客服账号级)，限频错误码退避重试
+SEND_RATE_CORP_PER_SEC = float(os.getenv("SEND_RATE_CORP_PER_SEC", 20))
+SEND_BURST_CORP = int(os.getenv("SEND_BURST_CORP", 40))
+SEND_RATE_KFID_PER_SEC = float(os.getenv("SEND_RATE_KFID_PER_SEC", 5))
+SEND_BURST_KFID = int(os.getenv("SEND_BURST_KFID", 10))
+SEND_CONCURRENCY = int(os.getenv("SEND_CONCURRENCY", 8))  # 每个进程的发送协程数
+SEND_QUEUE_MAXSIZE = int(os.getenv("SEND_QUEUE_MAXSIZE", 10000))  # 队列满时发送方等待 (背压)，不丢弃
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", 4))
+SEND_BACKOFF_BASE_MS = int(os.getenv("SEND_BACKOFF_BASE_MS", 500))
+SEND_BACKOFF_MAX_MS = int(os.getenv("SEND_BACKOFF_MAX_MS", 8000))
+
+# 渐进式回复：Coze 流式输出时按段落 / 句子切分，边生成边发送
+COZE_PROGRESSIVE_REPLY = os.getenv("COZE_PROGRESSIVE_REPLY", "False").lower() == "true"
+REPLY_SEGMENT_MIN_CHARS = int(os.getenv("REPLY_SEGMENT_MIN_CHARS", 60))  # 按句子切分时每段的最少字符数
+WEWORK_TEXT_MAX_BYTES = 2048  # 企业微信客服文本消息 content 上限 (UTF-8 字节)
+
+# Coze 会话预热池：按机器人配置 (COZE_BOT_CONFIGS 的 key) 在 Redis 中预留已创建的会话，新用户首条消息直接取用
+COZE_CONV_POOL_ENABLED = os.getenv("COZE_CONV_POOL_ENABLED", "True").lower() == "true"
+COZE_CONV_POOL_SIZE = int(os.getenv("COZE_CONV_POOL_SIZE", 10))  # 每次补充到的数量
+COZE_CONV_POOL_LOW_WATERMARK = int(os.getenv("COZE_CONV_POOL_LOW_WATERMARK", 3))  # 低于该数量时触发补充
+COZE_CONV_POOL_CHECK_INTERVAL = int(os.getenv("COZE_CONV_POOL_CHECK_INTERVAL", 30))  # 后台巡检间隔(秒)
+
+# 用户最新会话 ID 缓存：进程内 LRU + Redis，稳定状态下每条消息不再查询 MySQL
+CONV_CACHE_LOCAL_SIZE = int(os.getenv("CONV_CACHE_LOCAL_SIZE", 10000))  # 进程内 LRU 条数，0 表示只用 Redis
+CONV_CACHE_LOCAL_TTL = int(os.getenv("CONV_CACHE_LOCAL_TTL", 60))  # 进程内条目有效期(秒)，限制其他 Worker 更换会话后的不一致窗口
+CONV_CACHE_TTL = int(os.getenv("CONV_CACHE_TTL", 7 * 24 * 3600))  # Redis 条目有效期(秒)
+CONV_CREATE_LOCK_MS = int(os.getenv("CONV_CREATE_LOCK_MS", 15000))  # 单飞创建锁时长(毫秒)，超时后由等待者接手 (fencing 防止旧结果覆盖)
+
+# FAQ 回复缓存：按 (工作流, 规范化后的问题) 缓存 Coze 回复，还需在 COZE_BOT_CONFIGS 中为机器人开启 reply_cache
+COZE_REPLY_CACHE_ENABLED = os.getenv("COZE_REPLY_CACHE_ENABLED", "False").lower() == "true"
+COZE_REPLY_CACHE_TTL = int(os.getenv("COZE_REPLY_CACHE_TTL", 3600))  # 缓存有效期(秒)，机器人配置中的 ttl 优先
+COZE_REPLY_CACHE_MAX_ENTRIES = int(os.getenv("COZE_REPLY_CACHE_MAX_ENTRIES", 1000))  # 每个工作流的条数上限，超出时淘汰最久未访问的
+COZE_REPLY_CACHE_MAX_QUESTION_CHARS = int(os.getenv("COZE_REPLY_CACHE_MAX_QUESTION_CHARS", 64))  # 只缓存不超过该长度的短问题
+
+# Coze 调用韧性：端到端截止时间、限流重试、按 workflow_id 熔断，熔断打开或超时时立即回复兜底文案
+COZE_REPLY_DEADLINE_S = float(os.getenv("COZE_REPLY_DEADLINE_S", 50))  # 从回复任务开始处理起算的回复截止时间(秒)
+COZE_RATE_LIMIT_RETRIES = int(os.getenv("COZE_RATE_LIMIT_RETRIES", 2))  # Coze 限流时的最大重试次数
+COZE_RETRY_BACKOFF_MS = int(os.getenv("COZE_RETRY_BACKOFF_MS", 500))  # 重试退避基数(毫秒)，第 n 次在 [0, 基数 * 2^n] 内随机
+COZE_BREAKER_WINDOW_S = int(os.getenv("COZE_BREAKER_WINDOW_S", 30))  # 熔断统计的滚动窗口(秒)
+COZE_BREAKER_MIN_REQUESTS = int(os.getenv("COZE_BREAKER_MIN_REQUESTS", 10))  # 窗口内至少多少次调用才判断是否熔断
+COZE_BREAKER_FAILURE_RATIO = float(os.getenv("COZE_BREAKER_FAILURE_RATIO", 0.5))  # 失败比例达到该值时打开熔断
+COZE_BREAKER_OPEN_S = float(os.getenv("COZE_BREAKER_OPEN_S", 30))  # 熔断打开后多久放行一个探测请求(秒)
+COZE_FALLBACK_REPLY = os.getenv("COZE_FALLBACK_REPLY", "当前咨询人数较多，请稍后再试～")  # 兜底文案，机器人配置中的 fallback_reply 优先
+# Coze 并发舱壁：每个机器人配置独立的并发上限和等待队列，慢工作流不会占满所有连接，机器人配置中的 bulkhead 优先
+COZE_BULKHEAD_MAX_CONCURRENT = int(os.getenv("COZE_BULKHEAD_MAX_CONCURRENT", 20))  # 每个 Worker 内同时调用 Coze 的上限
+COZE_BULKHEAD_MAX_QUEUE = int(os.getenv("COZE_BULKHEAD_MAX_QUEUE", 20))  # 每个 Worker 内等待名额的上限，超出时直接回复兜底文案
+COZE_BULKHEAD_CLUSTER_MAX_CONCURRENT = int(os.getenv("COZE_BULKHEAD_CLUSTER_MAX_CONCURRENT", 0))  # 全集群并发上限 (Redis)，0 表示不限制
+
+# Coze 降级到 OpenAI 兼容模型：熔断打开、超过时间预算或舱壁已满时改用大模型直接回答，失败再回复兜底文案
+# 机器人配置中的 llm_fallback 优先 (可单独开启 / 关闭、更换 base_url / model / api_key)
+LLM_FALLBACK_ENABLED = os.getenv("LLM_FALLBACK_ENABLED", "False").lower() == "true"
+LLM_FALLBACK_BASE_URL = os.getenv("LLM_FALLBACK_BASE_URL", "")  # 必填，如 https://api.openai.com/v1，为空时不开启降级
+LLM_FALLBACK_MODEL = os.getenv("LLM_FALLBACK_MODEL", "gpt-4o-mini")
+LLM_FALLBACK_API_KEY = os.getenv("LLM_FALLBACK_API_KEY") or OPENAI_API_KEY
+LLM_FALLBACK_SYSTEM_PROMPT = os.getenv("LLM_FALLBACK_SYSTEM_PROMPT", "你是企业微信客服助手，请简洁、礼貌地用中文回答用户的问题。")
+LLM_FALLBACK_TIMEOUT_S = float(os.getenv("LLM_FALLBACK_TIMEOUT_S", 15))  # 预留给大模型的时间(秒)，Coze 的截止时间相应提前
+LLM_FALLBACK_HISTORY_TURNS = int(os.getenv("LLM_FALLBACK_HISTORY_TURNS", 5))  # 带上最近几轮问答作为上下文
+LLM_FALLBACK_HISTORY_MAX_CHARS = int(os.getenv("LLM_FALLBACK_HISTORY_MAX_CHARS", 2000))  # 上下文总字数上限，超出时丢弃最早的
+LLM_FALLBACK_REASONS = [r.strip() for r in os.getenv("LLM_FALLBACK_REASONS", "circuit_open,deadline,bulkhead_full").split(",")
+                        if r.strip()]  # 触发降级的 Coze 不可用原因
+
+# 回复任务队列配置
+# memory: 任务在收到回调的 Worker 内以后台协程执行 (默认)
+# redis : 任务写入 Redis Stream，由消费者组内任意进程 (API Worker 或独立 worker.py) 消费
+WORK_QUEUE_MODE = os.getenv("WORK_QUEUE_MODE", "memory").lower()
+WORK_QUEUE_STREAM = os.getenv("WORK_QUEUE_STREAM", "coze:jobs")
+WORK_QUEUE_GROUP = os.getenv("WORK_QUEUE_GROUP", "coze-workers")
+WORK_QUEUE_MAXLEN = int(os.getenv("WORK_QUEUE_MAXLEN", 100000))  # Stream 近似最大长度
+WORK_QUEUE_CONSUMERS = int(os.getenv("WORK_QUEUE_CONSUMERS", 4))  # 每个进程的消费协程数，0 表示 API Worker 不消费
+WORK_QUEUE_VISIBILITY_MS = int(os.getenv("WORK_QUEUE_VISIBILITY_MS", 180000))  # 未 ACK 超过该时长的任务会被回收
+WORK_QUEUE_MAX_DELIVERIES = int(os.getenv("WORK_QUEUE_MAX_DELIVERIES", 3))  # 超过投递次数转入死信队列
+
+# 用户消息聚合：同一用户在静默期内连发的文本合并为一次 Coze 调用和一次回复
+AGGREGATE_QUIET_MS = int(os.getenv("AGGREGATE_QUIET_MS", 0))  # 静默期(毫秒)，0 表示不聚合 (默认关闭)
+AGGREGATE_MAX_WAIT_MS = int(os.getenv("AGGREGATE_MAX_WAIT_MS", 5000))  # 首条消息最长等待(毫秒)
+AGGREGATE_MAX_MSGS = int(os.getenv("AGGREGATE_MAX_MSGS", 10))  # 单批最多合并条数
+AGGREGATE_RECOVER_AFTER_MS = int(os.getenv("AGGREGATE_RECOVER_AFTER_MS", 30000))  # 超过该时长仍未交给回复任务的聚合消息视为所在进程已崩溃，由其他 Worker 回收
+
+# 有序执行通道：同一用户的回复任务串行，不同用户并行，总并发上限
+LANE_MAX_CONCURRENCY = int(os.getenv("LANE_MAX_CONCURRENCY", 50))
 
 # 日志配置
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -74,14 +186,23 @@ def generate_internal_uid(prefix="user"):
 # 1. 多账号配置映射表
 # ==============================================================================
 # 这里的 Key 是微信客服的 OpenKfId (wk开头)
-# Value 是对应的 Coze 机器人配置
+# Value 是对应的 Coze 机器人配置 (由 bot_registry 校验后为每个配置构建一次客户端，Token 可不带 Bearer 前缀)
 COZE_BOT_CONFIGS = {
     # 🤖 账号 A: 测试1 (生产环境)
     "wkx_XXXXXXXXXXX": {
         "name": "测试1",
         "token": "pat_XXXXXXXXXX",
         "workflow_id": "XXXXXXXXXX",
-        "app_id": "XXXXXXXXXX"
+        "app_id": "XXXXXXXXXX",
+        # 可选：FAQ 回复缓存 (还需 COZE_REPLY_CACHE_ENABLED=True)
+        # allowlist 为正则列表，匹配规范化后的问题 (全角转半角、小写、去标点)，不配置时所有短问题都缓存
+        # "reply_cache": {"enabled": True, "allowlist": ["营业时间|几点", "价格|多少钱", "发货|快递"], "ttl": 3600},
+        # 可选：Coze 熔断 / 超时时回复的兜底文案 (默认使用 COZE_FALLBACK_REPLY)
+        # "fallback_reply": "客服繁忙，请稍后再试或拨打 400-XXX-XXXX",
+        # 可选：并发舱壁 (默认使用 COZE_BULKHEAD_* 环境变量)，例如给慢的图片分析机器人更小的份额
+        # "bulkhead": {"max_concurrent": 5, "max_queue": 10, "cluster_max_concurrent": 15},
+        # 可选：Coze 不可用时降级到 OpenAI 兼容模型 (默认使用 LLM_FALLBACK_* 环境变量)，"enabled": False 可单独关闭
+        # "llm_fallback": {"enabled": True, "model": "gpt-4o-mini", "system_prompt": "你是 XX 店铺的客服……"},
     },
 
     # 🤖 账号 B: 测试2 (生产环境)
@@ -103,60 +224,17 @@ COZE_BOT_CONFIGS = {
     }
 }
 
-
 # ==============================================================================
-# 2. 综合获取配置函数 (替代原来的 init_config 和 get_coze_config)
+# 2. 配置来源与热更新 (bot_registry)
 # ==============================================================================
-def get_coze_config(open_kfid: str = None) -> dict:
-    """
-    根据 OpenKfId 获取最终的 Coze 配置字典。
-
-    功能特点：
-    1. 自动路由：根据 open_kfid 匹配不同机器人。
-    2. 自动兜底：匹配不到 ID 时，返回 default 配置。
-    3. 自动补全：确保 token 包含 'Bearer ' 前缀。
-    4. 安全校验：检查关键参数是否为空。
-    """
-
-    # 1. 获取原始配置字典
-    raw_config = COZE_BOT_CONFIGS.get(open_kfid)
-    print("🚀 初始化Coze环境变量")
-    if raw_config:
-        print(f"🎯 [Config] 命中特定配置: {raw_config['name']} (ID: {open_kfid})")
-        pass
-    else:
-        # 没找到 ID，使用默认配置
-        raw_config = COZE_BOT_CONFIGS["default"]
-        if open_kfid:  # 只有当传入了ID但没找到时才打印警告
-            print(f"⚠️ [Config] 未知客服ID [{open_kfid}]，降级使用默认配置: {raw_config['name']}")
-
-    # 2. 处理 Token 格式 (统一添加 Bearer 前缀)
-    # 许多人容易在这个细节出错，这里统一处理最稳妥
-    token = raw_config.get("token", "").strip()
-    if token and not token.startswith("Bearer "):
-        final_token = f"Bearer {token}"
-    else:
-        final_token = token
-
-    # 3. 构造最终配置对象
-    final_config = {
-        "name": raw_config.get("name", "Unknown"),
-        "token": final_token,
-        "workflow_id": raw_config.get("workflow_id", ""),
-        "app_id": raw_config.get("app_id", "")
-    }
-
-    # 4. 完整性校验
-    # 检查是否有空值
-    missing_keys = [k for k, v in final_config.items() if not v]
-    if missing_keys:
-        error_msg = f"❌ 配置错误: 客服账号 [{final_config['name']}] 缺少关键参数: {', '.join(missing_keys)}"
-        print(error_msg)
-        # 在生产环境中，这里可以选择抛出异常，或者返回空字典让调用方处理
-        # raise ValueError(error_msg)
-        return {}
-
-    return final_config
+# static: 使用上面的 COZE_BOT_CONFIGS (默认)，修改需重新部署
+# file  : 读取 COZE_BOT_CONFIG_FILE (JSON，结构同 COZE_BOT_CONFIGS)，文件修改后各 Worker 自动重新加载
+# redis : 读取 HASH COZE_BOT_CONFIG_REDIS_KEY (field 为 key，value 为 JSON)，用 python bot_registry.py publish <file> 发布
+# 新配置缺少 default 时沿用上面 COZE_BOT_CONFIGS 中的 default (即 .env 中的 COZE_PAT 等)
+COZE_BOT_CONFIG_SOURCE = os.getenv("COZE_BOT_CONFIG_SOURCE", "static").lower()
+COZE_BOT_CONFIG_FILE = os.getenv("COZE_BOT_CONFIG_FILE", "bot_configs.json")
+COZE_BOT_CONFIG_REDIS_KEY = os.getenv("COZE_BOT_CONFIG_REDIS_KEY", "coze:bot_configs")
+COZE_BOT_CONFIG_CHECK_S = float(os.getenv("COZE_BOT_CONFIG_CHECK_S", 5))  # 检查版本号 (文件修改时间 / Redis 版本号) 的间隔(秒)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,94 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import metrics
+from config import LOGGER, CONV_CACHE_LOCAL_SIZE, CONV_CACHE_LOCAL_TTL, CONV_CACHE_TTL
+from kv import get_latest_conversation, set_latest_conversation, invalidate_latest_conversation
+
+'''
+用户最新会话 ID 缓存
+
+get_or_create_latest_conversation 每条消息都要知道 (内部用户ID, 客服账号) 对应的最新会话，
+原本每次都查询 MySQL。这里在数据库前加两级缓存：
+- 进程内 LRU (CONV_CACHE_LOCAL_SIZE 条，每条 CONV_CACHE_LOCAL_TTL 秒后重新读 Redis，限制多 Worker 间的不一致窗口)
+- Redis (map:latest_conv:*，跨 Worker 共享)
+新建会话时写入；Coze 返回 4002 (会话失效) 时按值作废，只删除仍指向失效会话的条目。
+所有函数都是同步的，与 get_or_create_latest_conversation 一样在线程池中调用；Redis 不可用时回退到数据库。
+'''
+
+
+class _LocalLRU:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Tuple[str, str], Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key) -> Optional[str]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            if item[1] <= time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return item[0]
+
+    def put(self, key, value: str):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def discard(self, key, value: str):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[0] == value:
+                del self._data[key]
+
+
+_local = _LocalLRU(CONV_CACHE_LOCAL_SIZE, CONV_CACHE_LOCAL_TTL)
+
+
+def get(user_id: str, open_kfid: str = None) -> Optional[str]:
+    """返回缓存的最新会话 ID，未命中时返回 None (由调用方查询数据库后 put)"""
+    key = (user_id, open_kfid or "")
+    conversation_id = _local.get(key)
+    if conversation_id:
+        metrics.incr("conv_cache_lookups_total", tier="local")
+        return conversation_id
+    try:
+        conversation_id = get_latest_conversation(user_id, open_kfid)
+    except Exception as e:
+        LOGGER.error(f"[会话缓存] Redis 读取失败: {e}")
+        conversation_id = None
+    if conversation_id:
+        _local.put(key, conversation_id)
+        metrics.incr("conv_cache_lookups_total", tier="redis")
+        return conversation_id
+    metrics.incr("conv_cache_lookups_total", tier="miss")
+    return None
+
+
+def put(user_id: str, open_kfid: str, conversation_id: str):
+    _local.put((user_id, open_kfid or ""), conversation_id)
+    try:
+        set_latest_conversation(user_id, open_kfid, conversation_id, CONV_CACHE_TTL)
+    except Exception as e:
+        LOGGER.error(f"[会话缓存] Redis 写入失败: {e}")
+
+
+def invalidate(user_id: str, open_kfid: str, conversation_id: str):
+    """会话在 Coze 侧已失效 (4002)：只在缓存仍指向该会话时删除"""
+    _local.discard((user_id, open_kfid or ""), conversation_id)
+    try:
+        invalidate_latest_conversation(user_id, open_kfid, conversation_id)
+    except Exception as e:
+        LOGGER.error(f"[会话缓存] Redis 作废失败: {e}")
+    metrics.incr("conv_cache_invalidations_total")
@@ -0,0 +1,133 @@
+import asyncio
+import uuid
+from typing import Optional
+
+import metrics
+from config import LOGGER, COZE_CONV_POOL_ENABLED, COZE_CONV_POOL_SIZE, \
+    COZE_CONV_POOL_LOW_WATERMARK, COZE_CONV_POOL_CHECK_INTERVAL
+import bot_registry
+from kv import pop_pooled_conversation, push_pooled_conversation, async_pooled_conversation_count, async_push_pooled_conversation, \
+    async_acquire_conv_pool_refill_lease, async_release_conv_pool_refill_lease
+
+'''
+Coze 会话预热池
+
+新用户的第一条消息原本要先同步调用一次 /v1/conversation/create 再调用工作流，多出一个完整的 Coze 往返。
+这里按机器人配置 (bot_registry 中的 key，未知客服账号归入 default) 在 Redis 中预留已创建的会话：
+- 取用：get_or_create_latest_conversation 为新用户取会话时先从池中 LPOP，命中则只剩一次数据库写入
+- 补充：后台协程定期巡检，池中数量低于 COZE_CONV_POOL_LOW_WATERMARK 时补充到 COZE_CONV_POOL_SIZE；
+  取用后低于水位会立即唤醒补充。多个 Worker 通过 Redis 租约保证同一机器人同一时刻只有一个补充者
+- 池为空、Redis 不可用或未启用时回退到原来的同步创建，不影响回复
+'''
+
+# 预热会话在 Coze 侧的名称 (分配给用户后以数据库中的 conversation_name 为准)
+POOLED_CONVERSATION_NAME = "pooled"
+# 单次补充的并发创建数
+_REFILL_CONCURRENCY = 4
+_REFILL_LEASE_MS = 60000
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_wake: Optional[asyncio.Event] = None
+_task: Optional[asyncio.Task] = None
+
+
+def pool_key(open_kfid: str) -> str:
+    """客服账号对应的池 (与 Coze 客户端的机器人路由一致)"""
+    return bot_registry.bot_key(open_kfid)
+
+
+def take(open_kfid: str) -> Optional[str]:
+    """
+    为新用户取一个预先创建的会话 (同步，可在线程池中调用)，池为空或不可用时返回 None
+    未指定客服账号的旧路径使用 .env 中的 Coze 配置，不走预热池
+    """
+    if not COZE_CONV_POOL_ENABLED or not open_kfid:
+        return None
+    bot_key = pool_key(open_kfid)
+    try:
+        conversation_id, left = pop_pooled_conversation(bot_key)
+    except Exception as e:
+        LOGGER.warning(f"[会话池] 读取失败，改为直接创建: {e}")
+        return None
+    metrics.incr("coze_conv_pool_lookups_total", bot=bot_key, result="hit" if conversation_id else "miss")
+    metrics.set_gauge("coze_conv_pool_size", left, bot=bot_key)
+    if left < COZE_CONV_POOL_LOW_WATERMARK and _loop is not None and _wake is not None:
+        _loop.call_soon_threadsafe(_wake.set)
+    return conversation_id
+
+
+def recycle(open_kfid: str, conversation_id: str):
+    """归还一个已创建但未分配给用户的会话 (例如单飞创建中被 fencing 拒绝的结果)"""
+    if not COZE_CONV_POOL_ENABLED or not open_kfid:
+        return
+    try:
+        push_pooled_conversation(pool_key(open_kfid), conversation_id)
+    except Exception as e:
+        LOGGER.warning(f"[会话池] 归还会话失败: {e}")
+
+
+async def _refill(bot_key: str):
+    owner = uuid.uuid4().hex
+    if not await async_acquire_conv_pool_refill_lease(bot_key, owner, _REFILL_LEASE_MS):
+        return  # 其他 Worker 正在补充
+    try:
+        size = await async_pooled_conversation_count(bot_key)
+        metrics.set_gauge("coze_conv_pool_size", size, bot=bot_key)
+        if size >= COZE_CONV_POOL_LOW_WATERMARK:
+            return
+        client = bot_registry.get_coze_client(bot_key)
+        missing = COZE_CONV_POOL_SIZE - size
+        while missing > 0:
+            batch = min(missing, _REFILL_CONCURRENCY)
+            created = await asyncio.gather(*(client.create_conversation(POOLED_CONVERSATION_NAME) for _ in range(batch)))
+            for conversation_id in filter(None, created):
+                size = await async_push_pooled_conversation(bot_key, conversation_id)
+            ok = sum(1 for c in created if c)
+            metrics.incr("coze_conv_pool_refill_total", ok, bot=bot_key, result="ok")
+            if ok < batch:
+                # 创建失败 (配置错误 / 限流)：本轮放弃，等下次巡检
+                metrics.incr("coze_conv_pool_refill_total", batch - ok, bot=bot_key, result="error")
+                break
+            missing -= batch
+        metrics.set_gauge("coze_conv_pool_size", size, bot=bot_key)
+        LOGGER.info(f"[会话池] {bot_key} 已补充，当前 {size} 个")
+    finally:
+        await async_release_conv_pool_refill_lease(bot_key, owner)
+
+
+async def _refill_all():
+    # 每轮按当前配置补充 (热更新新增的机器人在下一轮开始预热)
+    bot_keys = bot_registry.bot_keys()
+    results = await asyncio.gather(*(_refill(bot_key) for bot_key in bot_keys), return_exceptions=True)
+    for bot_key, result in zip(bot_keys, results):
+        if isinstance(result, Exception):
+            LOGGER.error(f"[会话池] {bot_key} 补充失败: {result!r}")
+
+
+async def _refill_loop():
+    while True:
+        await _refill_all()
+        try:
+            await asyncio.wait_for(_wake.wait(), COZE_CONV_POOL_CHECK_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _wake.clear()
+
+
+def start():
+    """启动后台补充协程 (lifespan 启动时调用)"""
+    global _loop, _wake, _task
+    if not COZE_CONV_POOL_ENABLED or _task is not None:
+        return
+    _loop = asyncio.get_running_loop()
+    _wake = asyncio.Event()
+    _task = asyncio.create_task(_refill_loop())
+    LOGGER.info(f"🚀 Coze 会话预热池已启动: 每个机器人 {COZE_CONV_POOL_SIZE} 个，低水位 {COZE_CONV_POOL_LOW_WATERMARK}")
+
+
+async def stop():
+    global _loop, _wake, _task
+    task, _loop, _wake, _task = _task, None, None, None
+    if task is not None:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
@@ -0,0 +1,113 @@
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from typing import Callable, Dict, Optional, Tuple
+
+import metrics
+import conversation_pool
+from config import LOGGER, CONV_CACHE_TTL, CONV_CREATE_LOCK_MS
+from kv import acquire_conv_create_lock, release_conv_create_lock, conv_create_lock_held, \
+    commit_latest_conversation, get_latest_conversation
+
+'''
+会话创建单飞
+
+新用户的两条消息同时到达，或同一失效会话 (4002) 被并发请求同时发现时，每个请求都会各自创建一个 Coze 会话并写入数据库，
+既浪费 Coze 调用，又把用户的上下文拆到两个会话里。这里保证同一 (用户, 客服账号) 同一时刻只创建一次：
+- 进程内：并发调用方等待同一个 Future，共享结果
+- 跨 Worker：Redis 锁 + 递增的 fencing token。持锁者创建后按 token 条件写入最新会话 (map:latest_conv:*)，
+  锁过期后被其他 Worker 接手时，旧持锁者的写入会被拒绝，它创建的会话归还到预热池，转而采用新结果
+- 等待者在锁释放后从 Redis 读取结果；持锁者创建失败时由等待者重新抢锁创建
+- Redis 不可用时退化为只在进程内单飞
+'''
+
+_POLL_INTERVAL_S = 0.05
+# 持锁创建却被 fencing 拒绝的最多次数 (Coze 创建耗时持续超过锁时长时避免无限重试)
+_MAX_FENCED_ATTEMPTS = 3
+
+_inflight: Dict[Tuple[str, str], Future] = {}
+_inflight_lock = threading.Lock()
+
+
+def create_once(user_id: str, open_kfid: Optional[str], create: Callable[[], Optional[str]],
+                persist: Callable[[str], None], stale_conversation_id: str = None) -> Optional[str]:
+    """
+    为用户新建会话 (同步，在线程池中调用)，并发调用方共享同一个结果
+    @param create: 在 Coze 侧创建会话，返回会话 ID
+    @param persist: 写入数据库 (只由最终胜出的创建者调用)
+    @param stale_conversation_id: 已失效的会话 (4002)，缓存中仍是它时视为还没有新会话
+    """
+    key = (user_id, open_kfid or "")
+    with _inflight_lock:
+        future = _inflight.get(key)
+        leader = future is None
+        if leader:
+            future = _inflight[key] = Future()
+    if not leader:
+        metrics.incr("conv_create_total", result="shared")
+        return future.result()
+
+    try:
+        conversation_id = _create_across_workers(user_id, open_kfid, create, persist, stale_conversation_id)
+        future.set_result(conversation_id)
+        return conversation_id
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight.pop(key, None)
+
+
+def _current(user_id: str, open_kfid: Optional[str], stale_conversation_id: Optional[str]) -> Optional[str]:
+    conversation_id = get_latest_conversation(user_id, open_kfid)
+    return conversation_id if conversation_id and conversation_id != stale_conversation_id else None
+
+
+def _create_across_workers(user_id, open_kfid, create, persist, stale_conversation_id) -> Optional[str]:
+    owner = uuid.uuid4().hex
+    fenced_attempts = 0
+    while True:
+        try:
+            fence = acquire_conv_create_lock(user_id, open_kfid, owner, CONV_CREATE_LOCK_MS)
+        except Exception as e:
+            LOGGER.warning(f"[会话创建] Redis 锁不可用，仅在进程内单飞: {e}")
+            conversation_id = create()
+            if conversation_id:
+                persist(conversation_id)
+            return conversation_id
+
+        if fence:
+            try:
+                # 双重检查：其他 Worker 可能刚刚创建完成
+                existing = _current(user_id, open_kfid, stale_conversation_id)
+                if existing:
+                    metrics.incr("conv_create_total", result="shared")
+                    return existing
+                conversation_id = create()
+                if not conversation_id:
+                    metrics.incr("conv_create_total", result="failed")
+                    return None
+                if commit_latest_conversation(user_id, open_kfid, fence, conversation_id, CONV_CACHE_TTL):
+                    persist(conversation_id)
+                    metrics.incr("conv_create_total", result="created")
+                    return conversation_id
+                # 创建期间锁已过期并被其他 Worker 接手：放弃自己的结果
+                LOGGER.warning(f"[会话创建] fencing token {fence} 已过期，采用其他 Worker 的结果: user={user_id}")
+                metrics.incr("conv_create_total", result="fenced_out")
+                conversation_pool.recycle(open_kfid, conversation_id)
+                fenced_attempts += 1
+            finally:
+                release_conv_create_lock(user_id, open_kfid, owner)
+
+        # 其他 Worker 正在创建：等它释放锁 (或锁过期) 后读取结果，没有结果则重新抢锁
+        while conv_create_lock_held(user_id, open_kfid):
+            time.sleep(_POLL_INTERVAL_S)
+        existing = _current(user_id, open_kfid, stale_conversation_id)
+        if existing:
+            metrics.incr("conv_create_total", result="shared")
+            return existing
+        if fenced_attempts >= _MAX_FENCED_ATTEMPTS:
+            LOGGER.error(f"[会话创建] 连续 {fenced_attempts} 次创建超过锁时长 (CONV_CREATE_LOCK_MS)，放弃: user={user_id}")
+            return None
@@ -0,0 +1,355 @@
+import asyncio
+import json
+import random
+import time
+from typing import Awaitable, Callable, List, NamedTuple, Optional, Tuple
+
+import httpx
+
+import metrics
+from bulkhead import Bulkhead, BulkheadFull
+from circuit_breaker import get_breaker
+from config import LOGGER, COZE_REPLY_DEADLINE_S, COZE_RATE_LIMIT_RETRIES, COZE_RETRY_BACKOFF_MS, \
+    COZE_FALLBACK_REPLY
+from http_clients import get_async_client, UPSTREAM_COZE
+from llm_fallback import LLMFallback
+from reply_cache import ReplyCachePolicy
+from reply_segmenter import ReplySegmenter, PassThroughSegmenter
+from util.sse import SSEEvent, aiter_sse
+
+'''
+Coze 异步客户端
+
+每个机器人配置在进程内只构建一个 AsyncCozeClient (由 bot_registry 校验配置后构建，按客服账号查找)，
+构建时完成 Token 规范化 (补全 Bearer 前缀)，并准备好请求头和请求体模板，之后每条消息不再重新读取环境变量或拼装配置：
+- create_conversation：创建会话 (/v1/conversation/create)
+- run_workflow：调用对话流 (/v1/workflows/chat)，传入 on_segment 时边读流边分段回调，否则只取第一条完整回答；
+  会话失效 (4002) 时通过调用方提供的 renew_conversation 换一个新会话并自动重试一次
+- 韧性：按机器人配置的并发舱壁 (bulkhead) 限制同时调用数；整个调用 (含排队与重试) 受端到端截止时间约束；
+  Coze 限流时带随机抖动退避重试；按 workflow_id 熔断 (circuit_breaker)。
+  舱壁已满、熔断打开、超时或上游故障时返回 unavailable，由调用方降级到大模型 (llm_fallback) 或回复兜底文案 (fallback_reply)
+- 渐进式回复的分段先放入队列，由调用方所在协程在舱壁名额和截止时间之外逐段执行 on_segment，
+  发送慢 (企业微信限流、退避重试) 不会占用 Coze 并发名额，也不会让 Coze 调用被判超时
+所有请求走共享的 Coze 连接池 (http_clients)，同步调用方通过 http_clients.run_sync 使用。
+'''
+
+CREATE_CONVERSATION_URL = "https://api.coze.cn/v1/conversation/create"
+WORKFLOW_CHAT_URL = "https://api.coze.cn/v1/workflows/chat"
+
+# Coze 错误码：会话不存在 / 已失效
+CODE_CONVERSATION_NOT_FOUND = 4002
+# 限流：HTTP 429 与 Coze 业务码 4013 (请求频率超限)
+RATE_LIMIT_CODES = frozenset({429, 4013})
+# 剩余时间不足该值时不再发起 (或重试) 请求
+_MIN_BUDGET_S = 1.0
+
+# unavailable 原因
+UNAVAILABLE_CIRCUIT_OPEN = "circuit_open"
+UNAVAILABLE_DEADLINE = "deadline"
+UNAVAILABLE_NETWORK = "network"
+UNAVAILABLE_UPSTREAM = "upstream_error"
+UNAVAILABLE_RATE_LIMITED = "rate_limited"
+UNAVAILABLE_BULKHEAD_FULL = "bulkhead_full"
+
+# Coze /v1/workflows/chat 流式事件
+EVENT_MESSAGE_DELTA = "conversation.message.delta"
+EVENT_MESSAGE_COMPLETED = "conversation.message.completed"
+EVENT_CHAT_FAILED = "conversation.chat.failed"
+EVENT_ERROR = "error"
+EVENT_DONE = "done"
+# 只取完整回复时订阅的事件 (增量事件不解析)；渐进式回复额外订阅增量事件
+REPLY_EVENTS = (EVENT_MESSAGE_COMPLETED, EVENT_CHAT_FAILED, EVENT_ERROR, EVENT_DONE)
+PROGRESSIVE_EVENTS = REPLY_EVENTS + (EVENT_MESSAGE_DELTA,)
+
+
+class CozeReply(NamedTuple):
+    text: str
+    # 实际使用的会话 (4002 恢复后为新会话，消息记录应写到这里)
+    conversation_id: Optional[str]
+    error_code: Optional[int] = None
+    error_msg: Optional[str] = None
+    # 上游不可用的原因 (熔断 / 超时 / 网络 / 5xx / 限流)，此时调用方应回复兜底文案
+    unavailable: Optional[str] = None
+
+
+def build_messages(questions) -> Tuple[List[dict], Optional[str]]:
+    """
+    把用户问题 (字符串 / 数字 / 多条聚合消息) 转为 additional_messages
+    返回 (消息列表, 入库用的问题文本)，问题为空或类型不支持时消息列表为空
+    """
+    if isinstance(questions, (str, int, float)):
+        questions = [str(questions)]
+    if not isinstance(questions, list) or not questions:
+        return [], None
+    messages = [{'content_type': 'text', 'role': 'user', 'content': q} for q in questions]
+    # 聚合后的多条消息一起入库，保证历史记录完整
+    return messages, "\n".join(str(q) for q in questions)
+
+
+async def _aiter_coze_events(response: httpx.Response, subscribe=REPLY_EVENTS):
+    # Coze 出错时可能直接返回 JSON 而不是事件流，统一包装成 error 事件
+    if "application/json" in response.headers.get("Content-Type", ""):
+        yield SSEEvent(EVENT_ERROR, (await response.aread()).decode("utf-8", "replace"))
+        return
+    async for event in aiter_sse(response.aiter_bytes(), subscribe):
+        yield event
+
+
+def _load_event(event: SSEEvent) -> Optional[dict]:
+    try:
+        data = event.json()
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def _coze_event_error(event: str, data: dict) -> Optional[Tuple[int, str]]:
+    """事件表示失败时返回 (错误码, 错误信息)"""
+    if event == EVENT_CHAT_FAILED:
+        last_error = data.get("last_error") or {}
+        return last_error.get("code"), last_error.get("msg")
+    if "msg" in data and "code" in data and data.get("code") != 0:
+        return data.get("code"), data.get("msg")
+    return None
+
+
+def _is_answer(data: dict) -> bool:
+    # 排除 follow_up (推荐问题)、verbose 等非回答消息
+    return data.get("role") == "assistant" and data.get("type", "answer") == "answer"
+
+
+class AsyncCozeClient:
+    def __init__(self, bot_key: str, name: str, token: str, workflow_id: str, app_id: str,
+                 reply_cache: dict = None, fallback_reply: str = None, bulkhead: dict = None,
+                 llm_fallback: dict = None):
+        self.bot_key = bot_key
+        self.name = name or "Unknown"
+        token = (token or "").strip()
+        if token and not token.startswith("Bearer "):
+            token = f"Bearer {token}"
+        missing = [k for k, v in (("token", token), ("workflow_id", workflow_id), ("app_id", app_id)) if not v]
+        if missing:
+            LOGGER.error(f"❌ 配置错误: 客服账号 [{self.name}] 缺少关键参数: {', '.join(missing)}")
+        self.headers = {'Authorization': token, 'Content-Type': 'application/json'}
+        self._body_template = {'app_id': app_id, 'workflow_id': workflow_id}
+        # FAQ 回复缓存规则 (未开启时为 None)
+        self.reply_cache = ReplyCachePolicy.from_config(bot_key, workflow_id, reply_cache)
+        self.fallback_reply = fallback_reply or COZE_FALLBACK_REPLY
+        self.breaker = get_breaker(workflow_id or bot_key)
+        # 并发舱壁按机器人配置划分 (多个客服账号即使共用工作流也各自有份额)
+        self.bulkhead = Bulkhead.from_config(bot_key, bulkhead)
+        # Coze 不可用时的降级模型 (未开启时为 None)
+        self.llm_fallback = LLMFallback.from_config(bot_key, llm_fallback)
+
+    @classmethod
+    def from_config(cls, bot_key: str, config: dict) -> "AsyncCozeClient":
+        return cls(bot_key, config.get("name"), config.get("token"), config.get("workflow_id"), config.get("app_id"),
+                   config.get("reply_cache"), config.get("fallback_reply"), config.get("bulkhead"),
+                   config.get("llm_fallback"))
+
+    async def create_conversation(self, name: str) -> Optional[str]:
+        """创建会话，失败返回 None"""
+        start = time.perf_counter()
+        try:
+            resp = await get_async_client(UPSTREAM_COZE).post(CREATE_CONVERSATION_URL, headers=self.headers,
+                                                              json={'name': name})
+            info = resp.json() if resp.status_code == 200 else {}
+        except (httpx.HTTPError, ValueError) as e:
+            LOGGER.warning(f"[Coze] {self.bot_key} 创建会话异常: {e!r}")
+            return None
+        finally:
+            metrics.observe("coze_conv_create_seconds", time.perf_counter() - start)
+        conversation_id = (info.get("data") or {}).get("id") if isinstance(info, dict) else None
+        if not conversation_id:
+            LOGGER.warning(f"[Coze] {self.bot_key} 创建会话失败: status={resp.status_code}, body={resp.text[:200]}")
+        return conversation_id
+
+    async def run_workflow(self, user_id: str, conversation_id: str, messages: List[dict],
+                           on_segment: Optional[Callable[[str], Awaitable[None]]] = None,
+                           raw_deltas: bool = False,
+                           renew_conversation: Optional[Callable[[str], Awaitable[Optional[str]]]] = None,
+                           deadline: float = None) -> CozeReply:
+        """
+        调用对话流
+        on_segment: 渐进式回复。边读取流式增量边按段落 / 句子切分，每段完整后立即 await on_segment(段落)；
+                    不传时只取第一条完整回答
+        raw_deltas: 为 True 时不切分，Coze 的每个增量原样交给 on_segment (用于 SSE 透传)
+        renew_conversation: 会话失效 (4002) 时调用，传入失效的会话 ID，返回新会话 ID (None 表示放弃重试)
+        deadline: 截止时间 (time.time() 时间戳)，默认从现在起 COZE_REPLY_DEADLINE_S 秒
+        """
+        if deadline is None:
+            deadline = time.time() + COZE_REPLY_DEADLINE_S
+        if deadline - time.time() < _MIN_BUDGET_S:
+            return CozeReply("", conversation_id, unavailable=UNAVAILABLE_DEADLINE)
+        if on_segment is None:
+            return await self._run_in_bulkhead(user_id, conversation_id, messages, None, raw_deltas,
+                                               renew_conversation, deadline)
+
+        # Coze 调用 (舱壁 + 截止时间内) 只把分段放入队列；本协程在其之外逐段执行 on_segment
+        segments: asyncio.Queue = asyncio.Queue()
+
+        async def enqueue(segment: str):
+            segments.put_nowait(segment)
+
+        producer = asyncio.create_task(self._run_in_bulkhead(user_id, conversation_id, messages, enqueue, raw_deltas,
+                                                             renew_conversation, deadline))
+        producer.add_done_callback(lambda _: segments.put_nowait(None))
+        try:
+            while True:
+                segment = await segments.get()
+                if segment is None:
+                    break
+                await on_segment(segment)
+            return producer.result()
+        finally:
+            # on_segment 出错或调用方被取消 (客户端断开) 时一并取消 Coze 调用
+            if not producer.done():
+                producer.cancel()
+                await asyncio.gather(producer, return_exceptions=True)
+
+    async def _run_in_bulkhead(self, user_id, conversation_id, messages, on_segment, raw_deltas, renew_conversation,
+                               deadline) -> CozeReply:
+        try:
+            async with self.bulkhead.slot(deadline - _MIN_BUDGET_S):
+                return await self._guarded(user_id, conversation_id, messages, on_segment, raw_deltas,
+                                           renew_conversation, deadline)
+        except BulkheadFull:
+            return CozeReply("", conversation_id, unavailable=UNAVAILABLE_BULKHEAD_FULL)
+
+    async def _guarded(self, user_id, conversation_id, messages, on_segment, raw_deltas, renew_conversation,
+                       deadline) -> CozeReply:
+        if not self.breaker.allow():
+            return CozeReply("", conversation_id, unavailable=UNAVAILABLE_CIRCUIT_OPEN)
+
+        # 已经发出的分段：超时时作为部分回复返回，且不再重试 / 回复兜底文案
+        emitted = []
+
+        async def emit(segment: str):
+            emitted.append(segment)
+            await on_segment(segment)
+
+        reply = None
+        try:
+            reply = await self._run_with_retries(user_id, conversation_id, messages, emit if on_segment else None,
+                                                 raw_deltas, renew_conversation, deadline, emitted)
+            return reply
+        finally:
+            if reply is None:
+                self.breaker.release()  # 调用被取消 (客户端断开)
+            else:
+                self.breaker.record(reply.unavailable is None)
+
+    async def _run_with_retries(self, user_id, conversation_id, messages, on_segment, raw_deltas, renew_conversation,
+                                deadline, emitted) -> CozeReply:
+        renewed, retries = False, 0
+        while True:
+            reply = await self._attempt(user_id, conversation_id, messages, on_segment, raw_deltas, deadline, emitted)
+            if reply.text or emitted:
+                return reply
+            if reply.error_code == CODE_CONVERSATION_NOT_FOUND and renew_conversation is not None and not renewed:
+                renewed = True
+                new_conversation_id = await renew_conversation(conversation_id)
+                if not new_conversation_id:
+                    return reply
+                LOGGER.info(f"[Coze] 会话 {conversation_id} 已失效，改用新会话 {new_conversation_id} 重试")
+                conversation_id = new_conversation_id
+                continue
+            if reply.unavailable == UNAVAILABLE_RATE_LIMITED and retries < COZE_RATE_LIMIT_RETRIES:
+                # 全抖动指数退避，避免被限流的请求同时重试
+                delay = random.uniform(0, COZE_RETRY_BACKOFF_MS * 2 ** retries) / 1000
+                if deadline - time.time() - delay >= _MIN_BUDGET_S:
+                    retries += 1
+                    metrics.incr("coze_retries_total", bot=self.bot_key, reason=reply.unavailable)
+                    LOGGER.warning(f"[Coze] {self.bot_key} 被限流，{delay:.2f}s 后第 {retries} 次重试")
+                    await asyncio.sleep(delay)
+                    continue
+            return reply
+
+    async def _attempt(self, user_id, conversation_id, messages, on_segment, raw_deltas, deadline,
+                       emitted) -> CozeReply:
+        try:
+            return await asyncio.wait_for(self._chat(user_id, conversation_id, messages, on_segment, raw_deltas),
+                                          max(deadline - time.time(), 0))
+        except asyncio.TimeoutError:
+            LOGGER.warning(f"[Coze] {self.bot_key} 超过回复截止时间，放弃等待")
+            partial = ("" if raw_deltas else "\n\n").join(emitted)
+            return CozeReply(partial, conversation_id, unavailable=UNAVAILABLE_DEADLINE)
+        except httpx.RequestError as e:
+            LOGGER.warning(f"[Coze] {self.bot_key} 网络异常: {e!r}")
+            return CozeReply("", conversation_id, error_msg=str(e), unavailable=UNAVAILABLE_NETWORK)
+
+    async def _chat(self, user_id, conversation_id, messages, on_segment, raw_deltas) -> CozeReply:
+        body = {**self._body_template, 'parameters': {'user_id': user_id}, 'conversation_id': conversation_id,
+                'additional_messages': messages}
+        segmenter = None
+        if on_segment:
+            segmenter = PassThroughSegmenter() if raw_deltas else ReplySegmenter()
+        # 增量事件只在渐进式回复时订阅，否则解码器直接丢弃，不做解析
+        subscribe = PROGRESSIVE_EVENTS if segmenter is not None else REPLY_EVENTS
+        reply, error_code, error_msg = "", None, None
+        streamed_msg_ids = set()  # 已通过增量事件收到内容的消息，其 completed 事件不再重复处理
+
+        start = time.perf_counter()
+        try:
+            async with get_async_client(UPSTREAM_COZE).stream('POST', WORKFLOW_CHAT_URL, headers=self.headers,
+                                                              json=body) as response:
+                if response.status_code != 200:
+                    text = (await response.aread()).decode("utf-8", "replace")
+                    try:
+                        info = json.loads(text)
+                    except ValueError:
+                        info = None
+                    if isinstance(info, dict) and "code" in info:
+                        error_code, error_msg = info.get("code"), info.get("msg")
+                    else:
+                        error_code, error_msg = response.status_code, text[:200]
+                    return CozeReply("", conversation_id, error_code, error_msg,
+                                     self._classify(response.status_code, error_code))
+
+                async for event in _aiter_coze_events(response, subscribe):
+                    if event.event == EVENT_DONE:
+                        break
+                    data = _load_event(event)
+                    if data is None:
+                        continue
+                    error = _coze_event_error(event.event, data)
+                    if error:
+                        error_code, error_msg = error
+                        break
+                    if not _is_answer(data):
+                        continue
+                    if segmenter is None:
+                        # 只取第一条完整的回答
+                        reply = (data.get("content") or "").strip()
+                        break
+                    chunks = []
+                    if event.event == EVENT_MESSAGE_DELTA:
+                        streamed_msg_ids.add(data.get("id"))
+                        chunks.append(data.get("content") or "")
+                    elif event.event == EVENT_MESSAGE_COMPLETED:
+                        if data.get("id") not in streamed_msg_ids:
+                            chunks.append(data.get("content") or "")
+                        # 一条消息结束：用空行分隔，ReplySegmenter 会把尚未凑满一段的尾巴也发出去
+                        chunks.append("\n\n")
+                    for chunk in chunks:
+                        if not chunk:
+                            continue
+                        reply += chunk
+                        for segment in segmenter.feed(chunk):
+                            await on_segment(segment)
+        finally:
+            metrics.observe("coze_workflow_seconds", time.perf_counter() - start, bot=self.bot_key)
+
+        if segmenter is not None:
+            for segment in segmenter.flush():
+                await on_segment(segment)
+            reply = reply.strip()
+        return CozeReply(reply, conversation_id, error_code, error_msg, self._classify(200, error_code))
+
+    @staticmethod
+    def _classify(status_code: int, error_code) -> Optional[str]:
+        if status_code in RATE_LIMIT_CODES or error_code in RATE_LIMIT_CODES:
+            return UNAVAILABLE_RATE_LIMITED
+        if status_code >= 500:
+            return UNAVAILABLE_UPSTREAM
+        return None
@@ -1,4 +1,5 @@
-from sqlalchemy import Column, String, BigInteger, Text, Integer, DateTime, ForeignKey, func, create_engine
+from sqlalchemy import Column, String, BigInteger, Text, Integer, DateTime, ForeignKey, func, create_engine, text
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import declarative_base, relationship, sessionmaker
 from sqlalchemy.dialects.mysql import LONGTEXT  # 👈 关键：引入 MySQL 专用类型
 from config import generate_internal_uid, LOGGER
@@ -65,6 +66,7 @@ class MessageRecord(Base):
                              ForeignKey('conversation.conversation_id', onupdate='CASCADE', ondelete='CASCADE'),
                              nullable=False, comment='会话ID')
     comments = Column(String(64), nullable=True, comment='备注')
+    reply_backend = Column(String(32), nullable=True, comment='回复来源 (coze / cache / llm:<model>)')
     sorting = Column(Integer, nullable=True, comment='排序')
     created_time = Column(DateTime, server_default=func.current_timestamp(), nullable=False, comment='创建时间')
 
@@ -96,6 +98,43 @@ SessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False)
 # 创建表
 Base.metadata.create_all(engine)
 
+# ================= 已有数据库升级 =================
+# create_all 只建缺失的表，不会给已存在的表补列；启动时按 information_schema 检查，缺列才执行 ALTER (幂等)
+# (表名, 列名, DDL)
+SCHEMA_MIGRATIONS = [
+    ("message_record", "reply_backend",
+     "ALTER TABLE message_record ADD COLUMN reply_backend varchar(32) DEFAULT NULL "
+     "COMMENT '回复来源 (coze / cache / llm:<model>)' AFTER comments"),
+]
+# MySQL 1060: Duplicate column name (多个 Worker 同时启动，其他 Worker 已经加上了)
+_ER_DUP_FIELDNAME = 1060
+
+
+def _column_exists(conn, table: str, column: str) -> bool:
+    return bool(conn.execute(
+        text("SELECT COUNT(*) FROM information_schema.COLUMNS "
+             "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table AND COLUMN_NAME = :column"),
+        {"table": table, "column": column},
+    ).scalar())
+
+
+def migrate_schema(bind=engine):
+    """补齐 SCHEMA_MIGRATIONS 中缺失的列，已存在时跳过"""
+    for table, column, ddl in SCHEMA_MIGRATIONS:
+        with bind.connect() as conn:
+            if _column_exists(conn, table, column):
+                continue
+            try:
+                conn.execute(text(ddl))
+                conn.commit()
+                LOGGER.info(f"✅ 数据库升级: {table} 新增列 {column}")
+            except OperationalError as e:
+                if e.orig is None or e.orig.args[0] != _ER_DUP_FIELDNAME:
+                    raise
+
+
+migrate_schema()
+
 
 # ================= 封装 User Session 的 CRUD =================
 
@@ -243,6 +282,18 @@ def get_conversations_by_user(user_id):
         session.close()
 
 
+def get_latest_conversation_id(user_id, open_kfid=None):
+    """只查询用户最新一条会话的 ID (不加载整张会话列表)，open_kfid 为空时不区分客服账号"""
+    session = SessionLocal()
+    try:
+        query = session.query(Conversation.conversation_id).filter_by(user_id=user_id)
+        if open_kfid:
+            query = query.filter_by(open_kfid=open_kfid)
+        return query.order_by(Conversation.updated_at.desc()).limit(1).scalar()
+    finally:
+        session.close()
+
+
 # Update Conversation
 def update_conversation(conv_id, update_data):
     session = SessionLocal()
@@ -319,6 +370,22 @@ def get_messages_by_user(user_id):
         session.close()
 
 
+# Read Recent Messages by Conversation (最近 limit 条，按时间正序)
+def get_recent_messages(conv_id, limit):
+    session = SessionLocal()
+    try:
+        rows = (
+            session.query(MessageRecord.user_question, MessageRecord.bot_reply)
+                .filter_by(conversation_id=conv_id)
+                .order_by(MessageRecord.id.desc())
+                .limit(limit)
+                .all()
+        )
+        return [(row.user_question, row.bot_reply) for row in reversed(rows)]
+    finally:
+        session.close()
+
+
 # Update Message
 def update_message(msg_id, update_data):
     session = SessionLocal()
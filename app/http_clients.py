@@ -0,0 +1,210 @@
+import asyncio
+import threading
+from typing import Awaitable, Dict, NamedTuple, Optional, TypeVar
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import LOGGER, HTTP2_ENABLED, HTTP_WARMUP, HTTP_KEEPALIVE_EXPIRY, WEWORK_HTTP_TIMEOUT, \
+    WEWORK_HTTP_MAX_CONNECTIONS, COZE_HTTP_MAX_CONNECTIONS, LLM_FALLBACK_ENABLED, LLM_FALLBACK_BASE_URL, \
+    LLM_FALLBACK_TIMEOUT_S
+
+'''
+按上游划分的共享 HTTP 连接池
+
+每个上游 (企业微信 / Coze / 降级用的大模型) 在进程内只有一个长连接 httpx.AsyncClient 和一个 requests.Session，
+由 FastAPI lifespan 创建、预热和关闭，避免每条消息都重新做一次 TCP + TLS 握手。
+安装了 h2 (httpx[http2]) 时启用 HTTP/2，由 TLS ALPN 协商，上游不支持时自动回退到 HTTP/1.1。
+
+连接复用统计：requests 为收到响应的请求数，new_connections 为新建的连接数，
+hits = requests - new_connections 即复用已有连接的请求数。
+
+异步客户端绑定在创建它的事件循环上，线程池中的同步代码通过 run_sync 把协程提交回该事件循环执行。
+'''
+
+T = TypeVar("T")
+
+try:
+    import h2  # noqa: F401
+    _H2_INSTALLED = True
+except ImportError:
+    _H2_INSTALLED = False
+
+UPSTREAM_WEWORK = "wework"
+UPSTREAM_COZE = "coze"
+UPSTREAM_LLM = "llm"
+
+
+class _UpstreamSpec(NamedTuple):
+    base_url: str
+    max_connections: int
+    timeout: httpx.Timeout
+    # 是否在启动时预热 (大模型只在开启降级时预热)
+    warmup: bool = True
+
+
+UPSTREAMS: Dict[str, _UpstreamSpec] = {
+    UPSTREAM_WEWORK: _UpstreamSpec("https://qyapi.weixin.qq.com", WEWORK_HTTP_MAX_CONNECTIONS,
+                                   httpx.Timeout(WEWORK_HTTP_TIMEOUT)),
+    UPSTREAM_COZE: _UpstreamSpec("https://api.coze.cn", COZE_HTTP_MAX_CONNECTIONS,
+                                 httpx.Timeout(60.0, connect=10.0)),
+    # 降级只在 Coze 不可用时发生，流量替代 Coze 的那部分，连接数上限沿用 Coze 的配置；机器人可配置不同的 base_url
+    UPSTREAM_LLM: _UpstreamSpec(LLM_FALLBACK_BASE_URL, COZE_HTTP_MAX_CONNECTIONS,
+                                httpx.Timeout(LLM_FALLBACK_TIMEOUT_S, connect=5.0), warmup=LLM_FALLBACK_ENABLED and bool(LLM_FALLBACK_BASE_URL)),
+}
+
+_async_clients: Dict[str, httpx.AsyncClient] = {}
+_sessions: Dict[str, requests.Session] = {}
+_sessions_lock = threading.Lock()
+# lifespan 所在的事件循环 (共享异步客户端只在这个循环中使用)
+_loop: Optional[asyncio.AbstractEventLoop] = None
+# (upstream, 客户端类型) -> [请求数, 新建连接数]
+_stats: Dict[tuple, list] = {}
+
+
+def _stat(upstream: str, kind: str) -> list:
+    return _stats.setdefault((upstream, kind), [0, 0])
+
+
+def _async_event_hooks(upstream: str) -> dict:
+    stat = _stat(upstream, "async")
+
+    async def trace(event_name: str, info: dict):
+        # httpcore 只有在连接池里没有可用连接时才会建立 TCP 连接
+        if event_name == "connection.connect_tcp.complete":
+            stat[1] += 1
+
+    async def on_request(request: httpx.Request):
+        request.extensions["trace"] = trace
+
+    async def on_response(response: httpx.Response):
+        stat[0] += 1
+
+    return {"request": [on_request], "response": [on_response]}
+
+
+def _new_async_client(upstream: str) -> httpx.AsyncClient:
+    spec = UPSTREAMS[upstream]
+    limits = httpx.Limits(max_connections=spec.max_connections,
+                          max_keepalive_connections=spec.max_connections,
+                          keepalive_expiry=HTTP_KEEPALIVE_EXPIRY)
+    return httpx.AsyncClient(timeout=spec.timeout, limits=limits, http2=HTTP2_ENABLED and _H2_INSTALLED,
+                             event_hooks=_async_event_hooks(upstream))
+
+
+def get_async_client(upstream: str) -> httpx.AsyncClient:
+    """
+    获取上游的共享异步客户端 (不要 close / async with，由 lifespan 统一关闭)
+    未经 lifespan 启动时 (脚本、独立进程) 按需创建
+    """
+    client = _async_clients.get(upstream)
+    if client is None or client.is_closed:
+        client = _async_clients[upstream] = _new_async_client(upstream)
+    return client
+
+
+def get_session(upstream: str) -> requests.Session:
+    """获取上游的共享同步会话 (线程安全，供线程池中的同步调用使用)"""
+    session = _sessions.get(upstream)
+    if session is not None:
+        return session
+    with _sessions_lock:
+        session = _sessions.get(upstream)
+        if session is None:
+            spec = UPSTREAMS[upstream]
+            session = requests.Session()
+            session.mount(spec.base_url, HTTPAdapter(pool_connections=1, pool_maxsize=spec.max_connections))
+            session.hooks["response"].append(lambda resp, *args, **kwargs: _count_session_request(upstream))
+            _sessions[upstream] = session
+        return session
+
+
+def _count_session_request(upstream: str):
+    _stat(upstream, "sync")[0] += 1
+
+
+def _session_connections(session: requests.Session) -> int:
+    # urllib3 连接池自带新建连接计数
+    total = 0
+    for adapter in session.adapters.values():
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                total += pool.num_connections
+    return total
+
+
+async def _warmup(upstream: str):
+    spec = UPSTREAMS[upstream]
+    try:
+        await get_async_client(upstream).head(spec.base_url, timeout=httpx.Timeout(3.0))
+        LOGGER.info(f"[HTTP] 已预热连接: {upstream} ({spec.base_url})")
+    except httpx.HTTPError as e:
+        LOGGER.warning(f"[HTTP] 预热连接失败 (不影响启动): {upstream}, error={e!r}")
+
+
+def run_sync(coro: Awaitable[T]) -> T:
+    """
+    在线程池 (非事件循环线程) 中同步执行使用共享异步客户端的协程
+    服务运行时提交到 lifespan 的事件循环；没有常驻事件循环时 (脚本) 临时运行一个，结束后关闭期间创建的客户端
+    """
+    loop = _loop
+    if loop is not None and loop.is_running():
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            raise RuntimeError("run_sync 不能在事件循环线程中调用，请直接 await")
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+    return asyncio.run(_run_standalone(coro))
+
+
+async def _run_standalone(coro: Awaitable[T]) -> T:
+    try:
+        return await coro
+    finally:
+        await close()
+
+
+async def startup():
+    """创建各上游的共享客户端并预先建立连接 (lifespan 启动时调用)"""
+    global _loop
+    _loop = asyncio.get_running_loop()
+    if HTTP2_ENABLED and not _H2_INSTALLED:
+        LOGGER.warning("[HTTP] 未安装 h2，HTTP/2 未启用 (pip install 'httpx[http2]')")
+    for upstream in UPSTREAMS:
+        get_async_client(upstream)
+    if HTTP_WARMUP:
+        await asyncio.gather(*(_warmup(upstream) for upstream, spec in UPSTREAMS.items() if spec.warmup))
+
+
+async def close():
+    """关闭所有共享客户端 (lifespan 退出时调用)"""
+    global _loop
+    if _loop is asyncio.get_running_loop():
+        _loop = None
+    clients = list(_async_clients.values())
+    _async_clients.clear()
+    await asyncio.gather(*(client.aclose() for client in clients), return_exceptions=True)
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def pool_stats() -> dict:
+    """各上游连接复用统计，通过 GET /metrics 输出"""
+    for upstream, session in list(_sessions.items()):
+        _stat(upstream, "sync")[1] = _session_connections(session)
+    result = {}
+    for (upstream, kind), (total, opened) in _stats.items():
+        result.setdefault(upstream, {})[kind] = {
+            "requests": total,
+            "new_connections": opened,
+            "hits": max(total - opened, 0),
+            "misses": opened,
+        }
+    return result
@@ -1,15 +1,471 @@
-from config import REDIS_CLIENT
+import json
+import time
+from typing import Dict, List, Optional, Set, Tuple
 
-def set_cursor(cursor: str):
-    REDIS_CLIENT.set("cursor", cursor)
+from config import REDIS_CLIENT, ASYNC_REDIS_CLIENT, WEWORK_CORPID, SYNC_LEASE_TTL_MS, MSG_DEDUP_TTL, \
+    COZE_BOT_CONFIG_REDIS_KEY
 
-def get_cursor():
-    return REDIS_CLIENT.get("cursor")
 
+# cursor 按 企业ID + 客服账号 分开保存，未指定客服账号时沿用旧的全局 key
+def _cursor_key(open_kfid: str = None):
+    if not open_kfid:
+        return "cursor"
+    return f"wework:cursor:{WEWORK_CORPID}:{open_kfid}"
 
-def set_msg_retry(msgid: str, retry: int):
-    REDIS_CLIENT.set(f"msg_retry_{msgid}", retry)
+def set_cursor(cursor: str, open_kfid: str = None):
+    REDIS_CLIENT.set(_cursor_key(open_kfid), cursor)
 
-def get_msg_retry(msgid: str):
-    return REDIS_CLIENT.get(f"msg_retry_{msgid}")
+def get_cursor(open_kfid: str = None):
+    return REDIS_CLIENT.get(_cursor_key(open_kfid))
 
+
+# ================= 消息去重状态 =================
+# 每条消息一个 key，值为处理状态，过期时间覆盖企业微信的重新投递窗口，不再无限增长
+MSG_STATE_CLAIMED = "claimed"  # 已被某个 Worker 认领，尚未开始处理
+MSG_STATE_PROCESSING = "processing"  # 正在调用 Coze / 发送回复
+MSG_STATE_DONE = "done"  # 已回复完成
+
+
+def _msg_state_key(msgid: str):
+    return f"wework:msg_state:{msgid}"
+
+def claim_msg(msgid: str) -> bool:
+    """原子认领一条消息 (SET NX EX)，返回 True 表示是新消息"""
+    return bool(REDIS_CLIENT.set(_msg_state_key(msgid), MSG_STATE_CLAIMED, nx=True, ex=MSG_DEDUP_TTL))
+
+def set_msg_state(msgid: str, state: str):
+    REDIS_CLIENT.set(_msg_state_key(msgid), state, ex=MSG_DEDUP_TTL)
+
+def get_msg_state(msgid: str):
+    state = REDIS_CLIENT.get(_msg_state_key(msgid))
+    return state.decode('utf-8') if state else None
+
+
+# ================= 异步版 (供 Event Loop 内使用) =================
+async def async_set_cursor(cursor: str, open_kfid: str = None):
+    await ASYNC_REDIS_CLIENT.set(_cursor_key(open_kfid), cursor)
+
+async def async_get_cursor(open_kfid: str = None):
+    return await ASYNC_REDIS_CLIENT.get(_cursor_key(open_kfid))
+
+
+# 一次往返认领整页消息：逐条 SET NX EX，返回新认领成功的下标 (从 1 开始)
+_CLAIM_MSGS_SCRIPT = ASYNC_REDIS_CLIENT.register_script("""
+local claimed = {}
+for i, key in ipairs(KEYS) do
+    if redis.call('SET', key, ARGV[1], 'NX', 'EX', ARGV[2]) then
+        table.insert(claimed, i)
+    end
+end
+return claimed
+""")
+
+
+async def async_claim_msgs(msgids: List[str]) -> Set[str]:
+    """
+    原子认领一批消息 (一次 Redis 往返)，返回其中的新消息 msgid 集合
+    """
+    if not msgids:
+        return set()
+    indexes = await _CLAIM_MSGS_SCRIPT(keys=[_msg_state_key(m) for m in msgids], args=[MSG_STATE_CLAIMED, MSG_DEDUP_TTL])
+    return {msgids[i - 1] for i in indexes}
+
+async def async_set_msg_state(msgid: str, state: str):
+    await ASYNC_REDIS_CLIENT.set(_msg_state_key(msgid), state, ex=MSG_DEDUP_TTL)
+
+async def async_get_msg_state(msgid: str):
+    state = await ASYNC_REDIS_CLIENT.get(_msg_state_key(msgid))
+    return state.decode('utf-8') if state else None
+
+
+# 一次回复 (以批次最后一条 msgid 标识) 已发出的分段数：任务在发送中途崩溃被重新投递时，跳过已发出的分段
+def _reply_progress_key(msgid: str):
+    return f"wework:reply_progress:{msgid}"
+
+async def async_get_reply_progress(msgid: str) -> int:
+    sent = await ASYNC_REDIS_CLIENT.get(_reply_progress_key(msgid))
+    return int(sent) if sent else 0
+
+async def async_set_reply_progress(msgid: str, sent: int):
+    await ASYNC_REDIS_CLIENT.set(_reply_progress_key(msgid), sent, ex=MSG_DEDUP_TTL)
+
+
+# ================= 聚合中的消息 (崩溃恢复) =================
+# 进入聚合窗口的消息在交给回复任务之前一直记录在这个 Hash 里 (msgid -> 消息 + 记录时间)，认领不算结束；
+# 所在进程崩溃后，超时的条目由其他 Worker 回收重新提交
+def _aggregating_key():
+    return f"wework:aggregating:{WEWORK_CORPID}"
+
+# 条目内容未变时才改写 (重新计时)，多个 Worker 同时回收同一条消息时只有一个成功
+_RESTAMP_AGGREGATING_SCRIPT = ASYNC_REDIS_CLIENT.register_script("""
+if redis.call('HGET', KEYS[1], ARGV[1]) == ARGV[2] then
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[3])
+    return 1
+end
+return 0
+""")
+
+
+def _aggregating_entry(msg: dict) -> str:
+    return json.dumps({"msg": msg, "held_at": time.time()}, ensure_ascii=False)
+
+async def async_hold_aggregating(msgid: str, msg: dict):
+    await ASYNC_REDIS_CLIENT.hset(_aggregating_key(), msgid, _aggregating_entry(msg))
+
+async def async_release_aggregating(msgids: List[str]):
+    if msgids:
+        await ASYNC_REDIS_CLIENT.hdel(_aggregating_key(), *msgids)
+
+async def async_take_stale_aggregating(older_than_s: float) -> List[dict]:
+    """
+    回收记录超过 older_than_s 秒仍未交出的消息，返回消息内容
+    回收时只重新计时、不删除：重新提交成功后由调用方 release，中途再次崩溃还能被下一轮回收
+    """
+    entries = await ASYNC_REDIS_CLIENT.hgetall(_aggregating_key())
+    now = time.time()
+    taken = []
+    for msgid, raw in entries.items():
+        entry = json.loads(raw)
+        if now - entry["held_at"] < older_than_s:
+            continue
+        if await _RESTAMP_AGGREGATING_SCRIPT(keys=[_aggregating_key()], args=[msgid, raw, _aggregating_entry(entry["msg"])]):
+            taken.append(entry["msg"])
+    return taken
+
+
+# ================= sync_msg 单飞租约 (跨 Worker) =================
+# 同一客服账号同一时刻只允许一个 Worker 拉取；拉取期间到达的回调只写入“待重新同步”标记 (值为最新 Token)
+def _sync_lease_key(open_kfid: str):
+    return f"wework:sync_lease:{WEWORK_CORPID}:{open_kfid}"
+
+def _resync_key(open_kfid: str):
+    return f"wework:sync_pending:{WEWORK_CORPID}:{open_kfid}"
+
+
+# 仅当租约仍属于自己时才续期/释放，防止误删其他 Worker 的租约
+_RENEW_LEASE_SCRIPT = ASYNC_REDIS_CLIENT.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+""")
+
+_RELEASE_LEASE_SCRIPT = ASYNC_REDIS_CLIENT.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+
+async def async_acquire_sync_lease(open_kfid: str, owner: str, ttl_ms: int = SYNC_LEASE_TTL_MS) -> bool:
+    return bool(await ASYNC_REDIS_CLIENT.set(_sync_lease_key(open_kfid), owner, nx=True, px=ttl_ms))
+
+async def async_renew_sync_lease(open_kfid: str, owner: str, ttl_ms: int = SYNC_LEASE_TTL_MS) -> bool:
+    return bool(await _RENEW_LEASE_SCRIPT(keys=[_sync_lease_key(open_kfid)], args=[owner, ttl_ms]))
+
+async def async_release_sync_lease(open_kfid: str, owner: str) -> bool:
+    return bool(await _RELEASE_LEASE_SCRIPT(keys=[_sync_lease_key(open_kfid)], args=[owner]))
+
+
+async def async_mark_resync(open_kfid: str, token: str):
+    # Token 有效期 10 分钟，标记随之过期
+    await ASYNC_REDIS_CLIENT.set(_resync_key(open_kfid), token, ex=600)
+
+async def async_restore_resync(open_kfid: str, token: str):
+    # 拉取失败时放回取出的标记；期间有新回调写入的 Token 时保留新的
+    await ASYNC_REDIS_CLIENT.set(_resync_key(open_kfid), token, ex=600, nx=True)
+
+async def async_has_resync(open_kfid: str) -> bool:
+    return bool(await ASYNC_REDIS_CLIENT.exists(_resync_key(open_kfid)))
+
+async def async_pop_resync(open_kfid: str):
+    token = await ASYNC_REDIS_CLIENT.getdel(_resync_key(open_kfid))
+    return token.decode('utf-8') if token else None
+
+
+# ================= access_token 缓存 (跨 Worker 共享) =================
+# 与同步版 wework._cachable_token 共用同一个 key；刷新时先抢租约，同一时刻全集群只有一个刷新者
+ACCESS_TOKEN_KEY = "wework:access_token"
+
+def _token_lease_key():
+    return f"wework:access_token_lease:{WEWORK_CORPID}"
+
+
+async def async_get_access_token():
+    """返回 (token, 剩余有效毫秒数)，不存在时为 (None, 0)"""
+    async with ASYNC_REDIS_CLIENT.pipeline(transaction=False) as pipe:
+        token, pttl = await pipe.get(ACCESS_TOKEN_KEY).pttl(ACCESS_TOKEN_KEY).execute()
+    if not token or pttl <= 0:
+        return None, 0
+    return token.decode('utf-8'), pttl
+
+async def async_set_access_token(token: str, ttl_ms: int):
+    await ASYNC_REDIS_CLIENT.set(ACCESS_TOKEN_KEY, token, px=ttl_ms)
+
+async def async_invalidate_access_token(token: str) -> bool:
+    # 仅当缓存的仍是这个失效 token 时才删除，避免删掉其他 Worker 刚刷新的新 token
+    return bool(await _RELEASE_LEASE_SCRIPT(keys=[ACCESS_TOKEN_KEY], args=[token]))
+
+async def async_acquire_token_lease(owner: str, ttl_ms: int) -> bool:
+    return bool(await ASYNC_REDIS_CLIENT.set(_token_lease_key(), owner, nx=True, px=ttl_ms))
+
+async def async_release_token_lease(owner: str) -> bool:
+    return bool(await _RELEASE_LEASE_SCRIPT(keys=[_token_lease_key()], args=[owner]))
+
+async def async_token_lease_held() -> bool:
+    return bool(await ASYNC_REDIS_CLIENT.exists(_token_lease_key()))
+
+
+# ================= kf/send_msg 令牌桶 (跨 Worker 共享) =================
+# 按企业、按客服账号各一个桶，两个桶都有令牌时才同时扣减；否则返回需要等待的毫秒数
+_TAKE_SEND_PERMIT_SCRIPT = ASYNC_REDIS_CLIENT.register_script("""
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local wait, tokens = 0, {}
+for i, key in ipairs(KEYS) do
+    local rate, cap = tonumber(ARGV[2 * i - 1]), tonumber(ARGV[2 * i])
+    local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+    local n = tonumber(bucket[1]) or cap
+    local ts = tonumber(bucket[2]) or now
+    n = math.min(cap, n + math.max(now - ts, 0) * rate / 1000)
+    tokens[i] = n
+    if n < 1 then
+        wait = math.max(wait, math.ceil((1 - n) * 1000 / rate))
+    end
+end
+for i, key in ipairs(KEYS) do
+    local rate, cap = tonumber(ARGV[2 * i - 1]), tonumber(ARGV[2 * i])
+    local n = tokens[i]
+    if wait == 0 then
+        n = n - 1
+    end
+    redis.call('HSET', key, 'tokens', tostring(n), 'ts', now)
+    redis.call('PEXPIRE', key, math.ceil(cap * 1000 / rate) + 1000)
+end
+return wait
+""")
+
+
+async def async_take_send_permit(open_kfid: str, corp_rate: float, corp_burst: int,
+                                 kfid_rate: float, kfid_burst: int) -> int:
+    """尝试取得一次发送许可，返回 0 表示可以立即发送，否则为建议等待的毫秒数"""
+    keys = [f"wework:send_bucket:{WEWORK_CORPID}", f"wework:send_bucket:{WEWORK_CORPID}:{open_kfid}"]
+    return int(await _TAKE_SEND_PERMIT_SCRIPT(keys=keys, args=[corp_rate, corp_burst, kfid_rate, kfid_burst]))
+
+
+# ================= Coze 会话预热池 (跨 Worker 共享) =================
+# 每个机器人配置一个 List，存放已在 Coze 创建、尚未分配给用户的会话 ID
+def _conv_pool_key(bot_key: str):
+    return f"coze:conv_pool:{bot_key}"
+
+def _conv_pool_refill_key(bot_key: str):
+    return f"coze:conv_pool_refill:{bot_key}"
+
+def pop_pooled_conversation(bot_key: str):
+    """取出一个预先创建的会话，返回 (会话ID 或 None, 池中剩余数量)"""
+    key = _conv_pool_key(bot_key)
+    with REDIS_CLIENT.pipeline(transaction=True) as pipe:
+        conversation_id, left = pipe.lpop(key).llen(key).execute()
+    return (conversation_id.decode('utf-8') if conversation_id else None), left
+
+def push_pooled_conversation(bot_key: str, conversation_id: str) -> int:
+    return REDIS_CLIENT.rpush(_conv_pool_key(bot_key), conversation_id)
+
+
+async def async_pooled_conversation_count(bot_key: str) -> int:
+    return await ASYNC_REDIS_CLIENT.llen(_conv_pool_key(bot_key))
+
+async def async_push_pooled_conversation(bot_key: str, conversation_id: str) -> int:
+    return await ASYNC_REDIS_CLIENT.rpush(_conv_pool_key(bot_key), conversation_id)
+
+async def async_acquire_conv_pool_refill_lease(bot_key: str, owner: str, ttl_ms: int) -> bool:
+    return bool(await ASYNC_REDIS_CLIENT.set(_conv_pool_refill_key(bot_key), owner, nx=True, px=ttl_ms))
+
+async def async_release_conv_pool_refill_lease(bot_key: str, owner: str) -> bool:
+    return bool(await _RELEASE_LEASE_SCRIPT(keys=[_conv_pool_refill_key(bot_key)], args=[owner]))
+
+
+# ================= 用户最新会话 ID 缓存 (跨 Worker 共享) =================
+# 与用户 ID 映射 (map:ext_uid:*) 同一命名空间，按 内部用户ID + 客服账号 保存
+def _latest_conv_key(user_id: str, open_kfid: str = None):
+    return f"map:latest_conv:{user_id}:{open_kfid or 'default'}"
+
+
+# 仅当缓存的仍是失效的那个会话时才删除，避免删掉其他 Worker 刚写入的新会话
+_DEL_IF_EQUAL_SCRIPT = REDIS_CLIENT.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+
+def get_latest_conversation(user_id: str, open_kfid: str = None):
+    conversation_id = REDIS_CLIENT.get(_latest_conv_key(user_id, open_kfid))
+    return conversation_id.decode('utf-8') if conversation_id else None
+
+def set_latest_conversation(user_id: str, open_kfid: str, conversation_id: str, ttl: int):
+    REDIS_CLIENT.set(_latest_conv_key(user_id, open_kfid), conversation_id, ex=ttl)
+
+def invalidate_latest_conversation(user_id: str, open_kfid: str, conversation_id: str) -> bool:
+    return bool(_DEL_IF_EQUAL_SCRIPT(keys=[_latest_conv_key(user_id, open_kfid)], args=[conversation_id]))
+
+
+# ================= 会话创建单飞锁 (带 fencing token) =================
+# 同一用户 + 客服账号同一时刻只允许一个创建者；每次加锁分配递增的 fencing token，
+# 写入结果时校验 token 仍是最新的，锁过期后被其他 Worker 接手的旧持有者无法覆盖新结果
+def _conv_create_lock_key(user_id: str, open_kfid: str = None):
+    return f"coze:conv_create_lock:{user_id}:{open_kfid or 'default'}"
+
+def _conv_create_fence_key(user_id: str, open_kfid: str = None):
+    return f"coze:conv_create_fence:{user_id}:{open_kfid or 'default'}"
+
+
+# 加锁成功返回新的 fencing token，失败返回 0
+_ACQUIRE_FENCED_LOCK_SCRIPT = REDIS_CLIENT.register_script("""
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    local fence = redis.call('INCR', KEYS[2])
+    redis.call('EXPIRE', KEYS[2], 86400)
+    return fence
+end
+return 0
+""")
+
+# fencing token 仍是最新时才写入最新会话
+_COMMIT_IF_FENCE_SCRIPT = REDIS_CLIENT.register_script("""
+if tonumber(redis.call('GET', KEYS[1]) or '0') == tonumber(ARGV[1]) then
+    redis.call('SET', KEYS[2], ARGV[2], 'EX', ARGV[3])
+    return 1
+end
+return 0
+""")
+
+
+def acquire_conv_create_lock(user_id: str, open_kfid: str, owner: str, ttl_ms: int) -> int:
+    keys = [_conv_create_lock_key(user_id, open_kfid), _conv_create_fence_key(user_id, open_kfid)]
+    return int(_ACQUIRE_FENCED_LOCK_SCRIPT(keys=keys, args=[owner, ttl_ms]))
+
+def release_conv_create_lock(user_id: str, open_kfid: str, owner: str) -> bool:
+    return bool(_DEL_IF_EQUAL_SCRIPT(keys=[_conv_create_lock_key(user_id, open_kfid)], args=[owner]))
+
+def conv_create_lock_held(user_id: str, open_kfid: str) -> bool:
+    return bool(REDIS_CLIENT.exists(_conv_create_lock_key(user_id, open_kfid)))
+
+def commit_latest_conversation(user_id: str, open_kfid: str, fence: int, conversation_id: str, ttl: int) -> bool:
+    keys = [_conv_create_fence_key(user_id, open_kfid), _latest_conv_key(user_id, open_kfid)]
+    return bool(_COMMIT_IF_FENCE_SCRIPT(keys=keys, args=[fence, conversation_id, ttl]))
+
+
+
+# ================= FAQ 回复缓存 (跨 Worker 共享) =================
+# 每个工作流一个 ZSET 记录各条目的最近访问时间 (毫秒)，超过条数上限时淘汰最久未访问的条目；
+# key 带 {workflow_id} hash tag，同一工作流的条目与 ZSET 落在同一个槽
+def _reply_cache_key(workflow_id: str, digest: str):
+    return f"coze:reply_cache:{{{workflow_id}}}:{digest}"
+
+def _reply_cache_lru_key(workflow_id: str):
+    return f"coze:reply_cache_lru:{{{workflow_id}}}"
+
+
+# 命中时刷新访问时间；条目已过期则顺手移出 ZSET
+_GET_REPLY_CACHE_SCRIPT = ASYNC_REDIS_CLIENT.register_script("""
+local reply = redis.call('GET', KEYS[1])
+if reply then
+    redis.call('ZADD', KEYS[2], ARGV[1], KEYS[1])
+else
+    redis.call('ZREM', KEYS[2], KEYS[1])
+end
+return reply
+""")
+
+# 写入后清理已过期的成员 (最近访问早于 TTL 的条目必然已过期)，再按条数上限淘汰最久未访问的条目，返回淘汰数
+_PUT_REPLY_CACHE_SCRIPT = ASYNC_REDIS_CLIENT.register_script("""
+local now, ttl, max_entries = tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ttl)
+redis.call('ZADD', KEYS[2], now, KEYS[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now - ttl * 1000)
+redis.call('EXPIRE', KEYS[2], ttl)
+local over = redis.call('ZCARD', KEYS[2]) - max_entries
+if over <= 0 then
+    return 0
+end
+local victims = redis.call('ZRANGE', KEYS[2], 0, over - 1)
+redis.call('ZREMRANGEBYRANK', KEYS[2], 0, over - 1)
+redis.call('DEL', unpack(victims))
+return over
+""")
+
+
+async def async_get_cached_reply(workflow_id: str, digest: str, now_ms: int):
+    keys = [_reply_cache_key(workflow_id, digest), _reply_cache_lru_key(workflow_id)]
+    reply = await _GET_REPLY_CACHE_SCRIPT(keys=keys, args=[now_ms])
+    return reply.decode('utf-8') if reply else None
+
+async def async_put_cached_reply(workflow_id: str, digest: str, reply: str, now_ms: int, ttl: int,
+                                 max_entries: int) -> int:
+    """写入一条缓存回复，返回因超过条数上限被淘汰的条目数"""
+    keys = [_reply_cache_key(workflow_id, digest), _reply_cache_lru_key(workflow_id)]
+    return int(await _PUT_REPLY_CACHE_SCRIPT(keys=keys, args=[reply, now_ms, ttl, max_entries]))
+
+
+# ================= Coze 并发舱壁 (跨 Worker 共享) =================
+# 每个机器人配置一个 ZSET，成员为持有者，分数为租约到期时间 (毫秒)；Worker 崩溃时未释放的名额在到期后自动回收
+def _bulkhead_key(bot_key: str):
+    return f"coze:bulkhead:{bot_key}"
+
+
+_ACQUIRE_BULKHEAD_SCRIPT = ASYNC_REDIS_CLIENT.register_script("""
+local now, lease_ms, limit = tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if redis.call('ZCARD', KEYS[1]) < limit then
+    redis.call('ZADD', KEYS[1], now + lease_ms, ARGV[1])
+    redis.call('PEXPIRE', KEYS[1], lease_ms)
+    return 1
+end
+return 0
+""")
+
+
+async def async_acquire_bulkhead_slot(bot_key: str, owner: str, now_ms: int, lease_ms: int, limit: int) -> bool:
+    return bool(await _ACQUIRE_BULKHEAD_SCRIPT(keys=[_bulkhead_key(bot_key)], args=[owner, now_ms, lease_ms, limit]))
+
+async def async_release_bulkhead_slot(bot_key: str, owner: str):
+    await ASYNC_REDIS_CLIENT.zrem(_bulkhead_key(bot_key), owner)
+
+
+# ================= 机器人配置 (COZE_BOT_CONFIG_SOURCE=redis) =================
+# HASH 的 field 为机器人配置 key (OpenKfId / default)，value 为 JSON；版本号单独一个 key，每次发布 INCR
+def _bot_config_version_key():
+    return f"{COZE_BOT_CONFIG_REDIS_KEY}:version"
+
+def publish_bot_configs(configs: Dict[str, str]) -> int:
+    """整体替换机器人配置 (value 为 JSON 字符串) 并递增版本号，返回新版本号"""
+    pipe = REDIS_CLIENT.pipeline(transaction=True)
+    pipe.delete(COZE_BOT_CONFIG_REDIS_KEY)
+    pipe.hset(COZE_BOT_CONFIG_REDIS_KEY, mapping=configs)
+    pipe.incr(_bot_config_version_key())
+    return int(pipe.execute()[-1])
+
+def get_bot_configs() -> Tuple[Optional[str], Dict[str, str]]:
+    """返回 (版本号, {key: JSON})，同一事务中读取，版本号与内容一致"""
+    pipe = REDIS_CLIENT.pipeline(transaction=True)
+    pipe.get(_bot_config_version_key())
+    pipe.hgetall(COZE_BOT_CONFIG_REDIS_KEY)
+    version, configs = pipe.execute()
+    return _decode_bot_configs(version, configs)
+
+async def async_get_bot_config_version() -> Optional[str]:
+    version = await ASYNC_REDIS_CLIENT.get(_bot_config_version_key())
+    return version.decode('utf-8') if version else None
+
+async def async_get_bot_configs() -> Tuple[Optional[str], Dict[str, str]]:
+    async with ASYNC_REDIS_CLIENT.pipeline(transaction=True) as pipe:
+        pipe.get(_bot_config_version_key())
+        pipe.hgetall(COZE_BOT_CONFIG_REDIS_KEY)
+        version, configs = await pipe.execute()
+    return _decode_bot_configs(version, configs)
+
+def _decode_bot_configs(version, configs) -> Tuple[Optional[str], Dict[str, str]]:
+    return (version.decode('utf-8') if version else None,
+            {k.decode('utf-8'): v.decode('utf-8') for k, v in configs.items()})
@@ -0,0 +1,88 @@
+import asyncio
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, Tuple
+
+import metrics
+from config import LOGGER
+
+'''
+按会话 (用户 + 客服账号) 划分的有序执行通道
+
+同一通道内的任务严格按提交顺序逐个执行，避免同一用户的两条消息并发调用 Coze、
+回复乱序或重复创建会话；不同通道之间并行执行，总并发受全局上限约束。
+'''
+
+CoroFactory = Callable[[], Awaitable[Any]]
+
+
+class LaneScheduler:
+    def __init__(self, max_concurrency: int, name: str = "lanes"):
+        self.name = name
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        # key -> 待执行队列 (协程工厂, 入队时间, 结果 Future)
+        self._lanes: Dict[Hashable, Deque[Tuple[CoroFactory, float, asyncio.Future]]] = {}
+        self._runners: Dict[Hashable, asyncio.Task] = {}
+
+    def submit(self, key: Hashable, factory: CoroFactory) -> asyncio.Future:
+        """
+        提交任务到 key 对应的通道 (非阻塞)，返回可 await 的结果 Future
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        lane = self._lanes.setdefault(key, deque())
+        lane.append((factory, loop.time(), future))
+        if key not in self._runners:
+            self._runners[key] = asyncio.create_task(self._run_lane(key))
+        self._update_gauges()
+        return future
+
+    async def run(self, key: Hashable, factory: CoroFactory) -> Any:
+        """提交并等待执行完成"""
+        return await self.submit(key, factory)
+
+    async def _run_lane(self, key: Hashable):
+        lane = self._lanes[key]
+        loop = asyncio.get_running_loop()
+        try:
+            while lane:
+                factory, enqueued_at, future = lane.popleft()
+                self._update_gauges()
+                async with self._semaphore:
+                    metrics.observe(f"{self.name}_wait_seconds", loop.time() - enqueued_at)
+                    try:
+                        result = await factory()
+                    except asyncio.CancelledError:
+                        future.cancel()
+                        raise
+                    except Exception as e:
+                        LOGGER.error(f"[{self.name}] 通道任务异常: key={key}, error={e}")
+                        if not future.cancelled():
+                            future.set_exception(e)
+                        continue
+                    if not future.cancelled():
+                        future.set_result(result)
+        finally:
+            # 通道清空后释放，避免长尾用户占用内存
+            for _, _, future in lane:
+                future.cancel()
+            self._lanes.pop(key, None)
+            self._runners.pop(key, None)
+            self._update_gauges()
+
+    def _update_gauges(self):
+        depths = [len(lane) for lane in self._lanes.values()]
+        metrics.set_gauge(f"{self.name}_active", len(self._lanes))
+        metrics.set_gauge(f"{self.name}_queued", sum(depths))
+        metrics.set_gauge(f"{self.name}_max_depth", max(depths, default=0))
+
+    def depth(self, key: Hashable) -> int:
+        """某个通道当前排队中的任务数"""
+        lane = self._lanes.get(key)
+        return len(lane) if lane else 0
+
+    async def close(self):
+        """取消所有通道 (进程退出时调用)"""
+        runners = list(self._runners.values())
+        for task in runners:
+            task.cancel()
+        await asyncio.gather(*runners, return_exceptions=True)
@@ -0,0 +1,113 @@
+import asyncio
+import time
+from typing import List, Optional, Sequence, Tuple
+
+import httpx
+
+import metrics
+from config import LOGGER, LLM_FALLBACK_ENABLED, LLM_FALLBACK_BASE_URL, LLM_FALLBACK_MODEL, LLM_FALLBACK_API_KEY, \
+    LLM_FALLBACK_SYSTEM_PROMPT, LLM_FALLBACK_TIMEOUT_S, LLM_FALLBACK_HISTORY_TURNS, LLM_FALLBACK_HISTORY_MAX_CHARS
+from http_clients import get_async_client, UPSTREAM_LLM
+
+'''
+Coze 降级：OpenAI 兼容模型
+
+Coze 熔断打开、超过时间预算或舱壁已满时，与其回复“请稍后再试”，不如让一个 OpenAI 兼容的大模型直接回答：
+- 按机器人配置 (COZE_BOT_CONFIGS 中的 llm_fallback，默认使用 LLM_FALLBACK_* 环境变量) 构建一次，请求头预先拼好
+- 带上该会话最近 LLM_FALLBACK_HISTORY_TURNS 轮问答 (总字数不超过 LLM_FALLBACK_HISTORY_MAX_CHARS) 作为上下文
+- 调用方为它预留 LLM_FALLBACK_TIMEOUT_S 秒：Coze 的截止时间相应提前，降级后仍在用户的回复截止时间内完成
+- 走共享的大模型连接池 (http_clients)，不经过 SDK 的自动重试；失败或超时返回 None，由调用方回复兜底文案
+回复写入 message_record 时 reply_backend 记为 llm:<model>。
+'''
+
+_MIN_BUDGET_S = 1.0
+
+
+class LLMFallback:
+    def __init__(self, bot_key: str, base_url: str = LLM_FALLBACK_BASE_URL, model: str = LLM_FALLBACK_MODEL,
+                 api_key: str = LLM_FALLBACK_API_KEY, system_prompt: str = LLM_FALLBACK_SYSTEM_PROMPT,
+                 history_turns: int = LLM_FALLBACK_HISTORY_TURNS, timeout_s: float = LLM_FALLBACK_TIMEOUT_S):
+        self.bot_key = bot_key
+        self.url = f"{base_url.rstrip('/')}/chat/completions"
+        self.model = model
+        self.headers = {'Authorization': f"Bearer {api_key}", 'Content-Type': 'application/json'}
+        self.system_prompt = system_prompt
+        self.history_turns = history_turns
+        self.timeout_s = timeout_s
+        # 写入 message_record.reply_backend
+        self.backend = f"llm:{model}"[:32]
+
+    @classmethod
+    def from_config(cls, bot_key: str, config: Optional[dict]) -> Optional["LLMFallback"]:
+        """机器人配置中的 llm_fallback (缺省项使用环境变量)，未开启或缺少 base_url / API Key 时返回 None"""
+        config = config or {}
+        if not config.get("enabled", LLM_FALLBACK_ENABLED):
+            return None
+        api_key = config.get("api_key") or LLM_FALLBACK_API_KEY
+        if not api_key:
+            LOGGER.error(f"❌ 配置错误: [{bot_key}] 开启了 llm_fallback 但缺少 api_key (LLM_FALLBACK_API_KEY)，已关闭降级")
+            return None
+        base_url = config.get("base_url") or LLM_FALLBACK_BASE_URL
+        if not base_url:
+            LOGGER.error(f"❌ 配置错误: [{bot_key}] 开启了 llm_fallback 但缺少 base_url (LLM_FALLBACK_BASE_URL)，已关闭降级")
+            return None
+        return cls(bot_key,
+                   base_url,
+                   config.get("model") or LLM_FALLBACK_MODEL,
+                   api_key,
+                   config.get("system_prompt") or LLM_FALLBACK_SYSTEM_PROMPT,
+                   int(config.get("history_turns", LLM_FALLBACK_HISTORY_TURNS)),
+                   float(config.get("timeout_s", LLM_FALLBACK_TIMEOUT_S)))
+
+    def build_messages(self, question: str, history: Sequence[Tuple[str, str]] = ()) -> List[dict]:
+        """
+        history: 最近的 (用户问题, 机器人回复)，按时间正序
+        只保留最近 history_turns 轮，且总字数不超过 LLM_FALLBACK_HISTORY_MAX_CHARS (从最早的一轮开始丢弃)
+        """
+        recent = list(history)[-self.history_turns:] if self.history_turns > 0 else []
+        turns, budget = [], LLM_FALLBACK_HISTORY_MAX_CHARS
+        for user_question, bot_reply in reversed(recent):
+            user_question, bot_reply = user_question or "", bot_reply or ""
+            budget -= len(user_question) + len(bot_reply)
+            if budget < 0:
+                break
+            turns.append((user_question, bot_reply))
+        messages = [{"role": "system", "content": self.system_prompt}]
+        for user_question, bot_reply in reversed(turns):
+            messages += [{"role": "user", "content": user_question}, {"role": "assistant", "content": bot_reply}]
+        messages.append({"role": "user", "content": question})
+        return messages
+
+    async def reply(self, question: str, history: Sequence[Tuple[str, str]] = (), deadline: float = None) -> Optional[str]:
+        """
+        调用 /chat/completions，返回回复文本；失败、超时或剩余时间不足时返回 None
+        deadline: 截止时间 (time.time() 时间戳)，实际等待不超过 timeout_s
+        """
+        budget = self.timeout_s if deadline is None else min(self.timeout_s, deadline - time.time())
+        if budget < _MIN_BUDGET_S:
+            metrics.incr("llm_fallback_total", bot=self.bot_key, result="no_budget")
+            return None
+        body = {"model": self.model, "messages": self.build_messages(question, history)}
+        start = time.perf_counter()
+        try:
+            resp = await asyncio.wait_for(get_async_client(UPSTREAM_LLM).post(self.url, headers=self.headers, json=body),
+                                          budget)
+            data = resp.json() if resp.status_code == 200 else None
+            text = (data["choices"][0]["message"]["content"] or "").strip() if data else ""
+        except asyncio.TimeoutError:
+            LOGGER.warning(f"[降级] {self.bot_key} 大模型超过截止时间")
+            metrics.incr("llm_fallback_total", bot=self.bot_key, result="timeout")
+            return None
+        except (httpx.HTTPError, ValueError, KeyError, IndexError, TypeError, AttributeError) as e:
+            LOGGER.warning(f"[降级] {self.bot_key} 大模型调用异常: {e!r}")
+            metrics.incr("llm_fallback_total", bot=self.bot_key, result="error")
+            return None
+        finally:
+            metrics.observe("llm_fallback_seconds", time.perf_counter() - start, bot=self.bot_key)
+        if not text:
+            LOGGER.warning(f"[降级] {self.bot_key} 大模型未返回回复: status={resp.status_code}, body={resp.text[:200]}")
+            metrics.incr("llm_fallback_total", bot=self.bot_key, result="error")
+            return None
+        metrics.incr("llm_fallback_total", bot=self.bot_key, result="ok")
+        return text
+
@@ -1,29 +1,82 @@
 from concurrent.futures import ThreadPoolExecutor
 import time
 import json
-from fastapi import Depends, FastAPI, Request, HTTPException
+from fastapi import FastAPI, Request, HTTPException
 from fastapi import BackgroundTasks  # 引入后台任务
-from fastapi.responses import JSONResponse, PlainTextResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse
 from starlette.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import Optional, List, Generator
-from ai import ai_reply, ai_reply_coze, async_ai_reply_coze
-from config import LOGGER, WEWORK_CORPID, WEWORK_ENCODING_AES_KEY, WEWORK_TOKEN
-from kv import get_cursor, get_msg_retry, set_msg_retry
-from schema import WeChatMessage, WeChatTokenMessage, WechatMsgEntity, WechatMsgSendEntity
-from util.wx_biz_json_msg_crypt import WXBizJsonMsgCrypt
-from wework import check_signature, parse_wechat_message, select_msgs, send_text_msg, download_wechat_image, \
+from typing import Optional, List, Generator, Union
+from ai import ai_reply_coze, async_ai_reply_coze
+from config import LOGGER, WECHAT_INGRESS_MODE, \
+    SYNC_MAX_MSG_AGE, WORK_QUEUE_MODE, WORK_QUEUE_CONSUMERS, AGGREGATE_QUIET_MS, AGGREGATE_MAX_WAIT_MS, \
+    AGGREGATE_MAX_MSGS, AGGREGATE_RECOVER_AFTER_MS, LANE_MAX_CONCURRENCY, WECHAT_MAX_BODY_BYTES, COZE_PROGRESSIVE_REPLY, COZE_REPLY_DEADLINE_S
+from kv import get_cursor, claim_msg, get_msg_state, set_msg_state, async_get_msg_state, async_set_msg_state, \
+    async_hold_aggregating, async_release_aggregating, \
+    async_take_stale_aggregating, MSG_STATE_PROCESSING, MSG_STATE_DONE
+from schema import WechatMsgEntity, WechatMsgSendEntity
+from wework import check_signature, get_wework_crypto, select_msgs, send_text_msg, download_wechat_image, \
     _cachable_token, handle_image_msg
-from wework import async_send_text_msg, async_handle_image
+from wework import async_handle_image, ReplySender
 from call_coze_api import get_or_create_latest_conversation, call_coze_workflow, get_or_create_internal_user, \
     async_call_coze_workflow
+from util.wx_envelope import decode_callback
+from sync_pipeline import enqueue_sync, start_sync_workers, stop_sync_workers, wait_background_tasks
+import work_queue
+from aggregator import MessageAggregator
+from lanes import LaneScheduler
+from contextlib import asynccontextmanager
+import metrics
+import http_clients
+from token_manager import access_tokens
+import send_dispatcher
+import conversation_pool
+import bot_registry
 import asyncio
 
 # thread_pool = ThreadPoolExecutor(max_workers=5)  # 创建一个线程池，最大工作线程数为5
 
-app = FastAPI(title="Wxwork Coze Chat API", version="1.0")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 启动：创建并预热企业微信 / Coze 共享连接池
+    await http_clients.startup()
+    # 启动：access_token 后台提前刷新
+    access_tokens.start()
+    send_dispatcher.start_senders()
+    # 启动：加载机器人配置 (file / redis 来源时后台检查热更新)
+    bot_registry.start()
+    # 启动：Coze 会话预热池后台补充
+    conversation_pool.start()
+    # 启动：后台消息同步管道 (回调入口只投递 Token，由管道异步拉取 sync_msg)
+    await start_sync_workers(async_process_msg)
+    # 启动：回收其他进程崩溃时留在聚合窗口里的消息
+    if AGGREGATE_QUIET_MS > 0:
+        _recovery_tasks.append(asyncio.create_task(_recover_aggregating_loop()))
+    # redis 队列模式下，API Worker 同时作为消费者 (也可以设为 0，只由独立 worker.py 消费)
+    if WORK_QUEUE_MODE == "redis" and WORK_QUEUE_CONSUMERS > 0:
+        await work_queue.start_consumers(WORK_QUEUE_CONSUMERS)
+    yield
+    # 关闭：停止拉取协程，提交尚在聚合窗口内的消息，停止消费 (未 ACK 的任务会被其他消费者回收)，等待已分发的回复任务结束
+    await stop_sync_workers()
+    for task in _recovery_tasks:
+        task.cancel()
+    await asyncio.gather(*_recovery_tasks, return_exceptions=True)
+    _recovery_tasks.clear()
+    await text_aggregator.flush_all()
+    await work_queue.stop_consumers()
+    await wait_background_tasks()
+    await reply_lanes.close()
+    await send_dispatcher.stop_senders()
+    await conversation_pool.stop()
+    await bot_registry.stop()
+    await access_tokens.stop()
+    await http_clients.close()
+
+
+app = FastAPI(title="Wxwork Coze Chat API", version="1.0", lifespan=lifespan)
 # 允许 WebUI 来源
 app.add_middleware(
     CORSMiddleware,
@@ -46,6 +99,13 @@ async def ping():
     return {"message": "pong"}
 
 
+@app.get("/metrics")
+async def get_metrics():
+    snapshot = metrics.snapshot()
+    snapshot["http_pools"] = http_clients.pool_stats()
+    return snapshot
+
+
 '''
 open-webui的相关API配置
 '''
@@ -88,6 +148,8 @@ async def openai_chat(req: dict):
         return {"error": "No messages provided"}
 
     user_message = messages[-1]["content"]
+    stream = bool(req.get("stream"))
+    model = req.get("model", "wxwork-coze-chat")
 
     # ⚠️ 关于 User ID 的建议：
     # WebUI 通常在 header 里不传真实用户ID。
@@ -98,6 +160,8 @@ async def openai_chat(req: dict):
 
     # 2. 处理特殊指令 (WebUI 的建议后续问题逻辑)
     if user_message.startswith("### Task:"):
+        if stream:
+            return _openai_text_stream(model, json.dumps({"follow_ups": []}))
         return {
             "id": f"follow-up-task-{int(time.time())}",
             "object": "chat.completion",
@@ -125,11 +189,23 @@ async def openai_chat(req: dict):
         )
     except Exception as e:
         LOGGER.error(f"[WebUI] 获取会话失败: {e}")
+        if stream:
+            return _openai_text_stream(model, "Error: Database Error")
         return create_openai_error_response("Database Error")
 
     if not conversation_id:
+        if stream:
+            return _openai_text_stream(model, "Error: Failed to create conversation")
         return create_openai_error_response("Failed to create conversation")
 
+    if stream:
+        # ✅ 流式：Coze 的每个增量直接转成 chat.completion.chunk 推给 WebUI
+        return StreamingResponse(
+            _openai_coze_stream(model, user_id, conversation_id, user_message, DEFAULT_WEBUI_KFID),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
     # =================================================================
     # 4. ✅ 异步优化：调用 Coze (使用之前写好的异步函数)
     # =================================================================
@@ -170,6 +246,71 @@ async def openai_chat(req: dict):
     }
 
 
+def _openai_chunk(completion_id: str, created: int, model: str, delta: dict, finish_reason: str = None) -> str:
+    chunk = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+
+
+def _openai_text_stream(model: str, text: str) -> StreamingResponse:
+    """把一段现成的文本按 OpenAI 流式格式返回 (特殊指令 / 错误)"""
+    async def events():
+        completion_id, created = f"chatcmpl-{int(time.time())}", int(time.time())
+        yield _openai_chunk(completion_id, created, model, {"role": "assistant", "content": text})
+        yield _openai_chunk(completion_id, created, model, {}, "stop")
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+async def _openai_coze_stream(model: str, user_id: str, conversation_id: str, question: str, open_kfid: str):
+    """
+    把 Coze 的流式增量桥接为 OpenAI chat.completion.chunk
+    客户端断开时 Starlette 会取消本生成器，finally 中取消 Coze 调用，随之关闭上游 SSE 连接
+    """
+    completion_id, created = f"chatcmpl-{int(time.time())}", int(time.time())
+    deltas: asyncio.Queue = asyncio.Queue()
+    done = object()
+
+    async def run():
+        try:
+            return await async_call_coze_workflow(
+                user_id=user_id,
+                conversation_id=conversation_id,
+                questions=question,
+                open_kfid=open_kfid,
+                on_segment=deltas.put,
+                raw_deltas=True,
+            )
+        finally:
+            deltas.put_nowait(done)
+
+    coze_task = asyncio.create_task(run())
+    sent_any = False
+    try:
+        yield _openai_chunk(completion_id, created, model, {"role": "assistant", "content": ""})
+        while True:
+            delta = await deltas.get()
+            if delta is done:
+                break
+            sent_any = True
+            yield _openai_chunk(completion_id, created, model, {"content": delta})
+        if not sent_any and not await coze_task:
+            yield _openai_chunk(completion_id, created, model, {"content": "❌ 服务器异常，Coze 无响应"})
+        yield _openai_chunk(completion_id, created, model, {}, "stop")
+        yield "data: [DONE]\n\n"
+    finally:
+        if not coze_task.done():
+            LOGGER.info(f"[WebUI] 客户端已断开，取消 Coze 流: user={user_id}")
+            coze_task.cancel()
+            await asyncio.gather(coze_task, return_exceptions=True)
+
+
 def create_openai_error_response(msg: str):
     """辅助函数：返回 OpenAI 格式的错误"""
     return {
@@ -201,43 +342,62 @@ async def wechat_hook_verification(
         return JSONResponse(content={"error": "Verification failed"}, status_code=400)
 
 
+async def _read_body_capped(request: Request, max_bytes: int) -> Optional[bytes]:
+    """
+    读取请求体，累计超过 max_bytes 时立即停止读取并返回 None
+    """
+    chunks, size = [], 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > max_bytes:
+            return None
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
 @app.post("/wechat/hook")
 async def wechat_hook_event(
+        request: Request,
         msg_signature: str, timestamp: str, nonce: str,
         background_tasks: BackgroundTasks,  # ✅ 注入后台任务对象
-        message: WeChatMessage = Depends(parse_wechat_message)
 ):
-    LOGGER.info("Received WeChat message: %s", message)
-    msg_crypt = WXBizJsonMsgCrypt(WEWORK_TOKEN, WEWORK_ENCODING_AES_KEY, WEWORK_CORPID)
-    ret, xml_content = msg_crypt.DecryptMsg(
-        message.Encrypt,
-        msg_signature,
-        timestamp,
-        nonce
-    )
-    token_msg = WeChatTokenMessage.from_xml(xml_str=xml_content)
-    LOGGER.info(f"Received WeChat token message: {token_msg.model_dump_json()}")
-    cursor = get_cursor()
-    # ✅ 传递 background_tasks 进去
-    process_msg(token_msg.Token, cursor, background_tasks)
+    # ⚡️ 超长请求体在读取前按 Content-Length 拒绝；没有 Content-Length (分块传输) 或与实际不符时边读边计数
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > WECHAT_MAX_BODY_BYTES:
+        return JSONResponse(content={"error": "Payload too large"}, status_code=413)
+    body = await _read_body_capped(request, WECHAT_MAX_BODY_BYTES)
+    if body is None:
+        return JSONResponse(content={"error": "Payload too large"}, status_code=413)
+    # 一次完成 请求体 -> 验签解密 -> (Token, OpenKfId, CreateTime)
+    ret, token_msg = decode_callback(get_wework_crypto(), body, msg_signature, timestamp, nonce,
+                                     max_bytes=WECHAT_MAX_BODY_BYTES)
+    if ret != 0:
+        LOGGER.error(f"回调消息验签/解密失败: ret={ret}")
+        return JSONResponse(content={"error": "Decrypt failed"}, status_code=400)
+    LOGGER.info(f"Received WeChat token message: OpenKfId={token_msg.OpenKfId}, CreateTime={token_msg.CreateTime}")
+
+    if WECHAT_INGRESS_MODE == "inline":
+        cursor = get_cursor(token_msg.OpenKfId)
+        # ✅ 传递 background_tasks 进去
+        process_msg(token_msg.Token, cursor, background_tasks, token_msg.OpenKfId)
+    else:
+        # ✅ 默认模式：只投递 Token 立即返回，sync_msg 由后台管道异步拉取
+        enqueue_sync(token_msg)
     return JSONResponse(content={"message": "Event received"})
 
 
-def process_msg(token: str, cursor: str, background_tasks: BackgroundTasks):
-    msg_entities, has_more, next_cursor = select_msgs(cursor=cursor, token=token)
+def process_msg(token: str, cursor: str, background_tasks: BackgroundTasks, open_kfid: str = None):
+    msg_entities, has_more, next_cursor = select_msgs(cursor=cursor, token=token, open_kfid=open_kfid)
     last_5 = msg_entities[-5:] if len(msg_entities) >= 5 else msg_entities
     for msg in last_5:
         # ---------------------------------------------------------
         # ✅ 修改点 1: 立即进行去重判断与标记
         # ---------------------------------------------------------
-        if get_msg_retry(msg.msgid):
+        # ⚡️ 核心：SET NX EX 原子认领，判断与标记一步完成，封死多 Worker 并发的空窗期。
+        if not claim_msg(msg.msgid):
             LOGGER.debug(f"消息已处理过，跳过: msgid={msg.msgid}")
             continue
 
-        # ⚡️ 核心：一旦决定处理，立刻标记！封死重试的空窗期。
-        # 这里设置为 int(time.time()) 只要是非0值即可，代表“正在处理/已处理”
-        set_msg_retry(msg.msgid, int(time.time()))
-
         # 获取消息类型
         msg_type = msg.msgtype
 
@@ -276,9 +436,91 @@ def process_msg(token: str, cursor: str, background_tasks: BackgroundTasks):
             continue
 
 
+async def _flush_user_texts(key, msgs: List[WechatMsgEntity]):
+    """
+    聚合窗口结束：把同一用户的多条文本合并成一个回复任务
+    """
+    external_userid, open_kfid = key
+    contents = [m.text.get('content') for m in msgs]
+    await work_queue.dispatch_job("reply_text", {
+        "msgid": msgs[-1].msgid,
+        "external_userid": external_userid,
+        "open_kfid": open_kfid,
+        # 单条仍传字符串；多条传列表，由 Coze 工作流作为多条 additional_messages 处理
+        "content": contents[0] if len(contents) == 1 else contents,
+        "merged_msgids": [m.msgid for m in msgs[:-1]],
+        # 最早一条消息的发送时间 (统计排队时长)
+        "send_time": msgs[0].send_time,
+    })
+    # 已交给回复任务，聚合阶段的认领到此结束
+    if AGGREGATE_QUIET_MS > 0:
+        await async_release_aggregating([m.msgid for m in msgs])
+
+
+text_aggregator = MessageAggregator(_flush_user_texts, AGGREGATE_QUIET_MS, AGGREGATE_MAX_WAIT_MS, AGGREGATE_MAX_MSGS)
+_recovery_tasks: List[asyncio.Task] = []
+
+
+async def recover_aggregating(older_than_s: float = AGGREGATE_RECOVER_AFTER_MS / 1000) -> int:
+    """
+    把超时仍留在 Redis 中的聚合消息 (所在进程已崩溃) 按用户重新分批提交为回复任务，返回回收条数
+    """
+    msgs = [WechatMsgEntity(**m) for m in await async_take_stale_aggregating(older_than_s)]
+    batches = {}
+    for msg in sorted(msgs, key=lambda m: m.send_time):
+        batches.setdefault((msg.external_userid, msg.open_kfid), []).append(msg)
+    for key, batch in batches.items():
+        LOGGER.warning(f"[聚合] 回收崩溃进程遗留的 {len(batch)} 条消息: {key}")
+        for i in range(0, len(batch), AGGREGATE_MAX_MSGS):
+            await _flush_user_texts(key, batch[i:i + AGGREGATE_MAX_MSGS])
+    if msgs:
+        metrics.incr("aggregated_msgs_recovered_total", len(msgs))
+    return len(msgs)
+
+
+async def _recover_aggregating_loop():
+    while True:
+        try:
+            await recover_aggregating()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            LOGGER.error(f"[聚合] 回收遗留消息失败: {e}")
+        await asyncio.sleep(AGGREGATE_RECOVER_AFTER_MS / 2000)
+
+
+async def async_process_msg(msg: WechatMsgEntity):
+    """
+    [异步版] 分发一条 sync_msg 拉取到的消息 (由后台消息同步管道逐条调用，管道已按页完成去重认领)
+    """
+    # 首次拉取 (无 cursor) 会从最早的历史消息开始，过旧的消息直接跳过，不再回复
+    if SYNC_MAX_MSG_AGE and time.time() - msg.send_time > SYNC_MAX_MSG_AGE:
+        LOGGER.debug(f"历史消息已过期，跳过: msgid={msg.msgid}")
+        return
+
+    msg_type = msg.msgtype
+    if msg_type == 'text':
+        if msg.text and msg.text.get('content'):
+            content = msg.text.get('content')
+            LOGGER.info(f"收到文本消息: msgid={msg.msgid}, content={content}")
+            # 同一用户连发的消息先进入聚合窗口，合并后一次调用 Coze、一次回复
+            if AGGREGATE_QUIET_MS > 0:
+                # 聚合窗口只在进程内存中：交给回复任务之前先在 Redis 留底，进程崩溃后由其他 Worker 回收
+                await async_hold_aggregating(msg.msgid, msg.model_dump())
+            text_aggregator.add((msg.external_userid, msg.open_kfid), msg)
+    elif msg_type == 'image':
+        if msg.image and msg.image.get('media_id'):
+            media_id = msg.image.get('media_id')
+            LOGGER.info(f"收到图片消息: msgid={msg.msgid}, media_id={media_id}")
+            await work_queue.dispatch_job("image", msg.model_dump())
+    else:
+        LOGGER.info(f"Skipping unsupported message type: msgid={msg.msgid}, msgtype={msg_type}")
+
+
 def reply_msg(msgid: str, external_userid: str, open_kfid: str, content: str):
-    if get_msg_retry(msgid) == b'0':
+    if get_msg_state(msgid) == MSG_STATE_DONE:
         return
+    set_msg_state(msgid, MSG_STATE_PROCESSING)
     '''添加(修改)'''
     # 用户ID = external_userid
     user_id = external_userid
@@ -286,39 +528,60 @@ def reply_msg(msgid: str, external_userid: str, open_kfid: str, content: str):
     print("=" * 80, "Coze 智能体回复处理中", "=" * 80)
 
     # 每个用户绑定独立 conversation_id
-    conversation_id = get_or_create_latest_conversation(user_id)
+    conversation_id = get_or_create_latest_conversation(user_id, open_kfid)
 
-    # 调用 Coze 工作流
+    # 调用 Coze 工作流 (与会话使用同一个客服账号对应的机器人)
     reply_text = ai_reply_coze(
         content=content,
         user_id=user_id,
-        conversation_id=conversation_id
+        conversation_id=conversation_id,
+        open_kfid=open_kfid
     )
     print("=" * 80, "Coze 智能体回复完成", "=" * 80)
     send_text_msg(msgid, external_userid, open_kfid, reply_text)
-    set_msg_retry(msgid, 0)
+    set_msg_state(msgid, MSG_STATE_DONE)
+
+
+class UserMappingError(RuntimeError):
+    """External ID -> Internal ID 映射失败 (数据库 / Redis 不可用)，回复任务需要重试"""
 
 
 # ✅ 修改后的异步函数
-async def async_reply_msg(msgid: str, external_userid: str, open_kfid: str, content: str):
+async def async_reply_msg(msgid: str, external_userid: str, open_kfid: str, content: Union[str, List[str]],
+                          merged_msgids: List[str] = None, send_time: int = None):
+    """
+    content 为列表时表示聚合后的多条消息 (merged_msgids 为除 msgid 外被合并的其他消息)
+    send_time: 用户发送消息的时间戳，只用于统计排队时长
+    Coze 调用须在本次开始处理后 COZE_REPLY_DEADLINE_S 秒内完成，否则回复兜底文案。
+    不从 send_time 起算：重新投递、积压回放和聚合回收的任务本来就晚于发送时间，仍应得到正常回答
+    (过旧的消息已在分发时按 SYNC_MAX_MSG_AGE 跳过)
+    """
     # 1. 这里的判断逻辑保留您的写法
-    # 注意：get_msg_retry 是同步 Redis 操作，速度很快，这里暂时不用改异步
-    if get_msg_retry(msgid) == b'0':
+    if await async_get_msg_state(msgid) == MSG_STATE_DONE:
         return
+    deadline = time.time() + COZE_REPLY_DEADLINE_S
+    if send_time:
+        metrics.observe("reply_job_delay_seconds", max(time.time() - send_time, 0))
+    all_msgids = [msgid] + (merged_msgids or [])
+    for mid in all_msgids:
+        await async_set_msg_state(mid, MSG_STATE_PROCESSING)
+    # 任务被重新投递 (上次在发送中途崩溃) 时，用户已经收到的分段不再重复发送
+    sender = await ReplySender.resume(msgid, external_userid, open_kfid)
 
     # =========================================================
     # ✅ 步骤 A: 身份转换 (External ID -> Internal ID)
     # =========================================================
+    # 映射失败时抛出异常：任务不会被确认，由任务队列重新投递，多次失败后转入死信队列 (不能当作已处理)
     try:
         # 将同步的映射逻辑放入线程池运行
         internal_user_id = await asyncio.to_thread(get_or_create_internal_user, external_userid)
     except Exception as e:
         LOGGER.error(f"无法获取内部用户ID，停止处理: {e}")
-        return
+        raise UserMappingError(f"获取内部用户ID失败: external_userid={external_userid}") from e
 
     if not internal_user_id:
         LOGGER.error(f"internal_user_id = {internal_user_id} ，映射失败，停止处理: external_userid={external_userid}")
-        return
+        raise UserMappingError(f"内部用户ID映射失败: external_userid={external_userid}")
 
     LOGGER.info(f"[映射] ExtID：{external_userid} -> IntID：{internal_user_id}")
     LOGGER.info(f"[消息] 用户：{internal_user_id} 内容：{content}")
@@ -338,11 +601,14 @@ async def async_reply_msg(msgid: str, external_userid: str, open_kfid: str, cont
     # ✅ 步骤 C: 调用 AI (传入 Internal ID)
     # =========================================================
     # Coze 里的 user_id 参数现在是 "user_xxxx"，这很好，Coze 就能认出同一个用户
+    # 渐进式回复：流式生成的每一段完整后立即发送 (⚠️ 发给微信必须使用 External ID)
     reply_text = await async_ai_reply_coze(
         content=content,
         user_id=internal_user_id,
         conversation_id=conversation_id,
-        open_kfid=open_kfid
+        open_kfid=open_kfid,
+        on_segment=sender.send_segment if COZE_PROGRESSIVE_REPLY else None,
+        deadline=deadline
     )
 
     print("=" * 80, "Coze 智能体回复完成", "=" * 80)
@@ -351,11 +617,35 @@ async def async_reply_msg(msgid: str, external_userid: str, open_kfid: str, cont
     # ✅ 步骤 D: 发送消息 (⚠️ 必须使用 External ID)
     # =========================================================
     # 发给微信接口时，微信只认 external_userid，千万别传内部 ID 过去
-    await async_send_text_msg(msgid, external_userid, open_kfid, reply_text)
+    # 渐进模式下已经边生成边发送；未发出任何分段 (非渐进模式 / 出错兜底文案) 时整段发送，超长按上限切分
+    if not sender.count:
+        await sender.send_text(reply_text)
 
     # 5. 更新状态
-    set_msg_retry(msgid, 0)
+    for mid in all_msgids:
+        await async_set_msg_state(mid, MSG_STATE_DONE)
+
+
+# ================= 任务队列处理函数 =================
+# 同一用户 + 客服账号的任务进入同一通道串行执行，保证回复顺序、避免并发创建会话
+reply_lanes = LaneScheduler(LANE_MAX_CONCURRENCY, name="reply_lanes")
+
+
+async def _reply_text_job(payload: dict):
+    await reply_lanes.run(
+        (payload["external_userid"], payload["open_kfid"]),
+        lambda: async_reply_msg(payload["msgid"], payload["external_userid"], payload["open_kfid"],
+                                payload["content"], payload.get("merged_msgids"), payload.get("send_time"))
+    )
+
+
+async def _image_job(payload: dict):
+    msg = WechatMsgEntity(**payload)
+    await reply_lanes.run((msg.external_userid, msg.open_kfid), lambda: async_handle_image(msg))
+
 
+work_queue.register_handler("reply_text", _reply_text_job)
+work_queue.register_handler("image", _image_job)
 
 '''
 uvicorn main:app --host 0.0.0.0 --port 8000 --reload
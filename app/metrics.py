@@ -0,0 +1,77 @@
+from collections import defaultdict
+from typing import Dict
+
+'''
+进程内运行指标 (计数器 / 仪表盘 / 直方图)，通过 GET /metrics 以 JSON 形式输出
+
+注意：gunicorn 多 Worker 时每个 Worker 各自统计，需要全局数据请在采集端汇总
+'''
+
+_counters: Dict[str, float] = defaultdict(int)
+_gauges: Dict[str, float] = {}
+_histograms: Dict[str, "_Histogram"] = {}
+
+# 默认直方图分桶 (秒)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class _Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 最后一格为 +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                return
+        self.counts[-1] += 1
+
+    def to_dict(self) -> dict:
+        # 输出累计分桶，与 Prometheus 的 le 语义一致
+        cumulative, acc = {}, 0
+        for bound, c in zip(list(self.buckets) + ["+Inf"], self.counts):
+            acc += c
+            cumulative[str(bound)] = acc
+        return {"buckets": cumulative, "sum": self.sum, "count": self.count}
+
+
+def _key(name: str, labels: dict) -> str:
+    # 与 Prometheus 文本格式一致：name{k="v",...}
+    if not labels:
+        return name
+    label_str = ",".join(f'{k}="{v}"' for k, v in sorted(labels.items()))
+    return f"{name}{{{label_str}}}"
+
+
+def incr(name: str, value: float = 1, **labels):
+    """计数器累加"""
+    _counters[_key(name, labels)] += value
+
+
+def set_gauge(name: str, value: float, **labels):
+    """仪表盘设置当前值"""
+    _gauges[_key(name, labels)] = value
+
+
+def observe(name: str, value: float, buckets=DEFAULT_BUCKETS, **labels):
+    """直方图记录一次观测值"""
+    key = _key(name, labels)
+    hist = _histograms.get(key)
+    if hist is None:
+        hist = _histograms[key] = _Histogram(buckets)
+    hist.observe(value)
+
+
+def snapshot() -> dict:
+    return {
+        "counters": dict(_counters),
+        "gauges": dict(_gauges),
+        "histograms": {k: h.to_dict() for k, h in _histograms.items()},
+    }
@@ -0,0 +1,83 @@
+import hashlib
+import re
+import time
+import unicodedata
+from typing import List, Optional
+
+import metrics
+from config import LOGGER, COZE_REPLY_CACHE_ENABLED, COZE_REPLY_CACHE_TTL, COZE_REPLY_CACHE_MAX_ENTRIES, \
+    COZE_REPLY_CACHE_MAX_QUESTION_CHARS
+from kv import async_get_cached_reply, async_put_cached_reply
+
+'''
+FAQ 回复缓存
+
+客服流量中有很大一部分是同几个问题 (营业时间、价格、发货……)，每一条都要完整跑一次 Coze 工作流。
+这里按 (workflow_id, 规范化后的问题) 缓存回复：
+- 规范化：全角转半角 (NFKC)、转小写、去掉标点、合并空白，“营业时间？”与“ 营业时间 ”命中同一条
+- 只缓存单条短问题 (不超过 COZE_REPLY_CACHE_MAX_QUESTION_CHARS 字)；机器人配置了 allowlist 时还必须匹配其中一条正则
+- Redis 中每条带 TTL，每个工作流最多 COZE_REPLY_CACHE_MAX_ENTRIES 条，超出时淘汰最久未访问的条目 (LRU)
+- 需要 COZE_REPLY_CACHE_ENABLED=True 且机器人配置 reply_cache.enabled 才生效；Redis 不可用时直接调用 Coze
+命中时不调用 Coze，该轮问答不会进入 Coze 会话的上下文，但仍写入 message_record。
+'''
+
+
+def normalize_question(text: str) -> str:
+    text = unicodedata.normalize("NFKC", text).lower()
+    text = "".join(ch for ch in text if not unicodedata.category(ch).startswith("P"))
+    return " ".join(text.split())
+
+
+class ReplyCachePolicy:
+    def __init__(self, bot_key: str, workflow_id: str, allowlist: List[str] = None, ttl: int = None):
+        self.bot_key = bot_key
+        self.workflow_id = workflow_id
+        self.allowlist = [re.compile(pattern) for pattern in allowlist or []]
+        self.ttl = int(ttl or COZE_REPLY_CACHE_TTL)
+
+    @classmethod
+    def from_config(cls, bot_key: str, workflow_id: str, config: Optional[dict]) -> Optional["ReplyCachePolicy"]:
+        """机器人配置中的 reply_cache 规则，未开启时返回 None"""
+        if not COZE_REPLY_CACHE_ENABLED or not config or not config.get("enabled"):
+            return None
+        try:
+            return cls(bot_key, workflow_id, config.get("allowlist"), config.get("ttl"))
+        except re.error as e:
+            LOGGER.error(f"❌ 配置错误: [{bot_key}] reply_cache.allowlist 正则无效，已关闭回复缓存: {e}")
+            return None
+
+    def question_key(self, messages: List[dict]) -> Optional[str]:
+        """可缓存时返回规范化后的问题，否则返回 None (多条聚合消息、过长、不在 allowlist 中)"""
+        if len(messages) != 1:
+            return None
+        question = normalize_question(str(messages[0].get("content") or ""))
+        if not question or len(question) > COZE_REPLY_CACHE_MAX_QUESTION_CHARS:
+            return None
+        if self.allowlist and not any(p.search(question) for p in self.allowlist):
+            return None
+        return question
+
+
+def _digest(question: str) -> str:
+    return hashlib.sha1(question.encode("utf-8")).hexdigest()
+
+
+async def get(policy: ReplyCachePolicy, question: str) -> Optional[str]:
+    try:
+        reply = await async_get_cached_reply(policy.workflow_id, _digest(question), int(time.time() * 1000))
+    except Exception as e:
+        LOGGER.warning(f"[回复缓存] Redis 读取失败: {e}")
+        return None
+    metrics.incr("coze_reply_cache_lookups_total", bot=policy.bot_key, result="hit" if reply else "miss")
+    return reply
+
+
+async def put(policy: ReplyCachePolicy, question: str, reply: str):
+    try:
+        evicted = await async_put_cached_reply(policy.workflow_id, _digest(question), reply, int(time.time() * 1000),
+                                               policy.ttl, COZE_REPLY_CACHE_MAX_ENTRIES)
+    except Exception as e:
+        LOGGER.warning(f"[回复缓存] Redis 写入失败: {e}")
+        return
+    if evicted:
+        metrics.incr("coze_reply_cache_evictions_total", evicted, bot=policy.bot_key)
@@ -0,0 +1,108 @@
+import re
+from typing import List
+
+from config import WEWORK_TEXT_MAX_BYTES, REPLY_SEGMENT_MIN_CHARS
+
+'''
+回复分段
+
+Coze 流式输出时，把增量文本按 段落 / 句子 边界切成若干段，每段一完整就发给用户，缩短首条回复的等待时间：
+- 遇到空行 (段落结束) 立即切出
+- 累计不少于 REPLY_SEGMENT_MIN_CHARS 个字符后，在最后一个句末标点处切出，避免一句一条刷屏
+- 任何一段都不超过企业微信文本消息的长度上限 (WEWORK_TEXT_MAX_BYTES，按 UTF-8 字节计)
+'''
+
+_PARAGRAPH_BREAK = re.compile(r"\n[ \t]*\n")
+# 中英文句末标点 (可跟右引号 / 右括号)，英文句点后必须是空白，避免把 3.14 之类切开
+_SENTENCE_END = re.compile(r"(?:[。！？!?；;…]+|\.(?=\s))[”’\"')）]*|\n")
+_SOFT_BREAK = re.compile(r"[\s，,、]")
+
+
+def _byte_len(text: str) -> int:
+    return len(text.encode("utf-8"))
+
+
+def _last_match_end(pattern: re.Pattern, text: str) -> int:
+    end = 0
+    for m in pattern.finditer(text):
+        end = m.end()
+    return end
+
+
+def _fit(text: str, max_bytes: int) -> int:
+    """不超过 max_bytes 的最长前缀的切分位置 (字符下标)，优先落在句末，其次落在空白 / 逗号处"""
+    prefix = text.encode("utf-8")[:max_bytes].decode("utf-8", "ignore")
+    cut = _last_match_end(_SENTENCE_END, prefix) or _last_match_end(_SOFT_BREAK, prefix)
+    return cut or len(prefix)
+
+
+def split_text(text: str, max_bytes: int = WEWORK_TEXT_MAX_BYTES) -> List[str]:
+    """把一段完整文本按长度上限切成多条消息 (不超限时原样返回一条)"""
+    segments = []
+    text = text.strip()
+    while _byte_len(text) > max_bytes:
+        cut = _fit(text, max_bytes)
+        segments.append(text[:cut].strip())
+        text = text[cut:].lstrip()
+    if text:
+        segments.append(text)
+    return [s for s in segments if s]
+
+
+class ReplySegmenter:
+    def __init__(self, max_bytes: int = WEWORK_TEXT_MAX_BYTES, min_chars: int = REPLY_SEGMENT_MIN_CHARS):
+        self.max_bytes = max_bytes
+        self.min_chars = min_chars
+        self._buf = ""
+
+    def feed(self, text: str) -> List[str]:
+        """追加增量文本，返回已经完整、可以发送的分段"""
+        self._buf += text
+        segments = []
+        while True:
+            self._buf = self._buf.lstrip()
+            cut = self._cut_point()
+            if not cut:
+                break
+            segment, self._buf = self._buf[:cut].strip(), self._buf[cut:]
+            if segment:
+                segments.append(segment)
+        return segments
+
+    def flush(self) -> List[str]:
+        """流结束时取出剩余文本"""
+        rest, self._buf = self._buf, ""
+        return split_text(rest, self.max_bytes)
+
+    def _cut_point(self) -> int:
+        buf = self._buf
+        cut = 0
+        m = _PARAGRAPH_BREAK.search(buf)
+        if m:
+            cut = m.end()
+        elif len(buf) >= self.min_chars:
+            end = _last_match_end(_SENTENCE_END, buf)
+            if end >= self.min_chars:
+                cut = end
+        # 超过长度上限时强制切分
+        if _byte_len(buf[:cut] if cut else buf) > self.max_bytes:
+            cut = _fit(buf, self.max_bytes)
+        return cut
+
+
+class PassThroughSegmenter:
+    """不切分：每个增量原样输出 (SSE 透传给 Open-WebUI 时使用)，消息之间的分隔空行只在后面还有内容时输出"""
+
+    def __init__(self):
+        self._pending = ""
+
+    def feed(self, text: str) -> List[str]:
+        if not text.strip():
+            self._pending += text
+            return []
+        text, self._pending = self._pending + text, ""
+        return [text]
+
+    def flush(self) -> List[str]:
+        self._pending = ""
+        return []
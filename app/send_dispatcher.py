@@ -0,0 +1,169 @@
+import asyncio
+import random
+import time
+from typing import List, Optional
+
+import httpx
+
+import metrics
+from config import LOGGER, SEND_RATE_CORP_PER_SEC, SEND_BURST_CORP, SEND_RATE_KFID_PER_SEC, SEND_BURST_KFID, \
+    SEND_CONCURRENCY, SEND_QUEUE_MAXSIZE, SEND_MAX_RETRIES, SEND_BACKOFF_BASE_MS, SEND_BACKOFF_MAX_MS
+from kv import async_take_send_permit
+from schema import WechatMsgSendEntity
+from token_manager import access_tokens
+
+'''
+kf/send_msg 发送调度
+
+回复不再各自直接调用 send_msg，而是进入本进程的发送队列，由固定数量的发送协程处理：
+- 限流：发送前从 Redis 令牌桶 (企业级 + 客服账号级，跨 Worker 共享) 取许可，突发流量被平滑而不是被企业微信拒绝
+- 重试：限频 / 系统繁忙类错误码按带抖动的指数退避重试，最多 SEND_MAX_RETRIES 次；其他错误码视为最终结果
+  网络异常只重试连接阶段的失败 (请求确定没有发出)；读超时、连接中途断开等请求可能已送达的情况不重试，避免重复消息
+- 背压：队列满时调用方等待，不丢弃回复
+'''
+
+SEND_MSG_URL = "https://qyapi.weixin.qq.com/cgi-bin/kf/send_msg"
+# -1: 系统繁忙；45009: 接口调用超过限制；45033: 接口并发调用超过限制
+RETRYABLE_ERRCODES = (-1, 45009, 45033)
+# 连接阶段的异常：请求还没有发到企业微信，重试不会重复发送
+RETRYABLE_EXCEPTIONS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+_queue: Optional[asyncio.Queue] = None
+_senders: List[asyncio.Task] = []
+
+
+class _SendJob:
+    __slots__ = ("entity", "future", "enqueued_at")
+
+    def __init__(self, entity: WechatMsgSendEntity, future: asyncio.Future, enqueued_at: float):
+        self.entity = entity
+        self.future = future
+        self.enqueued_at = enqueued_at
+
+
+async def send(entity: WechatMsgSendEntity) -> Optional[dict]:
+    """
+    提交一条消息并等待发送完成，返回企业微信的最终响应 (网络异常、非 200 响应时 errcode 为 -1)
+    同一调用方按顺序 await 即可保证同一用户的消息按序送达
+    """
+    if not _senders:
+        start_senders()
+    loop = asyncio.get_running_loop()
+    job = _SendJob(entity, loop.create_future(), time.perf_counter())
+    await _queue.put(job)
+    metrics.set_gauge("send_queue_depth", _queue.qsize())
+    return await job.future
+
+
+async def _wait_permit(open_kfid: str):
+    while True:
+        try:
+            wait_ms = await async_take_send_permit(open_kfid, SEND_RATE_CORP_PER_SEC, SEND_BURST_CORP,
+                                                   SEND_RATE_KFID_PER_SEC, SEND_BURST_KFID)
+        except Exception as e:
+            # Redis 不可用时放行，由企业微信的限频错误码 + 退避兜底
+            LOGGER.warning(f"[发送] 令牌桶不可用，直接发送: {e}")
+            return
+        if wait_ms <= 0:
+            return
+        metrics.incr("send_throttled_total")
+        await asyncio.sleep(wait_ms / 1000)
+
+
+def _backoff(attempt: int) -> float:
+    # 全抖动指数退避 (秒)
+    ceiling = min(SEND_BACKOFF_MAX_MS, SEND_BACKOFF_BASE_MS * (2 ** attempt))
+    return random.uniform(SEND_BACKOFF_BASE_MS / 2, ceiling) / 1000
+
+
+async def _deliver(entity: WechatMsgSendEntity) -> Optional[dict]:
+    payload = entity.model_dump()
+    result = None
+    for attempt in range(SEND_MAX_RETRIES + 1):
+        await _wait_permit(entity.open_kfid)
+        start = time.perf_counter()
+        retryable = False
+        try:
+            # access_token 由 token_manager 异步获取，失效时自动刷新重试
+            resp = await access_tokens.request("POST", SEND_MSG_URL, json=payload)
+            if resp.status_code == 200:
+                result = resp.json()
+                # 只有企业微信明确返回的限频 / 系统繁忙错误码才重试
+                retryable = result.get("errcode", 0) in RETRYABLE_ERRCODES
+            else:
+                result = {"errcode": -1, "errmsg": f"HTTP {resp.status_code}"}
+        except RETRYABLE_EXCEPTIONS as e:
+            result, retryable = {"errcode": -1, "errmsg": repr(e)}, True
+        except (httpx.HTTPError, ValueError) as e:
+            # 读超时、连接中途断开、响应无法解析：消息可能已经发出，重试会让用户收到重复消息
+            result = {"errcode": -1, "errmsg": repr(e)}
+        metrics.observe("send_attempt_seconds", time.perf_counter() - start)
+
+        errcode = result.get("errcode", 0)
+        if errcode == 0:
+            metrics.incr("send_total", result="ok")
+            LOGGER.info(f"Async send success: {result.get('errmsg', 'ok')}")
+            return result
+        if not retryable:
+            metrics.incr("send_total", result="failed")
+            LOGGER.error(f"Async send failed (不可重试): touser={entity.touser}, resp={result}")
+            return result
+        if attempt < SEND_MAX_RETRIES:
+            delay = _backoff(attempt)
+            metrics.incr("send_retries_total", errcode=errcode)
+            LOGGER.warning(f"[发送] 企业微信返回 {errcode}，{delay:.2f}s 后第 {attempt + 1} 次重试")
+            await asyncio.sleep(delay)
+    metrics.incr("send_total", result="exhausted")
+    LOGGER.error(f"Async send failed (重试耗尽): touser={entity.touser}, resp={result}")
+    return result
+
+
+async def _sender():
+    while True:
+        job = await _queue.get()
+        metrics.set_gauge("send_queue_depth", _queue.qsize())
+        try:
+            if job.future.cancelled():
+                continue
+            result = await _deliver(job.entity)
+            if not job.future.cancelled():
+                job.future.set_result(result)
+        except asyncio.CancelledError:
+            job.future.cancel()
+            raise
+        except Exception as e:
+            LOGGER.error(f"Async send exception: {e}")
+            if not job.future.cancelled():
+                job.future.set_result(None)
+        finally:
+            metrics.observe("send_latency_seconds", time.perf_counter() - job.enqueued_at)
+            _queue.task_done()
+
+
+def start_senders(concurrency: int = SEND_CONCURRENCY):
+    """启动发送协程 (lifespan 启动时调用；未启动时首次 send 会自动启动)"""
+    global _queue
+    if _senders:
+        return
+    if _queue is None:
+        _queue = asyncio.Queue(maxsize=SEND_QUEUE_MAXSIZE)
+    for _ in range(max(concurrency, 1)):
+        _senders.append(asyncio.create_task(_sender()))
+    LOGGER.info(f"🚀 发送调度已启动: {len(_senders)} 个发送协程")
+
+
+async def stop_senders(timeout: float = 10):
+    """等待队列中的消息发完 (最多 timeout 秒) 后停止发送协程"""
+    global _queue
+    if _queue is not None:
+        try:
+            await asyncio.wait_for(_queue.join(), timeout)
+        except asyncio.TimeoutError:
+            LOGGER.warning(f"[发送] 退出时仍有 {_queue.qsize()} 条消息未发送")
+    for task in _senders:
+        task.cancel()
+    await asyncio.gather(*_senders, return_exceptions=True)
+    _senders.clear()
+    while _queue is not None and not _queue.empty():
+        _queue.get_nowait().future.cancel()
+    _queue = None
@@ -0,0 +1,267 @@
+import asyncio
+import random
+import uuid
+from contextlib import aclosing
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import httpx
+from redis.exceptions import RedisError
+
+import metrics
+from config import LOGGER, SYNC_QUEUE_MAXSIZE, SYNC_WORKER_COUNT, SYNC_LEASE_TTL_MS, SYNC_COALESCE_WINDOW_MS, \
+    SYNC_COALESCE_MAX_DELAY_MS, SYNC_DRAIN_RETRIES, SYNC_DRAIN_BACKOFF_MS
+from kv import async_get_cursor, async_acquire_sync_lease, async_renew_sync_lease, async_release_sync_lease, \
+    async_mark_resync, async_restore_resync, async_has_resync, async_pop_resync, async_claim_msgs
+from schema import WechatMsgEntity
+from util.wx_envelope import CallbackEnvelope
+from token_manager import AccessTokenError
+from wework import async_iter_msg_pages, SyncMsgError
+
+'''
+微信客服回调的异步消息同步管道
+
+回调入口 (/wechat/hook) 只负责验签、解密，并把 Token 投递到本 Worker 的内存队列后立即返回；
+后台的拉取协程从队列取出 Token，异步调用 kf/sync_msg 并把消息交给 handler 分发。
+这样一个慢的企业微信响应只会占用一个拉取协程，不会卡住同 Worker 内的其他请求。
+
+跨 Worker 单飞：同一客服账号 (OpenKfId) 同一时刻只有一个 Worker 持有 Redis 租约并拉取，
+其他 Worker 收到的回调只写入“待重新同步”标记，由持有租约的 Worker 拉完当前批次后补拉。
+
+回调合并：企业微信每条消息都会推一次 kf_msg_or_event，同一客服账号在 SYNC_COALESCE_WINDOW_MS 内
+连续到达的回调只保留最新的 Token 合并成一次拉取；持续有回调时最迟 SYNC_COALESCE_MAX_DELAY_MS 也会触发。
+
+拉取失败 (sync_msg 报错、网络异常、取不到 access_token) 时放回“待重新同步”标记，退避后从已保存的 cursor 重试；
+连续失败 SYNC_DRAIN_RETRIES 次后释放租约，标记保留，由下一次回调继续。
+
+租约续期失败 (已过期被其他 Worker 抢走、Redis 不可用) 时立即停止拉取：每页认领前检查，
+不再保存 cursor、不再分发消息，未拉完的部分放回标记交给新的租约持有者。
+
+handler 分发单条消息出错时只记录日志并跳过该条，同一页已认领的其他消息照常分发。
+'''
+
+# 拉取阶段可重试的失败 (handler 自身的异常不在此列)
+_DRAIN_ERRORS = (SyncMsgError, AccessTokenError, httpx.HTTPError)
+
+MsgHandler = Callable[[WechatMsgEntity], Awaitable[None]]
+
+_sync_queue: Optional[asyncio.Queue] = None
+_workers: List[asyncio.Task] = []
+# 持有后台任务的强引用，防止任务在执行中被 GC 回收
+_background_tasks = set()
+
+
+class _CoalesceSlot:
+    """某个客服账号正在等待合并的回调"""
+    __slots__ = ("token_msg", "first_at", "count", "handle")
+
+    def __init__(self, token_msg: CallbackEnvelope, first_at: float):
+        self.token_msg = token_msg
+        self.first_at = first_at
+        self.count = 1
+        self.handle: Optional[asyncio.TimerHandle] = None
+
+
+_coalesce_slots: Dict[str, _CoalesceSlot] = {}
+
+
+def spawn(coro) -> asyncio.Task:
+    """
+    创建后台任务，并在任务结束时自动释放引用
+    """
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+def _put_sync(token_msg: CallbackEnvelope) -> bool:
+    try:
+        _sync_queue.put_nowait(token_msg)
+        metrics.incr("sync_drains_scheduled_total", open_kfid=token_msg.OpenKfId)
+        return True
+    except asyncio.QueueFull:
+        LOGGER.warning(f"消息同步队列已满({_sync_queue.maxsize})，丢弃 Token: OpenKfId={token_msg.OpenKfId}")
+        metrics.incr("sync_queue_dropped_total", open_kfid=token_msg.OpenKfId)
+        return False
+
+
+def _flush_coalesced(open_kfid: str):
+    slot = _coalesce_slots.pop(open_kfid, None)
+    if slot is None:
+        return
+    if slot.count > 1:
+        LOGGER.info(f"合并回调 {slot.count} 次为一次拉取: OpenKfId={open_kfid}")
+    _put_sync(slot.token_msg)
+
+
+def enqueue_sync(token_msg: CallbackEnvelope) -> bool:
+    """
+    投递一个待拉取的 Token (非阻塞)，管道未启动或队列满时返回 False
+
+    开启回调合并时先放入合并窗口，窗口到期 (或达到最大等待时长) 后再投递到拉取队列
+    """
+    if _sync_queue is None:
+        LOGGER.error("消息同步管道未启动，丢弃 Token")
+        return False
+    open_kfid = token_msg.OpenKfId
+    metrics.incr("sync_callbacks_total", open_kfid=open_kfid)
+    if SYNC_COALESCE_WINDOW_MS <= 0:
+        return _put_sync(token_msg)
+
+    loop = asyncio.get_running_loop()
+    now = loop.time()
+    slot = _coalesce_slots.get(open_kfid)
+    if slot is None:
+        slot = _coalesce_slots[open_kfid] = _CoalesceSlot(token_msg, now)
+    else:
+        # 窗口内再次到达：只保留最新 Token，并重新计时 (不超过最大等待时长)
+        slot.token_msg = token_msg
+        slot.count += 1
+        slot.handle.cancel()
+        metrics.incr("sync_callbacks_merged_total", open_kfid=open_kfid)
+    delay = min(SYNC_COALESCE_WINDOW_MS, slot.first_at * 1000 + SYNC_COALESCE_MAX_DELAY_MS - now * 1000)
+    slot.handle = loop.call_later(max(delay, 0) / 1000, _flush_coalesced, open_kfid)
+    return True
+
+
+async def _drain_once(token: str, open_kfid: str, handler: MsgHandler, lease_lost: asyncio.Event) -> bool:
+    """
+    从该客服账号已保存的 cursor 开始分页拉取 sync_msg，每页一次往返完成去重认领，只把新消息交给 handler
+    租约丢失时停在当前页之前 (该页不认领、cursor 不前移) 并返回 False
+    """
+    cursor = await async_get_cursor(open_kfid)
+    count = 0
+    async with aclosing(async_iter_msg_pages(token=token, cursor=cursor, open_kfid=open_kfid)) as pages:
+        async for page in pages:
+            if lease_lost.is_set():
+                LOGGER.warning(f"拉取租约已丢失，停止拉取 (已分发 {count} 条): OpenKfId={open_kfid}")
+                return False
+            new_msgids = await async_claim_msgs([msg.msgid for msg in page])
+            metrics.incr("sync_msgs_duplicated_total", len(page) - len(new_msgids), open_kfid=open_kfid)
+            for msg in page:
+                if msg.msgid not in new_msgids:
+                    LOGGER.debug(f"消息已处理过，跳过: msgid={msg.msgid}")
+                    continue
+                try:
+                    await handler(msg)
+                except Exception as e:
+                    # 整页已认领、cursor 已前移，一条消息的异常不能中断整页，否则本页剩下的消息再也不会被分发
+                    LOGGER.error(f"分发消息异常，跳过: msgid={msg.msgid}, OpenKfId={open_kfid}, error={e!r}")
+                    metrics.incr("sync_dispatch_failures_total", open_kfid=open_kfid)
+                    continue
+                count += 1
+    LOGGER.info(f"本次拉取新消息 {count} 条: OpenKfId={open_kfid}")
+    return True
+
+
+async def _keep_lease_alive(open_kfid: str, owner: str, lease_lost: asyncio.Event):
+    # 拉取期间定期续期，防止大批量积压时租约过期被其他 Worker 抢走；续期失败时通知 drain 停止
+    while True:
+        await asyncio.sleep(SYNC_LEASE_TTL_MS / 3000)
+        try:
+            renewed = await async_renew_sync_lease(open_kfid, owner)
+        except RedisError as e:
+            LOGGER.warning(f"拉取租约续期异常: OpenKfId={open_kfid}, error={e!r}")
+            renewed = False
+        if not renewed:
+            LOGGER.warning(f"拉取租约续期失败 (可能已过期)，停止拉取: OpenKfId={open_kfid}")
+            metrics.incr("sync_lease_lost_total", open_kfid=open_kfid)
+            lease_lost.set()
+            return
+
+
+async def drain(token_msg: CallbackEnvelope, handler: MsgHandler):
+    """
+    单飞拉取：抢到租约的 Worker 负责拉取，没抢到的只留下“待重新同步”标记
+    """
+    open_kfid = token_msg.OpenKfId
+    # ⚠️ 顺序不能反：先写标记再抢租约，保证租约释放瞬间到达的回调不会丢
+    await async_mark_resync(open_kfid, token_msg.Token)
+    owner = uuid.uuid4().hex
+    if not await async_acquire_sync_lease(open_kfid, owner):
+        LOGGER.info(f"其他 Worker 正在拉取，已标记待重新同步: OpenKfId={open_kfid}")
+        return
+
+    lease_lost = asyncio.Event()
+    heartbeat = asyncio.create_task(_keep_lease_alive(open_kfid, owner, lease_lost))
+    released = False
+    failures = 0
+    try:
+        while not lease_lost.is_set():
+            token = await async_pop_resync(open_kfid)
+            if token:
+                try:
+                    if not await _drain_once(token, open_kfid, handler, lease_lost):
+                        # 没拉完：放回标记交给新的租约持有者
+                        await async_restore_resync(open_kfid, token)
+                        break
+                    failures = 0
+                except _DRAIN_ERRORS as e:
+                    # 失败不等于已拉完：放回标记，退避后从已保存的 cursor 重新拉取
+                    await async_restore_resync(open_kfid, token)
+                    failures += 1
+                    metrics.incr("sync_drain_failures_total", open_kfid=open_kfid)
+                    if failures > SYNC_DRAIN_RETRIES:
+                        LOGGER.error(f"拉取消息连续失败 {failures} 次，保留待重新同步标记: OpenKfId={open_kfid}, error={e!r}")
+                        break
+                    delay = random.uniform(0, SYNC_DRAIN_BACKOFF_MS * 2 ** (failures - 1)) / 1000
+                    LOGGER.warning(f"拉取消息失败，{delay:.2f}s 后重试 ({failures}/{SYNC_DRAIN_RETRIES}): "
+                                   f"OpenKfId={open_kfid}, error={e!r}")
+                    await asyncio.sleep(delay)
+                continue
+            # 没有新的标记，释放租约；释放后再检查一次，接住释放瞬间到达的回调
+            await async_release_sync_lease(open_kfid, owner)
+            released = True
+            if not await async_has_resync(open_kfid) or not await async_acquire_sync_lease(open_kfid, owner):
+                break
+            released = False
+    finally:
+        heartbeat.cancel()
+        if not released:
+            await async_release_sync_lease(open_kfid, owner)
+
+
+async def _sync_worker(worker_id: int, handler: MsgHandler):
+    while True:
+        token_msg = await _sync_queue.get()
+        try:
+            await drain(token_msg, handler)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            LOGGER.error(f"[SyncWorker-{worker_id}] 拉取消息异常: {e}")
+        finally:
+            _sync_queue.task_done()
+
+
+async def start_sync_workers(handler: MsgHandler, worker_count: int = SYNC_WORKER_COUNT):
+    """
+    启动拉取协程 (在 FastAPI lifespan 中调用)
+    """
+    global _sync_queue
+    _sync_queue = asyncio.Queue(maxsize=SYNC_QUEUE_MAXSIZE)
+    for i in range(worker_count):
+        _workers.append(asyncio.create_task(_sync_worker(i, handler)))
+    LOGGER.info(f"✅ 消息同步管道已启动: {worker_count} 个拉取协程")
+
+
+async def stop_sync_workers():
+    """
+    停止拉取协程 (已分发的后台任务不受影响)
+    """
+    for slot in _coalesce_slots.values():
+        slot.handle.cancel()
+    _coalesce_slots.clear()
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+    LOGGER.info("🛑 消息同步管道已停止")
+
+
+async def wait_background_tasks():
+    """
+    等待已分发的后台任务结束 (进程退出前调用)
+    """
+    if _background_tasks:
+        await asyncio.gather(*_background_tasks, return_exceptions=True)
@@ -0,0 +1,180 @@
+import asyncio
+import time
+import uuid
+from typing import Optional
+
+import httpx
+
+import metrics
+from config import LOGGER, WEWORK_CORPID, WEWORK_CORPSECRET, WEWORK_TOKEN_API, WEWORK_TOKEN_REFRESH_AHEAD, \
+    WEWORK_TOKEN_LEASE_MS
+from http_clients import get_async_client, UPSTREAM_WEWORK
+from kv import async_get_access_token, async_set_access_token, async_invalidate_access_token, \
+    async_acquire_token_lease, async_release_token_lease, async_token_lease_held
+
+'''
+企业微信 access_token 异步管理
+
+- 进程内缓存：按 gettoken 返回的 expires_in 计算过期时间，命中时不访问 Redis
+- 单飞刷新：进程内并发请求共享同一个刷新任务；跨 Worker 通过 Redis 租约保证同一时刻只有一个刷新者，
+  其他 Worker 等租约释放后直接读取 Redis 中的新 token
+- 提前刷新：后台协程在过期前 WEWORK_TOKEN_REFRESH_AHEAD 秒刷新；刷新期间仍返回旧 token (stale-while-refresh)
+- 失效重试：接口返回 40014 / 42001 时作废该 token (仅当 Redis 中仍是它时才删除) 并用新 token 重试一次
+'''
+
+# 40014: 不合法的 access_token；42001: access_token 已过期
+INVALID_TOKEN_ERRCODES = (40014, 42001)
+# 写入缓存时比 expires_in 少留的秒数，避免在边界上用到刚过期的 token
+_EXPIRY_SAFETY_S = 60
+# 有效期内重复调用 gettoken 会返回同一个 token，两次提前刷新之间至少间隔这么久，防止空转
+_MIN_REFRESH_INTERVAL_S = 30
+
+
+class AccessTokenError(RuntimeError):
+    pass
+
+
+class AccessTokenManager:
+    def __init__(self, refresh_ahead: float, lease_ms: int):
+        self.refresh_ahead = refresh_ahead
+        self.lease_ms = lease_ms
+        self._token: Optional[str] = None
+        self._expires_at = 0.0
+        self._next_refresh_at = 0.0
+        self._invalidated: Optional[str] = None
+        self._refreshing: Optional[asyncio.Task] = None
+        self._loop_task: Optional[asyncio.Task] = None
+
+    async def get(self) -> str:
+        """获取可用的 access_token，失败时抛出 AccessTokenError"""
+        now = time.time()
+        if self._token and now < self._expires_at:
+            if now >= self._next_refresh_at:
+                # 临近过期：后台刷新，本次先返回旧 token
+                self._start_refresh()
+            metrics.incr("wework_token_lookups_total", result="hit")
+            return self._token
+        metrics.incr("wework_token_lookups_total", result="miss")
+        return await self.refresh()
+
+    async def refresh(self) -> str:
+        """进程内单飞刷新；shield 保证某个调用方被取消时不会中断其他调用方等待的刷新"""
+        return await asyncio.shield(self._start_refresh())
+
+    async def invalidate(self, token: str):
+        """作废一个已被企业微信判定失效的 token"""
+        self._invalidated = token
+        if self._token == token:
+            self._token, self._expires_at = None, 0.0
+        await async_invalidate_access_token(token)
+        metrics.incr("wework_token_invalidated_total")
+
+    async def request(self, method: str, url: str, params: dict = None, **kwargs) -> httpx.Response:
+        """携带 access_token 请求企业微信接口，token 失效时作废并重试一次"""
+        for attempt in range(2):
+            token = await self.get()
+            resp = await get_async_client(UPSTREAM_WEWORK).request(
+                method, url, params={**(params or {}), "access_token": token}, **kwargs
+            )
+            errcode = _errcode(resp)
+            if attempt == 0 and errcode in INVALID_TOKEN_ERRCODES:
+                LOGGER.warning(f"[access_token] 企业微信返回 {errcode}，作废后重试: {url}")
+                await self.invalidate(token)
+                continue
+            return resp
+
+    def _start_refresh(self) -> asyncio.Task:
+        if self._refreshing is None or self._refreshing.done():
+            self._refreshing = asyncio.create_task(self._do_refresh())
+            self._refreshing.add_done_callback(_log_refresh_error)
+        return self._refreshing
+
+    def _adopt(self, token: str, ttl_ms: int) -> str:
+        now = time.time()
+        self._token = token
+        self._expires_at = now + ttl_ms / 1000
+        self._next_refresh_at = max(self._expires_at - self.refresh_ahead, now + _MIN_REFRESH_INTERVAL_S)
+        return token
+
+    def _usable(self, token: Optional[str], pttl: int) -> bool:
+        return bool(token) and token != self._invalidated and pttl > 0
+
+    async def _do_refresh(self) -> str:
+        stale = self._token
+        token, pttl = await async_get_access_token()
+        # 其他 Worker 已刷新过 (与手上的不同或仍远离过期)，直接采用
+        if self._usable(token, pttl) and (token != stale or pttl > self.refresh_ahead * 1000):
+            return self._adopt(token, pttl)
+
+        owner = uuid.uuid4().hex
+        while True:
+            if await async_acquire_token_lease(owner, self.lease_ms):
+                try:
+                    return await self._fetch_and_store()
+                finally:
+                    await async_release_token_lease(owner)
+            # 其他 Worker 正在刷新：等它释放租约后读取结果
+            while await async_token_lease_held():
+                await asyncio.sleep(0.05)
+            token, pttl = await async_get_access_token()
+            if self._usable(token, pttl):
+                return self._adopt(token, pttl)
+
+    async def _fetch_and_store(self) -> str:
+        start = time.perf_counter()
+        resp = await get_async_client(UPSTREAM_WEWORK).get(
+            WEWORK_TOKEN_API, params={"corpid": WEWORK_CORPID, "corpsecret": WEWORK_CORPSECRET}
+        )
+        data = resp.json()
+        metrics.observe("wework_token_fetch_seconds", time.perf_counter() - start)
+        if data.get("errcode") != 0 or not data.get("access_token"):
+            metrics.incr("wework_token_fetch_total", result="error")
+            raise AccessTokenError(f"获取 access_token 失败: errcode={data.get('errcode')}, errmsg={data.get('errmsg')}")
+        metrics.incr("wework_token_fetch_total", result="ok")
+        ttl_ms = max(int(data.get("expires_in", 7200)) - _EXPIRY_SAFETY_S, 1) * 1000
+        await async_set_access_token(data["access_token"], ttl_ms)
+        LOGGER.info(f"[access_token] 已刷新，有效期 {ttl_ms // 1000}s")
+        return self._adopt(data["access_token"], ttl_ms)
+
+    async def _refresh_loop(self):
+        while True:
+            delay = self._next_refresh_at - time.time()
+            if delay > 0:
+                # 分段休眠，token 被作废或由请求路径刷新后能及时重新计算
+                await asyncio.sleep(min(delay, 60))
+                continue
+            try:
+                await self.refresh()
+            except Exception as e:
+                LOGGER.error(f"[access_token] 后台刷新失败，5 秒后重试: {e}")
+                await asyncio.sleep(5)
+
+    def start(self):
+        """启动后台提前刷新协程 (lifespan 启动时调用)"""
+        if self._loop_task is None:
+            self._loop_task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self):
+        tasks = [t for t in (self._loop_task, self._refreshing) if t is not None]
+        self._loop_task = self._refreshing = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def _errcode(resp: httpx.Response) -> Optional[int]:
+    # 只解析 JSON 响应 (media/get 成功时返回的是文件内容)
+    if "json" not in resp.headers.get("Content-Type", "") and "text" not in resp.headers.get("Content-Type", ""):
+        return None
+    try:
+        return resp.json().get("errcode")
+    except ValueError:
+        return None
+
+
+def _log_refresh_error(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        LOGGER.error(f"[access_token] 刷新失败: {task.exception()}")
+
+
+access_tokens = AccessTokenManager(WEWORK_TOKEN_REFRESH_AHEAD, WEWORK_TOKEN_LEASE_MS)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- encoding:utf-8 -*-
+
+""" 企业微信回调消息加解密 (可复用上下文版)
+
+与 wx_biz_json_msg_crypt.py 的区别：
+- 每个企业只构造一次，EncodingAESKey / IV / 签名 Token / ReceiveId 预先解码缓存
+- 解密使用 memoryview 切片，避免多次拷贝，且不打印任何调试信息
+- 签名校验使用常量时间比较 (hmac.compare_digest)
+注意：AES-CBC 的 cipher 对象带链式状态，不能跨消息复用，每条消息仍需新建 (成本很低)
+"""
+
+import base64
+import functools
+import hashlib
+import hmac
+import os
+import struct
+from typing import Optional, Tuple
+
+from Crypto.Cipher import AES
+
+import ierror
+
+
+class WXCryptoContext(object):
+    """企业微信回调加解密上下文 (线程安全，只读)"""
+
+    __slots__ = ("token", "key", "iv", "receive_id")
+
+    def __init__(self, sToken: str, sEncodingAESKey: str, sReceiveId: str):
+        key = base64.b64decode(sEncodingAESKey + "=")
+        if len(key) != 32:
+            raise ValueError("[error]: EncodingAESKey unvalid !")
+        self.token = sToken
+        self.key = key
+        self.iv = key[:16]
+        self.receive_id = sReceiveId.encode("utf-8")
+
+    def signature(self, timestamp: str, nonce: str, encrypt: str) -> str:
+        """用SHA1算法生成安全签名"""
+        sortlist = sorted((self.token, timestamp, nonce, encrypt))
+        return hashlib.sha1("".join(sortlist).encode("utf-8")).hexdigest()
+
+    def verify_signature(self, msg_signature: str, timestamp: str, nonce: str, encrypt: str) -> bool:
+        """常量时间比较签名，避免计时侧信道"""
+        expected = self.signature(timestamp, nonce, encrypt)
+        return hmac.compare_digest(expected.encode("ascii"), (msg_signature or "").encode("ascii", "ignore"))
+
+    def decrypt(self, encrypt: str) -> Tuple[int, Optional[str]]:
+        """
+        解密密文
+        @return: (错误码, 明文)，成功时错误码为 0
+        """
+        try:
+            plain_text = AES.new(self.key, AES.MODE_CBC, self.iv).decrypt(base64.b64decode(encrypt))
+        except Exception:
+            return ierror.WXBizMsgCrypt_DecryptAES_Error, None
+        try:
+            pad = plain_text[-1]
+            if pad < 1 or pad > 32:
+                return ierror.WXBizMsgCrypt_IllegalBuffer, None
+            # 16位随机字符串 + 4字节网络序长度 + 明文 + ReceiveId + 补位
+            content = memoryview(plain_text)[16:len(plain_text) - pad]
+            msg_len = int.from_bytes(content[:4], "big")
+            msg = content[4:4 + msg_len]
+            from_receive_id = content[4 + msg_len:]
+        except Exception:
+            return ierror.WXBizMsgCrypt_IllegalBuffer, None
+        if from_receive_id != self.receive_id:
+            return ierror.WXBizMsgCrypt_ValidateCorpid_Error, None
+        try:
+            return ierror.WXBizMsgCrypt_OK, str(msg, "utf-8")
+        except UnicodeDecodeError:
+            return ierror.WXBizMsgCrypt_IllegalBuffer, None
+
+    def encrypt(self, text: str) -> str:
+        """加密明文 (用于被动回复或本地构造测试数据)"""
+        raw = text.encode("utf-8")
+        data = os.urandom(16) + struct.pack("!I", len(raw)) + raw + self.receive_id
+        pad = 32 - len(data) % 32
+        data += bytes([pad]) * pad
+        return base64.b64encode(AES.new(self.key, AES.MODE_CBC, self.iv).encrypt(data)).decode("ascii")
+
+    def decrypt_msg(self, encrypt: str, sMsgSignature: str, sTimeStamp: str, sNonce: str) -> Tuple[int, Optional[str]]:
+        """检验消息的真实性，并且获取解密后的明文 (与 WXBizJsonMsgCrypt.DecryptMsg 返回值一致)"""
+        if not self.verify_signature(sMsgSignature, sTimeStamp, sNonce, encrypt):
+            return ierror.WXBizMsgCrypt_ValidateSignature_Error, None
+        return self.decrypt(encrypt)
+
+    def verify_url(self, sMsgSignature: str, sTimeStamp: str, sNonce: str, sEchoStr: str) -> Tuple[int, Optional[str]]:
+        """验证URL (与 WXBizJsonMsgCrypt.VerifyURL 返回值一致)"""
+        return self.decrypt_msg(sEchoStr, sMsgSignature, sTimeStamp, sNonce)
+
+
+@functools.lru_cache(maxsize=None)
+def get_crypto_context(sToken: str, sEncodingAESKey: str, sReceiveId: str) -> WXCryptoContext:
+    """按企业缓存加解密上下文，进程内只构造一次"""
+    return WXCryptoContext(sToken, sEncodingAESKey, sReceiveId)
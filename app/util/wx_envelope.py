@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- encoding:utf-8 -*-
+
+""" 企业微信客服回调信封解码
+
+回调请求体 -> 验签解密 -> (Token, OpenKfId, CreateTime) 一次完成：
+不构建 ElementTree，也不经过两层 pydantic 模型，只按固定标签切片取值；
+超长或格式错误的请求体在解密前即被拒绝。
+"""
+
+from typing import NamedTuple, Optional, Tuple
+
+import ierror
+from util.wx_crypto import WXCryptoContext
+
+# 回调请求体通常不足 1KB，超过该值直接拒绝
+DEFAULT_MAX_BODY_BYTES = 16 * 1024
+
+_CDATA_OPEN = "<![CDATA["
+_CDATA_CLOSE = "]]>"
+_ENCRYPT_OPEN, _ENCRYPT_CLOSE = b"<Encrypt>", b"</Encrypt>"
+_CDATA_OPEN_B, _CDATA_CLOSE_B = _CDATA_OPEN.encode(), _CDATA_CLOSE.encode()
+
+
+class CallbackEnvelope(NamedTuple):
+    """kf_msg_or_event 回调携带的同步凭证 (字段名与 WeChatTokenMessage 保持一致)"""
+    Token: str
+    OpenKfId: str
+    CreateTime: int
+
+
+def _extract_encrypt(body: bytes) -> Optional[str]:
+    start = body.find(_ENCRYPT_OPEN)
+    if start < 0:
+        return None
+    start += len(_ENCRYPT_OPEN)
+    end = body.find(_ENCRYPT_CLOSE, start)
+    if end < 0:
+        return None
+    if body.startswith(_CDATA_OPEN_B, start) and body.endswith(_CDATA_CLOSE_B, start, end):
+        start, end = start + len(_CDATA_OPEN_B), end - len(_CDATA_CLOSE_B)
+    try:
+        return body[start:end].decode("ascii")
+    except UnicodeDecodeError:
+        return None
+
+
+def _extract_text(xml: str, tag: str) -> Optional[str]:
+    open_tag = f"<{tag}>"
+    start = xml.find(open_tag)
+    if start < 0:
+        return None
+    start += len(open_tag)
+    end = xml.find(f"</{tag}>", start)
+    if end < 0:
+        return None
+    if xml.startswith(_CDATA_OPEN, start) and xml.endswith(_CDATA_CLOSE, start, end):
+        return xml[start + len(_CDATA_OPEN):end - len(_CDATA_CLOSE)]
+    return xml[start:end]
+
+
+def decode_callback(ctx: WXCryptoContext, body: bytes, msg_signature: str, timestamp: str, nonce: str,
+                    max_bytes: int = DEFAULT_MAX_BODY_BYTES) -> Tuple[int, Optional[CallbackEnvelope]]:
+    """
+    解码回调请求体
+    @return: (错误码, CallbackEnvelope)，成功时错误码为 0
+    """
+    if len(body) > max_bytes:
+        return ierror.WXBizMsgCrypt_IllegalBuffer, None
+    encrypt = _extract_encrypt(body)
+    if not encrypt:
+        return ierror.WXBizMsgCrypt_ParseJson_Error, None
+
+    ret, xml = ctx.decrypt_msg(encrypt, msg_signature, timestamp, nonce)
+    if ret != ierror.WXBizMsgCrypt_OK:
+        return ret, None
+
+    token = _extract_text(xml, "Token")
+    open_kfid = _extract_text(xml, "OpenKfId")
+    create_time = _extract_text(xml, "CreateTime")
+    if not token or not open_kfid or not create_time or not create_time.isdigit():
+        return ierror.WXBizMsgCrypt_ParseJson_Error, None
+    return ierror.WXBizMsgCrypt_OK, CallbackEnvelope(token, open_kfid, int(create_time))
@@ -1,9 +1,8 @@
 #
 import json
 import time
-from typing import List
+from typing import AsyncIterator, List
 import os
-from fastapi import Request
 from config import (
     LOGGER,
     WEWORK_CORPID,
@@ -14,51 +13,48 @@ from config import (
     TEMP_IMAGE_DIR,
     SERVER_BASE_URL,
     REDIS_CLIENT,
+    SYNC_PAGE_LIMIT,
+    COZE_REPLY_DEADLINE_S,
 )
-import requests
-import httpx  # 引入 httpx
 import asyncio
-import xml.etree.ElementTree as ET
-from kv import get_msg_retry, set_cursor, set_msg_retry
-from schema import WeChatMessage, WechatMsgEntity, WechatMsgSendEntity
-from util.wx_biz_json_msg_crypt import WXBizJsonMsgCrypt
-from ai import ai_reply, ai_reply_coze, async_ai_reply_coze
+from kv import set_cursor, async_set_cursor, get_msg_state, set_msg_state, async_get_msg_state, async_set_msg_state, \
+    async_get_reply_progress, async_set_reply_progress, MSG_STATE_PROCESSING, MSG_STATE_DONE, ACCESS_TOKEN_KEY
+from schema import WechatMsgEntity, WechatMsgSendEntity
+from reply_segmenter import split_text
+from http_clients import get_session, UPSTREAM_WEWORK
+from token_manager import access_tokens
+import send_dispatcher
+from util.wx_crypto import WXCryptoContext, get_crypto_context
+from ai import ai_reply_coze, async_ai_reply_coze
 from call_coze_api import get_or_create_latest_conversation, call_coze_workflow, get_or_create_internal_user
 
 
-async def parse_wechat_message(request: Request) -> WeChatMessage:
-    body = await request.body()
-    xml_data = body.decode('utf-8')
-    root = ET.fromstring(xml_data)
-
-    message_dict = {
-        'ToUserName': root.find('ToUserName').text,
-        'AgentID': root.find('AgentID').text,
-        'Encrypt': root.find('Encrypt').text
-    }
-
-    return WeChatMessage(**message_dict)
+def get_wework_crypto() -> WXCryptoContext:
+    """当前企业的回调加解密上下文 (进程内缓存，key/IV 只解码一次)"""
+    return get_crypto_context(WEWORK_TOKEN, WEWORK_ENCODING_AES_KEY, WEWORK_CORPID)
 
 
 # 检查签名
 def check_signature(msg_signature, timestamp, nonce, echostr):
-    msg_crypt = WXBizJsonMsgCrypt(WEWORK_TOKEN, WEWORK_ENCODING_AES_KEY, WEWORK_CORPID)
-    ret, sEchoStr = msg_crypt.VerifyURL(msg_signature, timestamp, nonce, echostr)
+    ret, sEchoStr = get_wework_crypto().verify_url(msg_signature, timestamp, nonce, echostr)
     return ret, sEchoStr
 
 
-def select_msgs(cursor: str, token: str) -> List[WechatMsgEntity]:
-    resp = requests.post(
+def select_msgs(cursor: str, token: str, open_kfid: str = None) -> List[WechatMsgEntity]:
+    payload = {
+        "limit": 1000,
+        "token": token
+    }
+    if open_kfid:
+        payload["open_kfid"] = open_kfid
+    if cursor:
+        payload["cursor"] = cursor.decode('utf-8') if isinstance(cursor, bytes) else cursor
+    resp = get_session(UPSTREAM_WEWORK).post(
         "https://qyapi.weixin.qq.com/cgi-bin/kf/sync_msg",
         params={
             "access_token": _cachable_token()
         },
-        data=json.dumps(
-            {
-                "limit": 1000,
-                "token": token
-            }
-        )
+        data=json.dumps(payload)
     )
     resp_data = resp.json()
     msgs = resp_data.get("msg_list", [])
@@ -74,11 +70,80 @@ def select_msgs(cursor: str, token: str) -> List[WechatMsgEntity]:
     ]
 
     if next_cursor and has_more == 1:
-        set_cursor(next_cursor)
+        set_cursor(next_cursor, open_kfid)
 
     return msg_entities, has_more == 1, next_cursor
 
 
+class SyncMsgError(RuntimeError):
+    """kf/sync_msg 未成功返回 (HTTP 5xx、响应不是 JSON、errcode 非 0)，调用方应保留待同步标记并重试"""
+    pass
+
+
+def _to_msg_entity(msg: dict) -> WechatMsgEntity:
+    return WechatMsgEntity(
+        **{k: v for k, v in msg.items() if k not in ['open_kfid', 'external_userid']},
+        open_kfid=msg.get('open_kfid', ''),
+        external_userid=msg.get('external_userid', '')
+    )
+
+
+async def async_iter_msg_pages(token: str, cursor: str = None,
+                               open_kfid: str = None) -> AsyncIterator[List[WechatMsgEntity]]:
+    """
+    [异步版] 按 cursor 分页拉取微信客服消息 (kf/sync_msg)，逐页 yield
+
+    - 携带上次保存的 cursor，沿 next_cursor / has_more 一页一页往后拉，不再只取第一页
+    - 每次只持有当前一页，积压再多内存占用也只有一页
+    - 一页消费完后才保存 next_cursor，中途异常下次会从该页重新拉取 (由去重兜底)
+    - 指定 open_kfid 时只拉取该客服账号的消息，cursor 也按客服账号分开保存
+    - 接口失败时抛出 SyncMsgError (网络异常为 httpx.HTTPError)，不会当作已经拉完而静默结束
+    """
+    if isinstance(cursor, bytes):
+        cursor = cursor.decode('utf-8')
+    while True:
+        payload = {
+            "limit": SYNC_PAGE_LIMIT,
+            "token": token
+        }
+        if open_kfid:
+            payload["open_kfid"] = open_kfid
+        if cursor:
+            payload["cursor"] = cursor
+        # access_token 由 token_manager 异步获取，失效 (40014/42001) 时自动刷新重试
+        resp = await access_tokens.request(
+            "POST",
+            "https://qyapi.weixin.qq.com/cgi-bin/kf/sync_msg",
+            json=payload
+        )
+        if resp.status_code >= 500:
+            raise SyncMsgError(f"sync_msg HTTP {resp.status_code}: {resp.text[:200]}")
+        try:
+            resp_data = resp.json()
+        except ValueError:
+            raise SyncMsgError(f"sync_msg 响应不是 JSON: HTTP {resp.status_code}, {resp.text[:200]}")
+        if resp_data.get("errcode", 0) != 0:
+            raise SyncMsgError(f"sync_msg 失败: errcode={resp_data.get('errcode')}, errmsg={resp_data.get('errmsg')}")
+
+        yield [_to_msg_entity(msg) for msg in resp_data.get("msg_list", [])]
+
+        next_cursor = resp_data.get("next_cursor")
+        if next_cursor:
+            await async_set_cursor(next_cursor, open_kfid)
+            cursor = next_cursor
+        if resp_data.get("has_more", 0) != 1 or not next_cursor:
+            return
+
+
+async def async_iter_msgs(token: str, cursor: str = None, open_kfid: str = None) -> AsyncIterator[WechatMsgEntity]:
+    """
+    [异步版] 同 async_iter_msg_pages，但逐条 yield
+    """
+    async for page in async_iter_msg_pages(token, cursor, open_kfid):
+        for msg in page:
+            yield msg
+
+
 # 发送消息给用户
 def send_text_msg(msg_id, external_user_id, kf_id, content):
     _send_msg(
@@ -95,7 +160,7 @@ def send_text_msg(msg_id, external_user_id, kf_id, content):
 
 def _send_msg(entity: WechatMsgSendEntity):
     payload = entity.model_dump_json()
-    resp = requests.post(
+    resp = get_session(UPSTREAM_WEWORK).post(
         "https://qyapi.weixin.qq.com/cgi-bin/kf/send_msg",
         params={
             "access_token": _cachable_token()
@@ -128,38 +193,49 @@ async def async_send_text_msg(msg_id, external_user_id, kf_id, content):
     return await _async_send_msg(entity)
 
 
-# ✅ 底层异步发送实现
+# ✅ 底层异步发送实现：交给发送调度 (令牌桶限流 + 限频错误码退避重试)
 async def _async_send_msg(entity: WechatMsgSendEntity):
-    url = "https://qyapi.weixin.qq.com/cgi-bin/kf/send_msg"
-
-    # 获取 Token (Redis 操作通常很快，这里混用同步的 cached token 函数问题不大)
-    # 如果追求极致，_cachable_token 最好也改成 async 的，但目前瓶颈主要在网络 IO
-    token = _cachable_token()
-    params = {"access_token": token}
+    return await send_dispatcher.send(entity)
 
-    # 3. 序列化：使用 Pydantic 转为字典，让 httpx 处理 JSON 编码
-    # 或者使用 entity.model_dump_json() 获取字符串然后传给 content 参数
-    # 这里推荐用 json=entity.model_dump()，httpx 会自动处理 Content-Type
-    payload = entity.model_dump()
 
-    async with httpx.AsyncClient() as client:
-        try:
-            resp = await client.post(url, params=params, json=payload)
+class ReplySender:
+    """
+    一次回复的分段发送 (文本回复与图片回复共用)
+    - send_text：整段回复按企业微信文本消息上限 (2048 字节) 切分后逐段发送
+    - send_segment：发送一个分段 (渐进式回复的分段已由 ReplySegmenter 控制在上限内)
+    - 每发出一段把已发出的分段数记入 Redis (以 msgid 标识)，任务崩溃后重新投递时跳过用户已经收到的分段
+    """
 
-            # 简单的日志记录
-            if resp.status_code != 200:
-                LOGGER.error(f"Async send failed: {resp.text}")
-            else:
-                LOGGER.info(f"Async send success: {resp.json().get('errmsg', 'ok')}")
+    def __init__(self, msgid: str, external_userid: str, open_kfid: str, already_sent: int = 0):
+        self.msgid = msgid
+        self.external_userid = external_userid
+        self.open_kfid = open_kfid
+        self.already_sent = already_sent
+        # 本次回复累计的分段数 (含跳过的)
+        self.count = 0
+
+    @classmethod
+    async def resume(cls, msgid: str, external_userid: str, open_kfid: str) -> "ReplySender":
+        """读取该回复已发出的分段数 (首次处理为 0)"""
+        already_sent = await async_get_reply_progress(msgid)
+        if already_sent:
+            LOGGER.warning(f"[回复] 任务重新投递，跳过已发出的 {already_sent} 段: msgid={msgid}")
+        return cls(msgid, external_userid, open_kfid, already_sent)
+
+    async def send_segment(self, segment: str):
+        self.count += 1
+        if self.count <= self.already_sent:
+            return
+        await async_send_text_msg(self.msgid, self.external_userid, self.open_kfid, segment)
+        await async_set_reply_progress(self.msgid, self.count)
 
-            return resp
-        except Exception as e:
-            LOGGER.error(f"Async send exception: {e}")
-            return None
+    async def send_text(self, text: str):
+        for segment in split_text(text):
+            await self.send_segment(segment)
 
 
 # 定义 Token 在 Redis 中的 Key
-REDIS_TOKEN_KEY = "wework:access_token"
+REDIS_TOKEN_KEY = ACCESS_TOKEN_KEY
 TOKEN_TTL = 7000  # 微信有效期 7200秒，我们设短一点留余量
 
 
@@ -190,7 +266,7 @@ def _cachable_token():
 
 def _wework_token():
     # ... (保持原来的逻辑不变) ...
-    response = requests.get(
+    response = get_session(UPSTREAM_WEWORK).get(
         WEWORK_TOKEN_API,
         params={"corpid": WEWORK_CORPID, "corpsecret": WEWORK_CORPSECRET},
     )
@@ -217,7 +293,7 @@ def download_wechat_image(media_id: str, msg_id: str, access_token: str) -> str:
     }
 
     try:
-        response = requests.get(url, params=params)
+        response = get_session(UPSTREAM_WEWORK).get(url, params=params)
         response.raise_for_status()
 
         # 简单判断一下是否真的是图片（微信有时候会返回json错误）
@@ -249,7 +325,7 @@ def handle_image_msg(msg, token):
     """
     try:
         # 1. 再次检查重试 (双重保险)
-        # if get_msg_retry(msg.msgid) == "done": return
+        # if get_msg_state(msg.msgid) == MSG_STATE_DONE: return
 
         media_id = msg.image.get('media_id')
 
@@ -274,8 +350,9 @@ def handle_image_msg(msg, token):
 
 
 def reply_msg(msgid: str, external_userid: str, open_kfid: str, content: str):
-    if get_msg_retry(msgid) == b'0':
+    if get_msg_state(msgid) == MSG_STATE_DONE:
         return
+    set_msg_state(msgid, MSG_STATE_PROCESSING)
     '''添加(修改)'''
     # 用户ID = external_userid
     user_id = external_userid
@@ -283,17 +360,18 @@ def reply_msg(msgid: str, external_userid: str, open_kfid: str, content: str):
     print("=" * 80, "Coze 智能体回复处理中", "=" * 80)
 
     # 每个用户绑定独立 conversation_id
-    conversation_id = get_or_create_latest_conversation(user_id)
+    conversation_id = get_or_create_latest_conversation(user_id, open_kfid)
 
-    # 调用 Coze 工作流
+    # 调用 Coze 工作流 (与会话使用同一个客服账号对应的机器人)
     reply_text = ai_reply_coze(
         content=content,
         user_id=user_id,
-        conversation_id=conversation_id
+        conversation_id=conversation_id,
+        open_kfid=open_kfid
     )
     print("=" * 80, "Coze 智能体回复完成", "=" * 80)
     send_text_msg(msgid, external_userid, open_kfid, reply_text)
-    set_msg_retry(msgid, 0)
+    set_msg_state(msgid, MSG_STATE_DONE)
 
 
 '''
@@ -301,44 +379,42 @@ def reply_msg(msgid: str, external_userid: str, open_kfid: str, content: str):
 '''
 
 
-async def async_download_wechat_image(media_id: str, msg_id: str, access_token: str) -> str:
+async def async_download_wechat_image(media_id: str, msg_id: str) -> str:
     """
     [异步版] 下载微信图片到本地 static 目录，并返回可访问的 HTTP URL
     """
     url = f"https://qyapi.weixin.qq.com/cgi-bin/media/get"
     params = {
-        "access_token": access_token,
         "media_id": media_id
     }
 
     try:
-        # ✅ 改动1: 使用 httpx 进行异步网络请求
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url, params=params)
-
-            # httpx 的错误检查
-            if response.status_code != 200:
-                LOGGER.error(f"下载图片网络请求失败: {response.status_code}")
-                return None
-
-            # 简单判断 Content-Type (注意：httpx headers key 是不区分大小写的)
-            content_type = response.headers.get("Content-Type", "")
-            if "application/json" in content_type:
-                LOGGER.error(f"下载图片失败，微信返回不是图片: {response.text}")
-                return None
-
-            # 保存图片路径
-            file_name = f"{msg_id}.jpg"
-            file_path = os.path.join(TEMP_IMAGE_DIR, file_name)
-
-            # ✅ 改动2: 文件写入是阻塞操作，必须扔到线程池里，否则会卡死整个 Event Loop
-            # 使用 asyncio.to_thread (Python 3.9+) 将同步写入变为异步等待
-            await asyncio.to_thread(_save_file_sync, file_path, response.content)
-
-            # 生成外部可访问的 URL
-            public_url = f"{SERVER_BASE_URL}/{TEMP_IMAGE_DIR}/{file_name}"
-            LOGGER.info(f"图片已异步转存: {public_url}")
-            return public_url
+        # ✅ 改动1: 使用 httpx 进行异步网络请求 (access_token 由 token_manager 注入)
+        response = await access_tokens.request("GET", url, params=params)
+
+        # httpx 的错误检查
+        if response.status_code != 200:
+            LOGGER.error(f"下载图片网络请求失败: {response.status_code}")
+            return None
+
+        # 简单判断 Content-Type (注意：httpx headers key 是不区分大小写的)
+        content_type = response.headers.get("Content-Type", "")
+        if "application/json" in content_type:
+            LOGGER.error(f"下载图片失败，微信返回不是图片: {response.text}")
+            return None
+
+        # 保存图片路径
+        file_name = f"{msg_id}.jpg"
+        file_path = os.path.join(TEMP_IMAGE_DIR, file_name)
+
+        # ✅ 改动2: 文件写入是阻塞操作，必须扔到线程池里，否则会卡死整个 Event Loop
+        # 使用 asyncio.to_thread (Python 3.9+) 将同步写入变为异步等待
+        await asyncio.to_thread(_save_file_sync, file_path, response.content)
+
+        # 生成外部可访问的 URL
+        public_url = f"{SERVER_BASE_URL}/{TEMP_IMAGE_DIR}/{file_name}"
+        LOGGER.info(f"图片已异步转存: {public_url}")
+        return public_url
 
     except Exception as e:
         LOGGER.error(f"图片异步下载异常: {e}")
@@ -355,32 +431,26 @@ async def async_handle_image(msg):
     """
     [异步版] 专门在后台任务中处理图片：获取Token -> 下载 -> 调用AI回复
     """
+    # 回复截止时间从开始处理 (含下载耗时) 起算，重新投递的任务同样有完整的时间预算
+    deadline = time.time() + COZE_REPLY_DEADLINE_S
     try:
         media_id = msg.image.get('media_id')
 
-        # 1. 获取 Token
-        # (Redis读取非常快，毫秒级，这里混用同步函数通常没问题)
-        # (如果追求极致，也可以把 _cachable_token 改为 async)
-        api_access_token = _cachable_token()
-
-        if not api_access_token:
-            LOGGER.error("无法获取有效的 Access Token")
-            return
-
-        # 2. ✅ 异步下载图片 (释放 CPU 给其他请求)
-        image_url = await async_download_wechat_image(media_id, msg.msgid, api_access_token)
+        # 1. ✅ 异步下载图片 (释放 CPU 给其他请求，access_token 由 token_manager 异步获取)
+        image_url = await async_download_wechat_image(media_id, msg.msgid)
 
         if image_url:
             LOGGER.info(f"下载成功，准备调用回复: {image_url}")
 
-            # 3. ✅ 调用异步回复函数 (async_reply_msg 必须已经是 async def)
+            # 2. ✅ 调用异步回复函数 (async_reply_msg 必须已经是 async def)
             # 注意：这里调用的是上一轮修改过的 async_reply_msg
             # content 参数传入提示语，image_url 传给 AI 进行分析（如果 AI 支持）
             await async_reply_msg(
                 msgid=msg.msgid,
                 external_userid=msg.external_userid,
                 open_kfid=msg.open_kfid,
-                content=image_url  # 这里你可以决定是传 URL 还是传 "用户发送了一张图片"
+                content=image_url,  # 这里你可以决定是传 URL 还是传 "用户发送了一张图片"
+                deadline=deadline
             )
         else:
             LOGGER.error(f"图片下载失败: {msg.msgid}")
@@ -390,11 +460,11 @@ async def async_handle_image(msg):
 
 
 # ✅ 修改后的异步函数
-async def async_reply_msg(msgid: str, external_userid: str, open_kfid: str, content: str):
+async def async_reply_msg(msgid: str, external_userid: str, open_kfid: str, content: str, deadline: float = None):
     # 1. 这里的判断逻辑保留您的写法
-    # 注意：get_msg_retry 是同步 Redis 操作，速度很快，这里暂时不用改异步
-    if get_msg_retry(msgid) == b'0':
+    if await async_get_msg_state(msgid) == MSG_STATE_DONE:
         return
+    await async_set_msg_state(msgid, MSG_STATE_PROCESSING)
 
     # =========================================================
     # ✅ 步骤 A: 身份转换 (External ID -> Internal ID)
@@ -431,7 +501,8 @@ async def async_reply_msg(msgid: str, external_userid: str, open_kfid: str, cont
         content=content,
         user_id=internal_user_id,
         conversation_id=conversation_id,
-        open_kfid=open_kfid
+        open_kfid=open_kfid,
+        deadline=deadline
     )
 
     print("=" * 80, "Coze 智能体回复完成", "=" * 80)
@@ -440,7 +511,9 @@ async def async_reply_msg(msgid: str, external_userid: str, open_kfid: str, cont
     # ✅ 步骤 D: 发送消息 (⚠️ 必须使用 External ID)
     # =========================================================
     # 发给微信接口时，微信只认 external_userid，千万别传内部 ID 过去
-    await async_send_text_msg(msgid, external_userid, open_kfid, reply_text)
+    # 与文本回复共用分段发送：超过 2048 字节的回复按上限切分，重新投递时跳过已发出的分段
+    sender = await ReplySender.resume(msgid, external_userid, open_kfid)
+    await sender.send_text(reply_text)
 
     # 5. 更新状态
-    set_msg_retry(msgid, 0)
\ No newline at end of file
+    await async_set_msg_state(msgid, MSG_STATE_DONE)
\ No newline at end of file
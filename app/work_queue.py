@@ -0,0 +1,161 @@
+import asyncio
+import json
+import os
+import socket
+from typing import Awaitable, Callable, Dict, List
+
+from redis.exceptions import ResponseError
+
+import metrics
+from config import LOGGER, ASYNC_REDIS_CLIENT, WORK_QUEUE_MODE, WORK_QUEUE_STREAM, WORK_QUEUE_GROUP, \
+    WORK_QUEUE_MAXLEN, WORK_QUEUE_VISIBILITY_MS, WORK_QUEUE_MAX_DELIVERIES
+from sync_pipeline import spawn
+
+'''
+回复任务队列
+
+- memory 模式：任务在当前 Worker 内以后台协程执行 (旧行为，进程重启会丢任务)
+- redis  模式：任务写入 Redis Stream，由消费者组里的任意进程消费 (可以是 API Worker，也可以是独立的 worker.py)
+  * 处理成功后显式 XACK
+  * 超过可见性超时仍未 ACK 的任务由 XAUTOCLAIM 回收重新处理 (进程被杀、超时重启都不会丢)
+  * 投递次数超过上限的任务转入死信 Stream，避免毒消息无限重试
+'''
+
+JobHandler = Callable[[dict], Awaitable[None]]
+
+_handlers: Dict[str, JobHandler] = {}
+_consumers: List[asyncio.Task] = []
+DEAD_LETTER_STREAM = f"{WORK_QUEUE_STREAM}:dead"
+
+
+def register_handler(kind: str, handler: JobHandler):
+    """注册任务处理函数，kind 为任务类型"""
+    _handlers[kind] = handler
+
+
+async def dispatch_job(kind: str, payload: dict):
+    """
+    提交一个任务：memory 模式直接在本进程后台执行，redis 模式写入 Stream
+    """
+    if WORK_QUEUE_MODE != "redis":
+        spawn(_handlers[kind](payload))
+        return
+    await ASYNC_REDIS_CLIENT.xadd(
+        WORK_QUEUE_STREAM,
+        {"kind": kind, "payload": json.dumps(payload, ensure_ascii=False)},
+        maxlen=WORK_QUEUE_MAXLEN,
+        approximate=True,
+    )
+    metrics.incr("work_queue_enqueued_total", kind=kind)
+
+
+async def _ensure_group():
+    try:
+        await ASYNC_REDIS_CLIENT.xgroup_create(WORK_QUEUE_STREAM, WORK_QUEUE_GROUP, id="0", mkstream=True)
+    except ResponseError as e:
+        # 消费者组已存在
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+async def _handle_entry(entry_id, fields: dict):
+    kind = fields.get(b"kind", b"").decode("utf-8")
+    handler = _handlers.get(kind)
+    if handler is None:
+        LOGGER.error(f"[WorkQueue] 未知任务类型，直接确认丢弃: id={entry_id}, kind={kind}")
+        await ASYNC_REDIS_CLIENT.xack(WORK_QUEUE_STREAM, WORK_QUEUE_GROUP, entry_id)
+        return
+    try:
+        payload = json.loads(fields[b"payload"])
+        await handler(payload)
+    except asyncio.CancelledError:
+        # 进程退出：不 ACK，等可见性超时后由其他消费者回收
+        raise
+    except Exception as e:
+        # 处理失败：不 ACK，等可见性超时后重试
+        LOGGER.error(f"[WorkQueue] 任务处理失败，等待重试: id={entry_id}, kind={kind}, error={e}")
+        metrics.incr("work_queue_failed_total", kind=kind)
+        return
+    await ASYNC_REDIS_CLIENT.xack(WORK_QUEUE_STREAM, WORK_QUEUE_GROUP, entry_id)
+    metrics.incr("work_queue_acked_total", kind=kind)
+
+
+async def _consume(consumer: str):
+    while True:
+        try:
+            resp = await ASYNC_REDIS_CLIENT.xreadgroup(
+                WORK_QUEUE_GROUP, consumer, {WORK_QUEUE_STREAM: ">"}, count=1, block=5000
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            LOGGER.error(f"[WorkQueue] 读取任务失败: {e}")
+            await asyncio.sleep(1)
+            continue
+        for _, entries in resp or []:
+            for entry_id, fields in entries:
+                await _handle_entry(entry_id, fields)
+
+
+async def _dead_letter(entry_id, fields: dict, deliveries: int):
+    LOGGER.error(f"[WorkQueue] 任务投递 {deliveries} 次仍失败，转入死信队列: id={entry_id}")
+    await ASYNC_REDIS_CLIENT.xadd(DEAD_LETTER_STREAM, {**fields, b"source_id": entry_id}, maxlen=WORK_QUEUE_MAXLEN,
+                                  approximate=True)
+    await ASYNC_REDIS_CLIENT.xack(WORK_QUEUE_STREAM, WORK_QUEUE_GROUP, entry_id)
+    metrics.incr("work_queue_dead_total")
+
+
+async def _reclaim(consumer: str):
+    """
+    回收超过可见性超时仍未确认的任务 (原消费者崩溃、被重启或处理失败)
+    """
+    while True:
+        await asyncio.sleep(WORK_QUEUE_VISIBILITY_MS / 2000)
+        try:
+            start_id = "0-0"
+            while True:
+                resp = await ASYNC_REDIS_CLIENT.xautoclaim(
+                    WORK_QUEUE_STREAM, WORK_QUEUE_GROUP, consumer,
+                    min_idle_time=WORK_QUEUE_VISIBILITY_MS, start_id=start_id, count=10
+                )
+                start_id, entries = resp[0], resp[1]
+                for entry_id, fields in entries:
+                    if fields is None:
+                        # 原始消息已被 XTRIM 裁掉
+                        await ASYNC_REDIS_CLIENT.xack(WORK_QUEUE_STREAM, WORK_QUEUE_GROUP, entry_id)
+                        continue
+                    metrics.incr("work_queue_reclaimed_total")
+                    pending = await ASYNC_REDIS_CLIENT.xpending_range(
+                        WORK_QUEUE_STREAM, WORK_QUEUE_GROUP, min=entry_id, max=entry_id, count=1
+                    )
+                    deliveries = pending[0]["times_delivered"] if pending else 1
+                    if deliveries > WORK_QUEUE_MAX_DELIVERIES:
+                        await _dead_letter(entry_id, fields, deliveries)
+                        continue
+                    LOGGER.warning(f"[WorkQueue] 回收超时任务重新处理: id={entry_id}, 第 {deliveries} 次投递")
+                    await _handle_entry(entry_id, fields)
+                if start_id in (b"0-0", "0-0"):
+                    break
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            LOGGER.error(f"[WorkQueue] 回收任务失败: {e}")
+
+
+async def start_consumers(concurrency: int):
+    """
+    启动 concurrency 个消费协程 + 1 个回收协程 (消费者名按 主机名-进程号-序号 区分)
+    """
+    await _ensure_group()
+    prefix = f"{socket.gethostname()}-{os.getpid()}"
+    for i in range(concurrency):
+        _consumers.append(asyncio.create_task(_consume(f"{prefix}-{i}")))
+    _consumers.append(asyncio.create_task(_reclaim(f"{prefix}-reclaim")))
+    LOGGER.info(f"✅ 任务队列消费者已启动: {prefix} x {concurrency}")
+
+
+async def stop_consumers():
+    for task in _consumers:
+        task.cancel()
+    await asyncio.gather(*_consumers, return_exceptions=True)
+    _consumers.clear()
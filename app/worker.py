@@ -0,0 +1,47 @@
+import asyncio
+import signal
+
+from config import LOGGER, WORK_QUEUE_MODE, WORK_QUEUE_CONSUMERS
+import work_queue
+import http_clients
+from token_manager import access_tokens
+import send_dispatcher
+import conversation_pool
+import bot_registry
+import main  # noqa: F401  导入即注册任务处理函数 (reply_text / image)
+
+'''
+独立的任务队列消费进程 (WORK_QUEUE_MODE=redis 时使用)
+
+可以在多台机器上同时运行，加入同一个消费者组，水平扩展 Coze 调用能力：
+python worker.py
+'''
+
+
+async def run():
+    if WORK_QUEUE_MODE != "redis":
+        LOGGER.error("WORK_QUEUE_MODE 不是 redis，独立消费进程无需启动")
+        return
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    await http_clients.startup()
+    access_tokens.start()
+    send_dispatcher.start_senders()
+    bot_registry.start()
+    conversation_pool.start()
+    await work_queue.start_consumers(max(WORK_QUEUE_CONSUMERS, 1))
+    await stop_event.wait()
+    LOGGER.info("🛑 收到退出信号，停止消费 (未确认的任务会被其他消费者回收)")
+    await work_queue.stop_consumers()
+    await send_dispatcher.stop_senders()
+    await conversation_pool.stop()
+    await bot_registry.stop()
+    await access_tokens.stop()
+    await http_clients.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
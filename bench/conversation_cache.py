@@ -0,0 +1,51 @@
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
+
+from sqlalchemy import event  # noqa: E402
+
+import conversation_cache  # noqa: E402
+import database_operation as db  # noqa: E402
+from call_coze_api import get_or_create_latest_conversation  # noqa: E402
+
+'''
+会话 ID 缓存基准：每条消息的 MySQL 语句数与耗时，对比直接查询 MySQL 的旧方式
+需要可连接的 MySQL 与 Redis，会临时创建并删除一个测试用户
+python bench/conversation_cache.py [消息条数]
+'''
+
+
+def main(n: int):
+    statements = [0]
+    event.listen(db.engine, "before_cursor_execute", lambda *args: statements.__setitem__(0, statements[0] + 1))
+
+    user_id = f"bench_{uuid.uuid4().hex[:12]}"
+    open_kfid = "wk_bench"
+    db.create_user({"user_id": user_id, "wechat_external_userid": user_id})
+    db.create_conversation({"conversation_id": f"conv_{user_id}", "user_id": user_id, "conversation_name": user_id,
+                            "open_kfid": open_kfid})
+    try:
+        def legacy():
+            return db.get_conversations_by_user_and_open_kfid(user_id, open_kfid)[0].conversation_id
+
+        def cached():
+            return get_or_create_latest_conversation(user_id, open_kfid)
+
+        assert legacy() == cached() == f"conv_{user_id}"
+        for name, fn in (("直接查询 MySQL (旧)", legacy), ("LRU + Redis 缓存", cached)):
+            statements[0] = 0
+            start = time.perf_counter()
+            for _ in range(n):
+                fn()
+            cost = time.perf_counter() - start
+            print(f"{name:<18} {statements[0] / n:>6.3f} 次 SQL/消息  {cost / n * 1e3:>7.3f} ms/消息")
+    finally:
+        conversation_cache.invalidate(user_id, open_kfid, f"conv_{user_id}")
+        db.delete_user(user_id)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
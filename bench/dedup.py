@@ -0,0 +1,57 @@
+import asyncio
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
+
+from config import REDIS_CLIENT, MSG_DEDUP_TTL  # noqa: E402
+from kv import async_claim_msgs, _msg_state_key  # noqa: E402
+
+'''
+去重方案基准：旧的逐条 GET + SET 对比按页一次 Lua 批量认领 (需要可连接的 Redis)
+python bench/dedup.py [消息条数]
+'''
+
+
+def used_memory() -> int:
+    return REDIS_CLIENT.info("memory")["used_memory"]
+
+
+def main(n: int, page: int = 200):
+    # 旧方案：每条消息 GET + SET 两次往返，key 无过期时间
+    old_ids = [f"bench_{uuid.uuid4().hex}" for _ in range(n)]
+    mem_before = used_memory()
+    start = time.perf_counter()
+    for msgid in old_ids:
+        if not REDIS_CLIENT.get(f"msg_retry_{msgid}"):
+            REDIS_CLIENT.set(f"msg_retry_{msgid}", int(time.time()))
+    old_cost = time.perf_counter() - start
+    old_mem = used_memory() - mem_before
+    REDIS_CLIENT.delete(*[f"msg_retry_{m}" for m in old_ids])
+
+    # 新方案：每页一次 Lua 认领，key 带状态与过期时间
+    new_ids = [f"bench_{uuid.uuid4().hex}" for _ in range(n)]
+
+    async def claim_all():
+        for i in range(0, n, page):
+            await async_claim_msgs(new_ids[i:i + page])
+
+    mem_before = used_memory()
+    start = time.perf_counter()
+    asyncio.run(claim_all())
+    new_cost = time.perf_counter() - start
+    new_mem = used_memory() - mem_before
+    REDIS_CLIENT.delete(*[_msg_state_key(m) for m in new_ids])
+
+    per_million = 1_000_000 / n
+    print(f"消息条数: {n}，每页 {page} 条")
+    print(f"旧方案 GET+SET : 往返 {2 * n} 次，耗时 {old_cost:.2f}s，"
+          f"内存 {old_mem * per_million / 1024 / 1024:.1f} MB/百万条 (永不过期)")
+    print(f"新方案 批量认领: 往返 {-(-n // page)} 次，耗时 {new_cost:.2f}s，"
+          f"内存 {new_mem * per_million / 1024 / 1024:.1f} MB/百万条 ({MSG_DEDUP_TTL}s 后过期)")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,94 @@
+import json
+import os
+import random
+import sys
+import time
+from typing import List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
+
+from util.sse import iter_sse  # noqa: E402
+
+'''
+SSE 解码基准：对比逐行 startswith("data:") + json.loads 的旧解析方式
+python bench/sse.py [每种方式解析的流数]
+'''
+
+
+def coze_stream(answer_deltas: int, seed: int = 0) -> bytes:
+    """按 Coze /v1/workflows/chat 的事件顺序构造的一段流 (回答增量 + 完成消息 + 推荐问题)"""
+    rnd = random.Random(seed)
+    words = ["您好", "关于", "产品", "价格", "规格", "我们", "支持", "专业版", "旗舰版", "，", "。", "\n"]
+    meta = {"conversation_id": "7400000000000000001", "bot_id": "7400000000000000002",
+            "chat_id": "7400000000000000003", "section_id": "7400000000000000004"}
+    out = []
+
+    def emit(event, data):
+        out.append(f"event:{event}\ndata:{json.dumps(data, ensure_ascii=False)}\n\n")
+
+    emit("conversation.chat.created", {"id": meta["chat_id"], "status": "created", **meta})
+    emit("conversation.chat.in_progress", {"id": meta["chat_id"], "status": "in_progress", **meta})
+    parts = []
+    for _ in range(answer_deltas):
+        part = "".join(rnd.choice(words) for _ in range(rnd.randint(1, 4)))
+        parts.append(part)
+        emit("conversation.message.delta", {"id": "m1", "role": "assistant", "type": "answer",
+                                            "content": part, "content_type": "text", **meta})
+    emit("conversation.message.completed", {"id": "m1", "role": "assistant", "type": "answer",
+                                            "content": "".join(parts), "content_type": "text", **meta})
+    for i in range(3):
+        emit("conversation.message.completed", {"id": f"f{i}", "role": "assistant", "type": "follow_up",
+                                                "content": f"推荐问题 {i}？", "content_type": "text", **meta})
+    emit("conversation.chat.completed", {"id": meta["chat_id"], "status": "completed", "usage": {}, **meta})
+    out.append('event:done\ndata:"[DONE]"\n\n')
+    return "".join(out).encode("utf-8")
+
+
+def split_randomly(raw: bytes, seed: int = 1, low: int = 1, high: int = 512) -> List[bytes]:
+    rnd = random.Random(seed)
+    chunks, i = [], 0
+    while i < len(raw):
+        step = rnd.randint(low, high)
+        chunks.append(raw[i:i + step])
+        i += step
+    return chunks
+
+
+def main(n: int):
+    raw = coze_stream(400)
+    reference = [e.json() for e in iter_sse([raw])]
+    chunks = split_randomly(raw, seed=2, low=256, high=4096)
+
+    def bench_legacy():
+        # 旧方式：按行读取，每一个 data 行都 json.loads，再按内容判断是否需要
+        text, answers = b"".join(chunks).decode("utf-8"), []
+        for line in text.splitlines():
+            if line.startswith("data:"):
+                try:
+                    data = json.loads(line[5:].strip())
+                except json.JSONDecodeError:
+                    continue
+                if isinstance(data, dict) and data.get("role") == "assistant":
+                    answers.append(data)
+        return answers
+
+    def bench_all_events():
+        return [e.json() for e in iter_sse(chunks)]
+
+    def bench_subscribed():
+        return [e.json() for e in iter_sse(chunks, {"conversation.message.completed", "conversation.chat.failed",
+                                                    "error", "done"})]
+
+    assert bench_subscribed()[0]["content"] == reference[-6]["content"]
+    print(f"流大小 {len(raw) / 1024:.1f} KB, {len(reference)} 个事件, {len(chunks)} 个网络块")
+    for name, fn in (("逐行 json.loads (旧)", bench_legacy), ("SSEDecoder 全部事件", bench_all_events),
+                     ("SSEDecoder 仅订阅事件", bench_subscribed)):
+        start = time.perf_counter()
+        for _ in range(n):
+            fn()
+        cost = time.perf_counter() - start
+        print(f"{name:<20} {n / cost:>8.0f} 流/秒  ({cost / n * 1e3:.2f} ms/流)")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
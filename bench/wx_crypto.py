@@ -0,0 +1,47 @@
+import contextlib
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
+
+from util.wx_biz_json_msg_crypt import WXBizJsonMsgCrypt  # noqa: E402
+from util.wx_crypto import get_crypto_context  # noqa: E402
+
+'''
+回调加解密基准：对比 wx_biz_json_msg_crypt.py 每条消息新建对象的 验签+解密 吞吐
+python bench/wx_crypto.py [消息条数]
+'''
+
+TOKEN, AES_KEY, CORP_ID = "QDG6eK", "jWmYm7qr5nMoAUwZRjGtBxmz3KA1tkAj3ykkR6q2B2C", "wx5823bf96d3bd56c7"
+
+
+def main(n: int):
+    ctx = get_crypto_context(TOKEN, AES_KEY, CORP_ID)
+    xml = ("<xml><ToUserName><![CDATA[%s]]></ToUserName><CreateTime>1700000000</CreateTime>"
+           "<MsgType><![CDATA[event]]></MsgType><Event><![CDATA[kf_msg_or_event]]></Event>"
+           "<Token><![CDATA[ENCApHxnGDNAVNY4AaSJKj4Tb5mwsEMzxhFmHVGcra996NR]]></Token>"
+           "<OpenKfId><![CDATA[wkxxxxxxxxxxxxxxxxxx]]></OpenKfId></xml>") % CORP_ID
+    encrypt = ctx.encrypt(xml)
+    timestamp, nonce = "1700000000", "1372623149"
+    signature = ctx.signature(timestamp, nonce, encrypt)
+
+    def bench_legacy():
+        # 旧路径：每条消息新建 WXBizJsonMsgCrypt (含 base64 解码 key)，解密时打印密文
+        with contextlib.redirect_stdout(io.StringIO()):
+            WXBizJsonMsgCrypt(TOKEN, AES_KEY, CORP_ID).DecryptMsg(encrypt, signature, timestamp, nonce)
+
+    def bench_context():
+        get_crypto_context(TOKEN, AES_KEY, CORP_ID).decrypt_msg(encrypt, signature, timestamp, nonce)
+
+    for name, fn in (("wx_biz_json_msg_crypt", bench_legacy), ("wx_crypto", bench_context)):
+        start = time.perf_counter()
+        for _ in range(n):
+            fn()
+        cost = time.perf_counter() - start
+        print(f"{name:<22} {n / cost:>10.0f} 条/秒  ({cost / n * 1e6:.1f} µs/条)")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
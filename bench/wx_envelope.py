@@ -0,0 +1,58 @@
+import contextlib
+import io
+import os
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
+
+from schema import WeChatMessage, WeChatTokenMessage  # noqa: E402
+from util.wx_biz_json_msg_crypt import WXBizJsonMsgCrypt  # noqa: E402
+from util.wx_crypto import get_crypto_context  # noqa: E402
+from util.wx_envelope import decode_callback  # noqa: E402
+
+'''
+回调信封解码基准：对比 ElementTree + WeChatMessage + DecryptMsg + WeChatTokenMessage.from_xml 的旧路径
+python bench/wx_envelope.py [消息条数]
+'''
+
+TOKEN, AES_KEY, CORP_ID = "QDG6eK", "jWmYm7qr5nMoAUwZRjGtBxmz3KA1tkAj3ykkR6q2B2C", "wx5823bf96d3bd56c7"
+
+
+def main(n: int):
+    ctx = get_crypto_context(TOKEN, AES_KEY, CORP_ID)
+    inner = ("<xml><ToUserName><![CDATA[%s]]></ToUserName><CreateTime>1700000000</CreateTime>"
+             "<MsgType><![CDATA[event]]></MsgType><Event><![CDATA[kf_msg_or_event]]></Event>"
+             "<Token><![CDATA[ENCApHxnGDNAVNY4AaSJKj4Tb5mwsEMzxhFmHVGcra996NR]]></Token>"
+             "<OpenKfId><![CDATA[wkxxxxxxxxxxxxxxxxxx]]></OpenKfId></xml>") % CORP_ID
+    encrypt = ctx.encrypt(inner)
+    timestamp, nonce = "1700000000", "1372623149"
+    signature = ctx.signature(timestamp, nonce, encrypt)
+    body = ("<xml><ToUserName><![CDATA[%s]]></ToUserName><Encrypt><![CDATA[%s]]></Encrypt>"
+            "<AgentID><![CDATA[]]></AgentID></xml>" % (CORP_ID, encrypt)).encode()
+
+    def bench_legacy():
+        root = ET.fromstring(body.decode("utf-8"))
+        message = WeChatMessage(ToUserName=root.find("ToUserName").text, AgentID=root.find("AgentID").text,
+                                Encrypt=root.find("Encrypt").text)
+        with contextlib.redirect_stdout(io.StringIO()):
+            _, xml_content = WXBizJsonMsgCrypt(TOKEN, AES_KEY, CORP_ID).DecryptMsg(
+                message.Encrypt, signature, timestamp, nonce)
+        return WeChatTokenMessage.from_xml(xml_str=xml_content)
+
+    def bench_envelope():
+        return decode_callback(ctx, body, signature, timestamp, nonce)[1]
+
+    legacy, envelope = bench_legacy(), bench_envelope()
+    assert (legacy.Token, legacy.OpenKfId, legacy.CreateTime) == tuple(envelope)
+    for name, fn in (("ElementTree + pydantic", bench_legacy), ("wx_envelope", bench_envelope)):
+        start = time.perf_counter()
+        for _ in range(n):
+            fn()
+        cost = time.perf_counter() - start
+        print(f"{name:<24} {n / cost:>10.0f} 条/秒  ({cost / n * 1e6:.1f} µs/条)")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
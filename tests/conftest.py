@@ -0,0 +1,150 @@
+import base64
+import hashlib
+import os
+import socket
+import struct
+import sys
+import time
+import types
+
+import pytest
+
+'''
+测试公共环境
+
+业务模块以 app 目录为根导入 (与 Docker 镜像中的 WORKDIR 一致)，且在导入时读取配置、注册 Redis 脚本、
+连接 MySQL，所以必须在导入任何业务模块之前：
+- 设置测试用的环境变量 (企业微信回调加解密参数、关闭预热和会话预热池)
+- 把 config 中的 Redis 客户端替换为 fakeredis
+- 用内存实现替换 database_operation (只有 call_coze_api 依赖它)
+'''
+
+APP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app")
+sys.path.insert(0, APP_DIR)
+# main.py 以相对路径挂载 static 目录
+os.chdir(APP_DIR)
+
+_TEST_ENV = {
+    "WEWORK_CORPID": "wx5823bf96d3bd56c7",
+    "WEWORK_CORPSECRET": "test-secret",
+    "WEWORK_TOKEN": "QDG6eK",
+    "WEWORK_ENCODING_AES_KEY": "jWmYm7qr5nMoAUwZRjGtBxmz3KA1tkAj3ykkR6q2B2C",
+    "OPENAI_API_KEY": "sk-test",
+    "HTTP_WARMUP": "False",
+    "COZE_CONV_POOL_ENABLED": "False",
+    "WORK_QUEUE_MODE": "memory",
+    "WECHAT_INGRESS_MODE": "queue",
+}
+for _name, _value in _TEST_ENV.items():
+    os.environ[_name] = _value
+
+import fakeredis  # noqa: E402
+
+import config  # noqa: E402
+
+_redis_server = fakeredis.FakeServer()
+config.REDIS_CLIENT = fakeredis.FakeRedis(server=_redis_server)
+config.ASYNC_REDIS_CLIENT = fakeredis.FakeAsyncRedis(server=_redis_server)
+
+
+class _Row:
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+def _install_fake_database():
+    store = {"conversations": [], "messages": [], "users": {}}
+    db = types.ModuleType("database_operation")
+    db.STORE = store
+
+    def create_conversation(data):
+        row = _Row(**data)
+        store["conversations"].insert(0, row)
+        return row
+
+    def create_message(data):
+        row = _Row(id=len(store["messages"]) + 1, **data)
+        store["messages"].append(row)
+        return row
+
+    def get_conversations_by_user_and_open_kfid(user_id, open_kfid):
+        return [c for c in store["conversations"] if c.user_id == user_id and c.open_kfid == open_kfid]
+
+    def get_conversations_by_user(user_id):
+        return [c for c in store["conversations"] if c.user_id == user_id]
+
+    def get_latest_conversation_id(user_id, open_kfid=None):
+        for c in store["conversations"]:
+            if c.user_id == user_id and (not open_kfid or c.open_kfid == open_kfid):
+                return c.conversation_id
+        return None
+
+    def get_recent_messages(conversation_id, limit):
+        rows = [m for m in store["messages"] if m.conversation_id == conversation_id]
+        return [(m.user_question, m.bot_reply) for m in rows[-limit:]]
+
+    def get_user_by_external_id(external_userid):
+        return store["users"].get(external_userid)
+
+    def create_user(data):
+        row = _Row(**data)
+        store["users"][data["wechat_external_userid"]] = row
+        return row
+
+    for func in (create_conversation, create_message, get_conversations_by_user_and_open_kfid,
+                 get_conversations_by_user, get_latest_conversation_id, get_recent_messages,
+                 get_user_by_external_id, create_user):
+        setattr(db, func.__name__, func)
+    sys.modules["database_operation"] = db
+    return db
+
+
+_fake_db = _install_fake_database()
+
+
+@pytest.fixture(autouse=True)
+def clean_state():
+    """
+    每个测试前清空 fakeredis 和内存数据库
+    fakeredis 的异步连接绑定在创建它的事件循环上，每个测试用各自的 asyncio.run，结束后丢弃连接
+    """
+    config.REDIS_CLIENT.flushall()
+    for rows in _fake_db.STORE.values():
+        rows.clear()
+    yield
+    config.ASYNC_REDIS_CLIENT.connection_pool.reset()
+
+
+def make_callback(token: str = "TOKEN1", open_kfid: str = "wkTest", create_time: int = None):
+    """
+    按企业微信的格式构造一条加密的 kf_msg_or_event 回调
+    返回 (请求体, 查询参数 msg_signature / timestamp / nonce)
+    """
+    from Crypto.Cipher import AES
+
+    corpid = config.WEWORK_CORPID
+    key = base64.b64decode(config.WEWORK_ENCODING_AES_KEY + "=")
+    inner = (f"<xml><ToUserName><![CDATA[{corpid}]]></ToUserName>"
+             f"<CreateTime>{create_time or int(time.time())}</CreateTime>"
+             f"<MsgType><![CDATA[event]]></MsgType><Event><![CDATA[kf_msg_or_event]]></Event>"
+             f"<Token><![CDATA[{token}]]></Token><OpenKfId><![CDATA[{open_kfid}]]></OpenKfId></xml>").encode()
+    raw = b"0123456789abcdef" + struct.pack("I", socket.htonl(len(inner))) + inner + corpid.encode()
+    pad = 32 - len(raw) % 32
+    raw += bytes([pad]) * pad
+    encrypted = base64.b64encode(AES.new(key, AES.MODE_CBC, key[:16]).encrypt(raw)).decode()
+    timestamp, nonce = str(int(time.time())), "nonce"
+    signature = hashlib.sha1("".join(sorted([config.WEWORK_TOKEN, timestamp, nonce, encrypted])).encode()).hexdigest()
+    body = (f"<xml><ToUserName><![CDATA[{corpid}]]></ToUserName><AgentID><![CDATA[1]]></AgentID>"
+            f"<Encrypt><![CDATA[{encrypted}]]></Encrypt></xml>")
+    return body, {"msg_signature": signature, "timestamp": timestamp, "nonce": nonce}
+
+
+@pytest.fixture
+def fake_db():
+    """内存版 database_operation (STORE 中为写入的会话、消息和用户)"""
+    return _fake_db
+
+
+@pytest.fixture
+def wework_callback():
+    return make_callback
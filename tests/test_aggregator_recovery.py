@@ -0,0 +1,69 @@
+import asyncio
+import time
+
+import pytest
+
+import main
+from aggregator import MessageAggregator
+from schema import WechatMsgEntity
+
+'''
+用户消息聚合：聚合窗口中的消息在交给回复任务之前留在 Redis，进程崩溃后可被回收
+'''
+
+
+def _text(msgid: str, content: str, send_time: int) -> WechatMsgEntity:
+    return WechatMsgEntity(msgid=msgid, open_kfid="wkTest", external_userid="wmUser", send_time=send_time,
+                           origin=3, msgtype="text", text={"content": content})
+
+
+@pytest.fixture
+def dispatched(monkeypatch):
+    jobs = []
+
+    async def fake_dispatch(kind, payload):
+        jobs.append((kind, payload))
+
+    monkeypatch.setattr(main.work_queue, "dispatch_job", fake_dispatch)
+    monkeypatch.setattr(main, "AGGREGATE_QUIET_MS", 1000)
+    return jobs
+
+
+def test_messages_left_in_a_crashed_aggregator_are_recovered(dispatched, monkeypatch):
+    # 静默期很长：模拟消息还在聚合窗口中进程就崩溃了
+    monkeypatch.setattr(main, "text_aggregator", MessageAggregator(main._flush_user_texts, 60000, 60000, 10))
+    now = int(time.time())
+
+    async def run():
+        await main.async_process_msg(_text("msg-1", "在吗", now))
+        await main.async_process_msg(_text("msg-2", "想问下营业时间", now + 1))
+        # 还没到回收时间：不回收
+        assert await main.recover_aggregating(older_than_s=60) == 0
+        # 崩溃：进程内的聚合窗口丢失，其他 Worker 回收
+        main.text_aggregator._batches.clear()
+        recovered = await main.recover_aggregating(older_than_s=0)
+        again = await main.recover_aggregating(older_than_s=0)
+        return recovered, again
+
+    recovered, again = asyncio.run(run())
+
+    assert (recovered, again) == (2, 0)
+    assert len(dispatched) == 1
+    kind, payload = dispatched[0]
+    assert kind == "reply_text"
+    assert payload["msgid"] == "msg-2"
+    assert payload["merged_msgids"] == ["msg-1"]
+    assert payload["content"] == ["在吗", "想问下营业时间"]
+
+
+def test_handed_off_batch_is_not_recovered(dispatched, monkeypatch):
+    monkeypatch.setattr(main, "text_aggregator", MessageAggregator(main._flush_user_texts, 20, 100, 10))
+    now = int(time.time())
+
+    async def run():
+        await main.async_process_msg(_text("msg-1", "你好", now))
+        await asyncio.sleep(0.2)
+        return await main.recover_aggregating(older_than_s=0)
+
+    assert asyncio.run(run()) == 0
+    assert [payload["msgid"] for _, payload in dispatched] == ["msg-1"]
@@ -0,0 +1,43 @@
+import call_coze_api
+import conversation_cache
+
+'''
+会话 ID 缓存：同一用户连续多条消息只在第一次查询数据库，之后由进程内 LRU / Redis 命中
+'''
+
+MESSAGES = 100
+
+
+def _count_db_queries(fake_db, monkeypatch) -> list:
+    queries = []
+
+    def get_latest_conversation_id(user_id, open_kfid=None):
+        queries.append((user_id, open_kfid))
+        return fake_db.get_latest_conversation_id(user_id, open_kfid)
+
+    monkeypatch.setattr(call_coze_api, "get_latest_conversation_id", get_latest_conversation_id)
+    return queries
+
+
+def test_repeated_messages_query_the_database_once(fake_db, monkeypatch):
+    fake_db.create_conversation({"conversation_id": "conv-1", "user_id": "user_cache_1", "open_kfid": "wkTest"})
+    queries = _count_db_queries(fake_db, monkeypatch)
+
+    conversation_ids = {call_coze_api.get_or_create_latest_conversation("user_cache_1", "wkTest")
+                        for _ in range(MESSAGES)}
+
+    assert conversation_ids == {"conv-1"}
+    assert len(queries) == 1
+
+
+def test_other_worker_hits_redis_instead_of_the_database(fake_db, monkeypatch):
+    fake_db.create_conversation({"conversation_id": "conv-2", "user_id": "user_cache_2", "open_kfid": "wkTest"})
+    queries = _count_db_queries(fake_db, monkeypatch)
+    call_coze_api.get_or_create_latest_conversation("user_cache_2", "wkTest")
+
+    # 另一个 Worker 的进程内 LRU 是空的
+    monkeypatch.setattr(conversation_cache, "_local", conversation_cache._LocalLRU(10, 60))
+    conversation_id = call_coze_api.get_or_create_latest_conversation("user_cache_2", "wkTest")
+
+    assert conversation_id == "conv-2"
+    assert len(queries) == 1
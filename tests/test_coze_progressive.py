@@ -0,0 +1,106 @@
+import asyncio
+import json
+import time
+
+import httpx
+
+import http_clients
+from coze_client import AsyncCozeClient
+from http_clients import UPSTREAM_COZE
+
+'''
+渐进式回复：分段在 Coze 的截止时间和并发舱壁之外发送
+'''
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def _coze_stream(*paragraphs: str) -> str:
+    events = [_sse("conversation.message.delta", {"id": "m1", "role": "assistant", "type": "answer",
+                                                  "content": p + "\n\n"}) for p in paragraphs]
+    events.append(_sse("conversation.message.completed", {"id": "m1", "role": "assistant", "type": "answer",
+                                                          "content": "\n\n".join(paragraphs)}))
+    events.append("event: done\ndata: {}\n\n")
+    return "".join(events)
+
+
+def _client() -> AsyncCozeClient:
+    return AsyncCozeClient("bot-test", "测试", "pat-test", "wf-test", "app-test",
+                           bulkhead={"max_concurrent": 1, "max_queue": 0})
+
+
+def test_slow_segment_sends_do_not_count_against_deadline_or_bulkhead():
+    paragraphs = ["第一段回答。", "第二段回答。", "第三段回答。"]
+
+    async def coze(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, headers={"Content-Type": "text/event-stream"},
+                              content=_coze_stream(*paragraphs).encode())
+
+    async def run():
+        http_clients._async_clients[UPSTREAM_COZE] = httpx.AsyncClient(transport=httpx.MockTransport(coze))
+        client = _client()
+        sent, in_flight = [], []
+
+        async def slow_send(segment: str):
+            # 发送比截止时间还慢 (企业微信限流退避)
+            await asyncio.sleep(0.8)
+            in_flight.append(client.bulkhead._in_flight)
+            sent.append(segment)
+
+        try:
+            reply = await client.run_workflow("user_test", "conv-1", [{"role": "user", "content": "你好"}],
+                                              on_segment=slow_send, deadline=time.time() + 1.5)
+        finally:
+            await http_clients.close()
+        return reply, sent, in_flight
+
+    reply, sent, in_flight = asyncio.run(run())
+
+    assert reply.unavailable is None
+    assert sent == paragraphs
+    assert reply.text == "\n\n".join(paragraphs)
+    # Coze 流读完就归还名额，之后的发送不占用舱壁
+    assert in_flight[-1] == 0
+
+
+def test_on_segment_error_cancels_coze_call():
+    closed = asyncio.Event()
+
+    class _Stream(httpx.AsyncByteStream):
+        async def __aiter__(self):
+            yield _sse("conversation.message.delta", {"id": "m1", "role": "assistant", "type": "answer",
+                                                      "content": "第一段。\n\n"}).encode()
+            await asyncio.sleep(30)
+            yield b""
+
+        async def aclose(self):
+            closed.set()
+
+    async def coze(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, headers={"Content-Type": "text/event-stream"}, stream=_Stream())
+
+    class _SendFailed(Exception):
+        pass
+
+    async def failing_send(segment: str):
+        raise _SendFailed()
+
+    async def run():
+        http_clients._async_clients[UPSTREAM_COZE] = httpx.AsyncClient(transport=httpx.MockTransport(coze))
+        client = _client()
+        try:
+            try:
+                await client.run_workflow("user_test", "conv-1", [{"role": "user", "content": "你好"}],
+                                          on_segment=failing_send, deadline=time.time() + 10)
+            except _SendFailed:
+                pass
+            else:
+                raise AssertionError("on_segment 的异常应抛给调用方")
+            await asyncio.wait_for(closed.wait(), 1)
+            return client.bulkhead._in_flight
+        finally:
+            await http_clients.close()
+
+    assert asyncio.run(run()) == 0
@@ -0,0 +1,53 @@
+import asyncio
+
+import httpx
+
+import main
+
+'''
+回调请求体上限：超过 WECHAT_MAX_BODY_BYTES 时返回 413，无论是否带 Content-Length
+'''
+
+
+def _post(content, params, headers=None):
+    async def run():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+            return await client.post("/wechat/hook", params=params, content=content, headers=headers)
+
+    return asyncio.run(run())
+
+
+def _chunks(*parts: bytes):
+    async def gen():
+        for part in parts:
+            yield part
+
+    return gen()
+
+
+def test_oversized_body_with_content_length_is_rejected(wework_callback):
+    _, params = wework_callback()
+
+    resp = _post(b"x" * (main.WECHAT_MAX_BODY_BYTES + 1), params)
+
+    assert resp.status_code == 413
+
+
+def test_oversized_chunked_body_is_rejected(wework_callback):
+    _, params = wework_callback()
+    chunk = b"x" * 4096
+    parts = [chunk] * (main.WECHAT_MAX_BODY_BYTES // len(chunk) + 2)
+
+    # 生成器请求体以分块传输发送，没有 Content-Length
+    resp = _post(_chunks(*parts), params)
+
+    assert resp.status_code == 413
+
+
+def test_chunked_body_within_limit_is_accepted(wework_callback):
+    body, params = wework_callback()
+
+    resp = _post(_chunks(body.encode()), params)
+
+    assert resp.status_code == 200
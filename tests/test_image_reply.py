@@ -0,0 +1,36 @@
+import asyncio
+
+import wework
+from config import WEWORK_TEXT_MAX_BYTES
+from kv import async_get_msg_state, MSG_STATE_DONE
+
+'''
+图片回复：与文本回复共用分段发送，超过企业微信 2048 字节上限的回复切分后发送
+'''
+
+
+def test_long_image_reply_is_split_under_wework_limit(monkeypatch):
+    sent = []
+    reply = "这张图片里是一份菜单。" * 200
+
+    async def fake_send(msgid, external_userid, open_kfid, content):
+        sent.append(content)
+
+    async def fake_coze(content, user_id, conversation_id, open_kfid, deadline=None):
+        return reply
+
+    monkeypatch.setattr(wework, "async_send_text_msg", fake_send)
+    monkeypatch.setattr(wework, "async_ai_reply_coze", fake_coze)
+    monkeypatch.setattr(wework, "get_or_create_internal_user", lambda external_userid: "user_test")
+    monkeypatch.setattr(wework, "get_or_create_latest_conversation", lambda user_id, open_kfid: "conv-1")
+
+    async def run():
+        await wework.async_reply_msg("img-1", "wmUser", "wkTest", "https://example.com/a.jpg")
+        return await async_get_msg_state("img-1")
+
+    state = asyncio.run(run())
+
+    assert len(sent) > 1
+    assert all(len(segment.encode("utf-8")) <= WEWORK_TEXT_MAX_BYTES for segment in sent)
+    assert "".join(sent) == reply
+    assert state == MSG_STATE_DONE
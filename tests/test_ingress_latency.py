@@ -0,0 +1,63 @@
+import asyncio
+import json
+import time
+
+import httpx
+
+import http_clients
+from http_clients import UPSTREAM_WEWORK
+import main
+
+'''
+回调入口延迟：/wechat/hook 只投递 Token，不等待 sync_msg
+企业微信的 sync_msg 故意延迟 SYNC_MSG_DELAY_S 秒返回，回调仍应立即响应
+'''
+
+SYNC_MSG_DELAY_S = 3.0
+HOOK_BUDGET_S = 0.5
+
+
+class _SlowWework:
+    """企业微信接口替身：gettoken 立即返回，sync_msg 延迟返回"""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.sync_started = asyncio.Event()
+        self.sync_payloads = []
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        if request.url.path.endswith("/gettoken"):
+            return httpx.Response(200, json={"errcode": 0, "access_token": "test-token", "expires_in": 7200})
+        if request.url.path.endswith("/kf/sync_msg"):
+            self.sync_payloads.append(json.loads(request.content))
+            self.sync_started.set()
+            await asyncio.sleep(self.delay)
+            return httpx.Response(200, json={"errcode": 0, "errmsg": "ok", "next_cursor": "cursor-1",
+                                             "has_more": 0, "msg_list": []})
+        return httpx.Response(404, json={"errcode": 404, "errmsg": "not found"})
+
+
+async def _post_hook_while_sync_is_slow(wework_callback):
+    wework = _SlowWework(SYNC_MSG_DELAY_S)
+    # 预先放入共享客户端，lifespan 启动时复用它而不是新建
+    http_clients._async_clients[UPSTREAM_WEWORK] = httpx.AsyncClient(transport=httpx.MockTransport(wework.handle))
+    body, params = wework_callback(token="TOKEN-SLOW", open_kfid="wkSlow")
+    async with main.app.router.lifespan_context(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+            start = time.perf_counter()
+            resp = await client.post("/wechat/hook", params=params, content=body)
+            elapsed = time.perf_counter() - start
+        # 后台管道确实去拉取了 (证明慢的 sync_msg 在回调之外执行)
+        await asyncio.wait_for(wework.sync_started.wait(), timeout=SYNC_MSG_DELAY_S)
+    return resp, elapsed, wework
+
+
+def test_hook_responds_before_slow_sync_msg(wework_callback):
+    resp, elapsed, wework = asyncio.run(_post_hook_while_sync_is_slow(wework_callback))
+
+    assert resp.status_code == 200
+    assert resp.json() == {"message": "Event received"}
+    assert elapsed < HOOK_BUDGET_S, f"/wechat/hook 用时 {elapsed:.2f}s，被 sync_msg ({SYNC_MSG_DELAY_S}s) 拖慢"
+    assert wework.sync_payloads[0]["token"] == "TOKEN-SLOW"
+    assert wework.sync_payloads[0]["open_kfid"] == "wkSlow"
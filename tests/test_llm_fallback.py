@@ -0,0 +1,157 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pytest
+
+import call_coze_api
+import http_clients
+from circuit_breaker import CircuitBreaker
+from coze_client import AsyncCozeClient
+from http_clients import UPSTREAM_COZE
+from llm_fallback import LLMFallback
+
+'''
+Coze 降级到 OpenAI 兼容模型：熔断打开 / 超时时由大模型回答，reply_backend 记为 llm:<model>，
+大模型也失败时回复兜底文案 (不入库)。大模型由本地的假 OpenAI 兼容服务代替。
+'''
+
+MODEL = "fake-model"
+FALLBACK_REPLY = "客服繁忙，请稍后再试"
+
+
+class _FakeOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _FakeOpenAIHandler)
+        # ok: 回显最后一条用户消息；slow: 超过降级超时才返回；error: HTTP 500
+        self.mode = "ok"
+        self.requests = []
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}/v1"
+
+
+class _FakeOpenAIHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.requests.append((self.path, self.headers.get("Authorization"), body))
+        if self.server.mode == "slow":
+            time.sleep(3)
+        if self.server.mode == "error":
+            self._reply(500, {"error": {"message": "upstream overloaded"}})
+            return
+        content = f"echo: {body['messages'][-1]['content']}"
+        self._reply(200, {"choices": [{"index": 0, "message": {"role": "assistant", "content": content}}]})
+
+    def _reply(self, status: int, payload: dict):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        try:
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def openai_server():
+    server = _FakeOpenAIServer()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def coze_bot(openai_server, monkeypatch):
+    client = AsyncCozeClient("bot-llm", "测试", "pat-test", "wf-llm", "app-test", fallback_reply=FALLBACK_REPLY,
+                             llm_fallback={"enabled": True, "base_url": openai_server.base_url, "model": MODEL,
+                                           "api_key": "sk-test", "history_turns": 2, "timeout_s": 1.5})
+    # 每个测试使用独立的熔断器，避免共享状态
+    client.breaker = CircuitBreaker("wf-llm-test", min_requests=1)
+    monkeypatch.setattr(call_coze_api, "get_coze_client", lambda open_kfid: client)
+    return client
+
+
+def _unexpected_coze(request: httpx.Request) -> httpx.Response:
+    raise AssertionError("不应调用 Coze")
+
+
+def _ask(question: str, coze_handler=_unexpected_coze, deadline_s: float = 10):
+    async def run():
+        http_clients._async_clients[UPSTREAM_COZE] = httpx.AsyncClient(transport=httpx.MockTransport(coze_handler))
+        try:
+            return await call_coze_api.async_call_coze_workflow("user_test", "conv-llm", question, "wkTest",
+                                                                deadline=time.time() + deadline_s)
+        finally:
+            await http_clients.close()
+
+    return asyncio.run(run())
+
+
+def _recorded(fake_db):
+    return [(m.user_question, m.bot_reply, m.reply_backend) for m in fake_db.STORE["messages"]]
+
+
+def test_breaker_open_falls_back_to_llm_with_history(coze_bot, openai_server, fake_db):
+    coze_bot.breaker.record(False)
+    assert not coze_bot.breaker.allow()
+    for question, reply in [("第一问", "第一答"), ("第二问", "第二答"), ("第三问", "第三答")]:
+        fake_db.create_message({"user_question": question, "bot_reply": reply, "user_id": "user_test",
+                                "conversation_id": "conv-llm", "reply_backend": "coze"})
+
+    reply = _ask("营业时间？")
+
+    assert reply == "echo: 营业时间？"
+    assert _recorded(fake_db)[-1] == ("营业时间？", "echo: 营业时间？", f"llm:{MODEL}")
+    path, auth, body = openai_server.requests[-1]
+    assert path == "/v1/chat/completions"
+    assert auth == "Bearer sk-test"
+    assert body["model"] == MODEL
+    # system + 最近 2 轮问答 + 当前问题
+    assert [m["content"] for m in body["messages"][1:]] == ["第二问", "第二答", "第三问", "第三答", "营业时间？"]
+
+
+def test_coze_timeout_falls_back_to_llm(coze_bot, openai_server, fake_db):
+    async def slow_coze(request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(10)
+        return httpx.Response(200)
+
+    start = time.time()
+    reply = _ask("还在吗", slow_coze, deadline_s=3)
+
+    # Coze 在截止时间前 timeout_s 放弃，降级回复仍在截止时间内
+    assert time.time() - start < 3
+    assert reply == "echo: 还在吗"
+    assert _recorded(fake_db) == [("还在吗", "echo: 还在吗", f"llm:{MODEL}")]
+
+
+@pytest.mark.parametrize("mode", ["error", "slow"])
+def test_canned_reply_when_llm_also_fails(coze_bot, openai_server, fake_db, mode):
+    openai_server.mode = mode
+    coze_bot.breaker.record(False)
+
+    reply = _ask("你好")
+
+    assert reply == FALLBACK_REPLY
+    assert len(openai_server.requests) == 1
+    # 兜底文案不入库
+    assert _recorded(fake_db) == []
+
+
+def test_fallback_disabled_without_base_url():
+    # 未配置 LLM_FALLBACK_BASE_URL 时即使 enabled 也不开启降级，不会把对话发往默认地址
+    assert LLMFallback.from_config("bot-llm", {"enabled": True, "api_key": "sk-test"}) is None
+    assert LLMFallback.from_config("bot-llm", {"enabled": True, "api_key": "sk-test",
+                                               "base_url": "http://127.0.0.1:1/v1"}) is not None
@@ -0,0 +1,154 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pytest
+
+import coze_client
+import http_clients
+import main
+
+'''
+Open-WebUI 流式接口：Coze 的 conversation.message.delta 桥接为 OpenAI chat.completion.chunk
+Coze 由本地 SSE 服务代替 (真实 TCP 连接)，客户端断开时应取消 Coze 调用并关闭上游连接
+'''
+
+DELTAS = ["你好", "，我是", "客服助手。"]
+
+
+def _sse(event: str, data: dict) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8")
+
+
+class _CozeSSEServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _CozeSSEHandler)
+        # complete: 按 DELTAS 推送增量后正常结束；hang: 推送第一个增量后一直保持连接
+        self.mode = "complete"
+        self.requests = []
+        self.upstream_closed = threading.Event()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}"
+
+
+class _CozeSSEHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.requests.append(body)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        message = {"id": "m1", "role": "assistant", "type": "answer"}
+        try:
+            if self.server.mode == "hang":
+                self._write(_sse("conversation.message.delta", {**message, "content": DELTAS[0]}))
+                # 持续发送注释行，客户端关闭连接后写入失败
+                deadline = time.time() + 10
+                while time.time() < deadline:
+                    time.sleep(0.05)
+                    self._write(b": keep-alive\n\n")
+                return
+            for delta in DELTAS:
+                self._write(_sse("conversation.message.delta", {**message, "content": delta}))
+                time.sleep(0.02)
+            self._write(_sse("conversation.message.completed", {**message, "content": "".join(DELTAS)}))
+            self._write(b"event: done\ndata: {}\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            self.server.upstream_closed.set()
+
+    def _write(self, data: bytes):
+        self.wfile.write(data)
+        self.wfile.flush()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def coze_server(monkeypatch):
+    server = _CozeSSEServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(coze_client, "WORKFLOW_CHAT_URL", f"{server.base_url}/v1/workflows/chat")
+    monkeypatch.setattr(main, "get_or_create_latest_conversation", lambda user_id, open_kfid: "conv-webui")
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _chunks(body: str):
+    """解析 SSE 响应体，返回 (chunk 列表, 是否以 [DONE] 结束)"""
+    events = [line[len("data: "):] for line in body.split("\n") if line.startswith("data: ")]
+    done = bool(events) and events[-1] == "[DONE]"
+    return [json.loads(e) for e in events if e != "[DONE]"], done
+
+
+def test_coze_deltas_are_bridged_to_openai_chunks(coze_server):
+    async def run():
+        try:
+            transport = httpx.ASGITransport(app=main.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+                return await client.post("/v1/chat/completions", json={
+                    "model": "wxwork-coze-chat", "stream": True,
+                    "messages": [{"role": "user", "content": "你是谁"}],
+                })
+        finally:
+            await http_clients.close()
+
+    resp = asyncio.run(run())
+
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/event-stream")
+    chunks, done = _chunks(resp.text)
+    assert done
+    assert all(c["object"] == "chat.completion.chunk" for c in chunks)
+    assert len({c["id"] for c in chunks}) == 1
+    # 首个 chunk 声明角色，随后每个 Coze 增量一个 chunk，最后是 finish_reason=stop
+    assert chunks[0]["choices"][0]["delta"] == {"role": "assistant", "content": ""}
+    assert [c["choices"][0]["delta"]["content"] for c in chunks[1:-1]] == DELTAS
+    assert chunks[-1]["choices"][0] == {"index": 0, "delta": {}, "finish_reason": "stop"}
+    # 透传给 Coze 的是用户问题和会话
+    assert coze_server.requests[0]["conversation_id"] == "conv-webui"
+    assert coze_server.requests[0]["additional_messages"][0]["content"] == "你是谁"
+
+
+def test_client_disconnect_cancels_coze_and_closes_upstream(coze_server):
+    coze_server.mode = "hang"
+
+    async def run():
+        received = []
+        stream = main._openai_coze_stream("wxwork-coze-chat", "user_webui", "conv-webui", "你是谁", "wkx_webui")
+
+        async def consume():
+            # 相当于 StreamingResponse 逐个发送 chunk；客户端断开时 Starlette 取消这个任务
+            async for chunk in stream:
+                received.append(chunk)
+
+        tasks_before = asyncio.all_tasks()
+        consumer = asyncio.create_task(consume())
+        try:
+            deadline = time.time() + 5
+            while len(received) < 2 and time.time() < deadline:
+                await asyncio.sleep(0.02)
+            consumer.cancel()
+            await asyncio.gather(consumer, return_exceptions=True)
+            # Coze 调用任务随之结束，没有遗留的后台任务
+            leftover = [t for t in asyncio.all_tasks() - tasks_before if not t.done()]
+            return received, leftover
+        finally:
+            await http_clients.close()
+
+    received, leftover = asyncio.run(run())
+
+    assert [json.loads(c[len("data: "):])["choices"][0]["delta"] for c in received[:2]] == [
+        {"role": "assistant", "content": ""}, {"content": DELTAS[0]}]
+    assert not any("[DONE]" in c for c in received)
+    assert leftover == []
+    assert coze_server.upstream_closed.wait(timeout=3)
@@ -0,0 +1,57 @@
+import asyncio
+import json
+import time
+
+import httpx
+
+import call_coze_api
+import http_clients
+import main
+import wework
+from coze_client import AsyncCozeClient
+from http_clients import UPSTREAM_COZE
+
+'''
+回复截止时间从任务开始处理起算：重新投递 / 积压回放的任务即使距用户发送已超过 COZE_REPLY_DEADLINE_S，
+仍然调用 Coze 并回复正常答案，而不是兜底文案
+'''
+
+FALLBACK_REPLY = "客服繁忙，请稍后再试"
+ANSWER = "这是正常的回答。"
+
+
+def _coze_stream(answer: str) -> bytes:
+    completed = {"id": "m1", "role": "assistant", "type": "answer", "content": answer}
+    return (f"event: conversation.message.completed\ndata: {json.dumps(completed, ensure_ascii=False)}\n\n"
+            "event: done\ndata: {}\n\n").encode()
+
+
+def test_redelivered_job_still_calls_coze(monkeypatch):
+    coze_requests, sent = [], []
+
+    async def coze(request: httpx.Request) -> httpx.Response:
+        coze_requests.append(request)
+        return httpx.Response(200, headers={"Content-Type": "text/event-stream"}, content=_coze_stream(ANSWER))
+
+    async def fake_send(msgid, external_userid, open_kfid, content):
+        sent.append(content)
+
+    client = AsyncCozeClient("bot-test", "测试", "pat-test", "wf-test", "app-test", fallback_reply=FALLBACK_REPLY)
+    monkeypatch.setattr(call_coze_api, "get_coze_client", lambda open_kfid: client)
+    monkeypatch.setattr(wework, "async_send_text_msg", fake_send)
+    monkeypatch.setattr(main, "get_or_create_internal_user", lambda external_userid: "user_test")
+    monkeypatch.setattr(main, "get_or_create_latest_conversation", lambda user_id, open_kfid: "conv-1")
+
+    async def run():
+        http_clients._async_clients[UPSTREAM_COZE] = httpx.AsyncClient(transport=httpx.MockTransport(coze))
+        try:
+            # 进程崩溃后由 XAUTOCLAIM 重新投递：距用户发送已过去 WORK_QUEUE_VISIBILITY_MS (180 秒)
+            await main._reply_text_job({"msgid": "msg-1", "external_userid": "wmUser", "open_kfid": "wkTest",
+                                        "content": "你好", "send_time": int(time.time()) - 180})
+        finally:
+            await http_clients.close()
+
+    asyncio.run(run())
+
+    assert len(coze_requests) == 1
+    assert sent == [ANSWER]
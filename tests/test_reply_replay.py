@@ -0,0 +1,132 @@
+import asyncio
+import json
+
+import pytest
+
+import config
+import main
+import wework
+import work_queue
+from kv import async_get_msg_state, async_get_reply_progress, MSG_STATE_DONE, MSG_STATE_PROCESSING
+
+'''
+回复任务重放：发送中途崩溃后重新投递，用户已经收到的分段不再重复发送
+'''
+
+SEGMENTS = ["第一段。", "第二段。", "第三段。"]
+
+
+class _Crash(Exception):
+    pass
+
+
+@pytest.fixture
+def reply_env(monkeypatch):
+    sent = []
+    crash_on = {"call": None}
+
+    async def fake_send(msgid, external_userid, open_kfid, content):
+        if len(sent) + 1 == crash_on["call"]:
+            crash_on["call"] = None
+            raise _Crash()
+        sent.append(content)
+
+    async def fake_coze(content, user_id, conversation_id, open_kfid, on_segment=None, deadline=None):
+        if on_segment is not None:
+            for segment in SEGMENTS:
+                await on_segment(segment)
+        return "".join(SEGMENTS)
+
+    monkeypatch.setattr(wework, "async_send_text_msg", fake_send)
+    monkeypatch.setattr(main, "async_ai_reply_coze", fake_coze)
+    monkeypatch.setattr(main, "get_or_create_internal_user", lambda external_userid: "user_test")
+    monkeypatch.setattr(main, "get_or_create_latest_conversation", lambda user_id, open_kfid: "conv-1")
+    monkeypatch.setattr(main, "COZE_PROGRESSIVE_REPLY", True)
+    return sent, crash_on
+
+
+def _reply_twice():
+    async def run():
+        args = ("msg-3", "wmUser", "wkTest", ["一", "二", "三"], ["msg-1", "msg-2"])
+        with pytest.raises(_Crash):
+            await main.async_reply_msg(*args)
+        states_after_crash = [await async_get_msg_state(m) for m in ("msg-1", "msg-2", "msg-3")]
+        progress_after_crash = await async_get_reply_progress("msg-3")
+        # 任务被重新投递
+        await main.async_reply_msg(*args)
+        states = [await async_get_msg_state(m) for m in ("msg-1", "msg-2", "msg-3")]
+        return states_after_crash, progress_after_crash, states
+
+    return asyncio.run(run())
+
+
+def test_replay_skips_segments_already_sent(reply_env):
+    sent, crash_on = reply_env
+    crash_on["call"] = 2
+
+    states_after_crash, progress_after_crash, states = _reply_twice()
+
+    assert states_after_crash == [MSG_STATE_PROCESSING] * 3
+    assert progress_after_crash == 1
+    assert sent == SEGMENTS
+    assert states == [MSG_STATE_DONE] * 3
+
+
+def test_replay_of_whole_reply_skips_segments_already_sent(reply_env, monkeypatch):
+    sent, crash_on = reply_env
+    monkeypatch.setattr(main, "COZE_PROGRESSIVE_REPLY", False)
+    monkeypatch.setattr(wework, "split_text", lambda text: SEGMENTS)
+    crash_on["call"] = 3
+
+    states_after_crash, progress_after_crash, states = _reply_twice()
+
+    assert progress_after_crash == 2
+    assert sent == SEGMENTS
+    assert states == [MSG_STATE_DONE] * 3
+
+
+def test_done_batch_is_not_replied_again(reply_env):
+    sent, _ = reply_env
+
+    async def run():
+        args = ("msg-9", "wmUser", "wkTest", "你好")
+        await main.async_reply_msg(*args)
+        await main.async_reply_msg(*args)
+
+    asyncio.run(run())
+
+    assert sent == SEGMENTS
+
+
+def test_user_mapping_failure_leaves_the_job_unacked(reply_env, monkeypatch):
+    sent, _ = reply_env
+    mapping = {"user": None}
+    monkeypatch.setattr(main, "get_or_create_internal_user", lambda external_userid: mapping["user"])
+    payload = {"msgid": "msg-map", "external_userid": "wmUser", "open_kfid": "wkTest", "content": "你好"}
+    redis = config.ASYNC_REDIS_CLIENT
+
+    async def deliver(start_id: str):
+        # ">" 为新任务；"0" 重新读取本消费者已投递但未确认的任务 (相当于 XAUTOCLAIM 回收后再次处理)
+        resp = await redis.xreadgroup(work_queue.WORK_QUEUE_GROUP, "consumer-1",
+                                      {work_queue.WORK_QUEUE_STREAM: start_id}, count=1)
+        entry_id, fields = resp[0][1][0]
+        await work_queue._handle_entry(entry_id, fields)
+        return (await redis.xpending(work_queue.WORK_QUEUE_STREAM, work_queue.WORK_QUEUE_GROUP))["pending"]
+
+    async def run():
+        await work_queue._ensure_group()
+        await redis.xadd(work_queue.WORK_QUEUE_STREAM, {"kind": "reply_text", "payload": json.dumps(payload)})
+        pending_after_failure = await deliver(">")
+        state_after_failure = await async_get_msg_state("msg-map")
+        # 数据库恢复后重新投递
+        mapping["user"] = "user_test"
+        return pending_after_failure, state_after_failure, await deliver("0"), await async_get_msg_state("msg-map")
+
+    pending_after_failure, state_after_failure, pending, state = asyncio.run(run())
+
+    # 映射失败：不确认，不发送，等待重新投递 (多次失败后转入死信队列)
+    assert pending_after_failure == 1
+    assert state_after_failure == MSG_STATE_PROCESSING
+    assert pending == 0
+    assert sent == SEGMENTS
+    assert state == MSG_STATE_DONE
@@ -0,0 +1,83 @@
+import asyncio
+
+import httpx
+import pytest
+
+import http_clients
+import send_dispatcher
+from http_clients import UPSTREAM_WEWORK
+from schema import WechatMsgSendEntity
+
+'''
+发送调度：只重试确定没有送达的失败，请求可能已送达时不重试 (避免重复消息)
+'''
+
+
+def _entity() -> WechatMsgSendEntity:
+    return WechatMsgSendEntity(touser="wmUser", open_kfid="wkTest", msgtype="text", text={"content": "你好"})
+
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(send_dispatcher, "SEND_BACKOFF_BASE_MS", 1)
+    monkeypatch.setattr(send_dispatcher, "SEND_BACKOFF_MAX_MS", 2)
+
+
+def _send_with(responses):
+    """
+    responses: 依次作为 send_msg 的结果，httpx.Response 直接返回，异常类型则抛出
+    返回 (最终结果, send_msg 调用次数)
+    """
+    responses = list(responses)
+    calls = []
+
+    async def handle(request: httpx.Request) -> httpx.Response:
+        if request.url.path.endswith("/gettoken"):
+            return httpx.Response(200, json={"errcode": 0, "access_token": "test-token", "expires_in": 7200})
+        calls.append(request)
+        outcome = responses.pop(0)
+        if isinstance(outcome, type) and issubclass(outcome, Exception):
+            raise outcome("simulated", request=request)
+        return outcome
+
+    async def run():
+        http_clients._async_clients[UPSTREAM_WEWORK] = httpx.AsyncClient(transport=httpx.MockTransport(handle))
+        try:
+            return await send_dispatcher.send(_entity())
+        finally:
+            await send_dispatcher.stop_senders()
+            await http_clients.close()
+
+    return asyncio.run(run()), len(calls)
+
+
+OK = httpx.Response(200, json={"errcode": 0, "errmsg": "ok", "msgid": "sent-1"})
+
+
+@pytest.mark.parametrize("error", [httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout])
+def test_connect_phase_errors_are_retried(error):
+    result, calls = _send_with([error, OK])
+
+    assert result["errcode"] == 0
+    assert calls == 2
+
+
+@pytest.mark.parametrize("errcode", [-1, 45009, 45033])
+def test_explicit_busy_errcodes_are_retried(errcode):
+    result, calls = _send_with([httpx.Response(200, json={"errcode": errcode, "errmsg": "busy"}), OK])
+
+    assert result["errcode"] == 0
+    assert calls == 2
+
+
+@pytest.mark.parametrize("outcome", [
+    httpx.ReadTimeout,
+    httpx.RemoteProtocolError,
+    httpx.Response(502, text="Bad Gateway"),
+    httpx.Response(200, text="not json"),
+])
+def test_possibly_delivered_failures_are_not_retried(outcome):
+    result, calls = _send_with([outcome, OK])
+
+    assert result["errcode"] == -1
+    assert calls == 1
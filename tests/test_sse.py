@@ -0,0 +1,49 @@
+import json
+import random
+
+import pytest
+
+from util.sse import SSEDecoder, SSEEvent, iter_sse
+
+'''
+增量 SSE 解码：网络块可能切在任意字节 (包括 \r\n 之间和多字节 UTF-8 字符中间)
+'''
+
+TRICKY = "﻿: ping\r\nevent: a\r\ndata: 第一行\r\ndata:第二行\r\nid: 7\r\n\r\ndata\n\nevent:b\ndata:x\n\rdata:tail".encode()
+TRICKY_EVENTS = [SSEEvent("a", "第一行\n第二行", "7"), SSEEvent("message", "", "7"), SSEEvent("b", "x", "7")]
+
+
+def _split(raw: bytes, seed: int, low: int, high: int):
+    rnd = random.Random(seed)
+    chunks, i = [], 0
+    while i < len(raw):
+        step = rnd.randint(low, high)
+        chunks.append(raw[i:i + step])
+        i += step
+    return chunks
+
+
+@pytest.mark.parametrize("max_chunk", range(1, 8))
+def test_events_survive_arbitrary_chunk_boundaries(max_chunk):
+    decoder = SSEDecoder()
+
+    events = [e for chunk in _split(TRICKY, seed=max_chunk, low=1, high=max_chunk) for e in decoder.feed(chunk)]
+
+    # 末尾没有空行的 data:tail 不构成完整事件
+    assert events == TRICKY_EVENTS
+
+
+def test_only_subscribed_events_are_dispatched():
+    assert [e.event for e in iter_sse([TRICKY], {"b"})] == ["b"]
+
+
+def test_chunked_coze_stream_matches_whole_stream():
+    deltas = [f"第{i}段，" for i in range(50)]
+    raw = "".join(f"event:conversation.message.delta\ndata:{json.dumps({'content': d}, ensure_ascii=False)}\n\n"
+                  for d in deltas).encode("utf-8") + b'event:done\ndata:"[DONE]"\n\n'
+
+    whole = [(e.event, e.data) for e in iter_sse([raw])]
+    chunked = [(e.event, e.data) for e in iter_sse(_split(raw, seed=3, low=1, high=64))]
+
+    assert chunked == whole
+    assert [json.loads(data)["content"] for event, data in whole[:-1]] == deltas
@@ -0,0 +1,174 @@
+import asyncio
+
+import httpx
+import pytest
+
+import http_clients
+import sync_pipeline
+from http_clients import UPSTREAM_WEWORK
+from kv import async_get_cursor, async_has_resync
+from util.wx_envelope import CallbackEnvelope
+
+'''
+消息同步管道：sync_msg 失败时不能当作已经拉完
+'''
+
+
+def _envelope(open_kfid: str, token: str = "TOKEN1") -> CallbackEnvelope:
+    return CallbackEnvelope(Token=token, OpenKfId=open_kfid, CreateTime=0)
+
+
+def _text_msg(msgid: str, open_kfid: str) -> dict:
+    return {"msgid": msgid, "open_kfid": open_kfid, "external_userid": "wmUser", "send_time": 0,
+            "origin": 3, "msgtype": "text", "text": {"content": "你好"}}
+
+
+class _FlakyWework:
+    """企业微信接口替身：sync_msg 先按 failures 依次返回失败响应，之后返回一页消息"""
+
+    def __init__(self, failures, open_kfid: str):
+        self.failures = list(failures)
+        self.open_kfid = open_kfid
+        self.sync_calls = 0
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        if request.url.path.endswith("/gettoken"):
+            return httpx.Response(200, json={"errcode": 0, "access_token": "test-token", "expires_in": 7200})
+        self.sync_calls += 1
+        if self.failures:
+            return self.failures.pop(0)
+        return httpx.Response(200, json={"errcode": 0, "next_cursor": "cursor-1", "has_more": 0,
+                                         "msg_list": [_text_msg("msg-1", self.open_kfid)]})
+
+
+async def _drain_with(wework: _FlakyWework, open_kfid: str):
+    handled = []
+
+    async def handler(msg):
+        handled.append(msg.msgid)
+
+    http_clients._async_clients[UPSTREAM_WEWORK] = httpx.AsyncClient(transport=httpx.MockTransport(wework.handle))
+    try:
+        await sync_pipeline.drain(_envelope(open_kfid), handler)
+        return handled, await async_get_cursor(open_kfid), await async_has_resync(open_kfid)
+    finally:
+        await http_clients.close()
+
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(sync_pipeline, "SYNC_DRAIN_BACKOFF_MS", 1)
+    monkeypatch.setattr(sync_pipeline, "SYNC_DRAIN_RETRIES", 3)
+
+
+def test_drain_retries_after_errcode_5xx_and_non_json():
+    wework = _FlakyWework([
+        httpx.Response(200, json={"errcode": 45009, "errmsg": "api freq out of limit"}),
+        httpx.Response(502, text="Bad Gateway"),
+        httpx.Response(200, text="<html>upstream error</html>"),
+    ], "wkFlaky")
+
+    handled, cursor, pending = asyncio.run(_drain_with(wework, "wkFlaky"))
+
+    assert wework.sync_calls == 4
+    assert handled == ["msg-1"]
+    assert cursor == b"cursor-1"
+    assert not pending
+
+
+def test_drain_keeps_resync_marker_when_retries_run_out():
+    failures = [httpx.Response(200, json={"errcode": -1, "errmsg": "system busy"})] * 10
+    wework = _FlakyWework(failures, "wkDown")
+
+    handled, cursor, pending = asyncio.run(_drain_with(wework, "wkDown"))
+
+    assert wework.sync_calls == 4
+    assert handled == []
+    assert cursor is None
+    # 标记保留，下一次回调 (或其他 Worker) 继续拉取
+    assert pending
+
+
+class _PagedWework:
+    """企业微信接口替身：sync_msg 每次返回一条消息，永远 has_more=1"""
+
+    def __init__(self, open_kfid: str):
+        self.open_kfid = open_kfid
+        self.sync_calls = 0
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        if request.url.path.endswith("/gettoken"):
+            return httpx.Response(200, json={"errcode": 0, "access_token": "test-token", "expires_in": 7200})
+        self.sync_calls += 1
+        n = self.sync_calls
+        return httpx.Response(200, json={"errcode": 0, "next_cursor": f"cursor-{n}", "has_more": 1,
+                                         "msg_list": [_text_msg(f"msg-{n}", self.open_kfid)]})
+
+
+def test_drain_stops_when_lease_renewal_fails(monkeypatch):
+    import config
+    from kv import _sync_lease_key
+
+    open_kfid = "wkStolen"
+    monkeypatch.setattr(sync_pipeline, "SYNC_LEASE_TTL_MS", 300)
+    wework = _PagedWework(open_kfid)
+    handled = []
+
+    async def run():
+        async def handler(msg):
+            handled.append(msg.msgid)
+            if len(handled) == 1:
+                # 租约过期后被其他 Worker 抢走，下一次续期失败
+                await config.ASYNC_REDIS_CLIENT.set(_sync_lease_key(open_kfid), "other-worker")
+                await asyncio.sleep(0.3)
+
+        http_clients._async_clients[UPSTREAM_WEWORK] = httpx.AsyncClient(
+            transport=httpx.MockTransport(wework.handle))
+        try:
+            await asyncio.wait_for(sync_pipeline.drain(_envelope(open_kfid), handler), timeout=5)
+            return (await async_get_cursor(open_kfid), await async_has_resync(open_kfid),
+                    await config.ASYNC_REDIS_CLIENT.get(_sync_lease_key(open_kfid)))
+        finally:
+            await http_clients.close()
+
+    cursor, pending, lease_owner = asyncio.run(run())
+
+    # 第二页已拉到但没有认领、没有分发，cursor 停在第一页之后
+    assert handled == ["msg-1"]
+    assert wework.sync_calls == 2
+    assert cursor == b"cursor-1"
+    assert pending
+    # 不会释放别人的租约
+    assert lease_owner == b"other-worker"
+
+
+def test_handler_error_mid_page_does_not_strand_the_rest_of_the_page():
+    open_kfid = "wkBroken"
+
+    async def sync_msg(request: httpx.Request) -> httpx.Response:
+        if request.url.path.endswith("/gettoken"):
+            return httpx.Response(200, json={"errcode": 0, "access_token": "test-token", "expires_in": 7200})
+        return httpx.Response(200, json={"errcode": 0, "next_cursor": "cursor-1", "has_more": 0,
+                                         "msg_list": [_text_msg(f"msg-{i}", open_kfid) for i in (1, 2, 3)]})
+
+    handled = []
+
+    async def run():
+        async def handler(msg):
+            if msg.msgid == "msg-2":
+                raise RuntimeError("dispatch failed")
+            handled.append(msg.msgid)
+
+        http_clients._async_clients[UPSTREAM_WEWORK] = httpx.AsyncClient(transport=httpx.MockTransport(sync_msg))
+        try:
+            await sync_pipeline.drain(_envelope(open_kfid), handler)
+            return await async_get_cursor(open_kfid), await async_has_resync(open_kfid)
+        finally:
+            await http_clients.close()
+
+    cursor, pending = asyncio.run(run())
+
+    # msg-2 出错后同一页的 msg-3 仍被分发
+    assert handled == ["msg-1", "msg-3"]
+    assert cursor == b"cursor-1"
+    assert not pending
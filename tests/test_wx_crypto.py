@@ -0,0 +1,75 @@
+import pytest
+
+import config
+import ierror
+from util.wx_biz_json_msg_crypt import WXBizJsonMsgCrypt
+from util.wx_crypto import get_crypto_context
+
+'''
+缓存上下文版回调加解密：与企业微信官方实现 (wx_biz_json_msg_crypt.py) 互通，验签 / ReceiveId 不符时拒绝
+'''
+
+TIMESTAMP, NONCE = "1700000000", "1372623149"
+XML = "<xml><Token><![CDATA[ENCApHxnGDNAVNY4]]></Token><OpenKfId><![CDATA[wk客服]]></OpenKfId></xml>"
+
+
+@pytest.fixture
+def ctx():
+    return get_crypto_context(config.WEWORK_TOKEN, config.WEWORK_ENCODING_AES_KEY, config.WEWORK_CORPID)
+
+
+def _legacy():
+    return WXBizJsonMsgCrypt(config.WEWORK_TOKEN, config.WEWORK_ENCODING_AES_KEY, config.WEWORK_CORPID)
+
+
+def test_encrypt_decrypt_round_trip(ctx):
+    encrypt = ctx.encrypt(XML)
+
+    assert ctx.decrypt_msg(encrypt, ctx.signature(TIMESTAMP, NONCE, encrypt), TIMESTAMP, NONCE) == (0, XML)
+
+
+def test_interoperates_with_legacy_implementation(ctx):
+    encrypt = ctx.encrypt(XML)
+    signature = ctx.signature(TIMESTAMP, NONCE, encrypt)
+
+    # 旧实现能解开新实现加密的消息，签名算法一致
+    assert _legacy().DecryptMsg(encrypt, signature, TIMESTAMP, NONCE) == (0, XML)
+
+
+def test_decrypts_callbacks_built_like_wework(ctx, wework_callback):
+    # make_callback 按企业微信的格式独立构造 (struct + socket.htonl 打包长度)，不经过 WXCryptoContext
+    body, params = wework_callback(token="TOKEN-RT", open_kfid="wkRoundTrip")
+    encrypt = body.split("<Encrypt><![CDATA[")[1].split("]]>")[0]
+
+    ret, text = ctx.decrypt_msg(encrypt, params["msg_signature"], params["timestamp"], params["nonce"])
+
+    assert ret == 0
+    assert "<Token><![CDATA[TOKEN-RT]]></Token>" in text
+
+
+def test_context_is_built_once_per_corp(ctx):
+    assert get_crypto_context(config.WEWORK_TOKEN, config.WEWORK_ENCODING_AES_KEY, config.WEWORK_CORPID) is ctx
+
+
+def test_bad_signature_is_rejected(ctx):
+    encrypt = ctx.encrypt(XML)
+
+    ret, text = ctx.decrypt_msg(encrypt, "0" * 40, TIMESTAMP, NONCE)
+
+    assert (ret, text) == (ierror.WXBizMsgCrypt_ValidateSignature_Error, None)
+
+
+def test_other_corp_receive_id_is_rejected(ctx):
+    other = get_crypto_context(config.WEWORK_TOKEN, config.WEWORK_ENCODING_AES_KEY, "wxOtherCorp")
+    encrypt = other.encrypt(XML)
+
+    ret, text = ctx.decrypt_msg(encrypt, ctx.signature(TIMESTAMP, NONCE, encrypt), TIMESTAMP, NONCE)
+
+    assert (ret, text) == (ierror.WXBizMsgCrypt_ValidateCorpid_Error, None)
+
+
+def test_garbage_ciphertext_is_rejected(ctx):
+    ret, text = ctx.decrypt("bm90IGEgdmFsaWQgY2lwaGVydGV4dA==")
+
+    assert text is None
+    assert ret in (ierror.WXBizMsgCrypt_DecryptAES_Error, ierror.WXBizMsgCrypt_IllegalBuffer)
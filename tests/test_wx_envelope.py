@@ -0,0 +1,92 @@
+import pytest
+
+import config
+import ierror
+from util.wx_crypto import get_crypto_context
+from util.wx_envelope import CallbackEnvelope, decode_callback
+
+'''
+回调信封单次解码：正常回调解出 (Token, OpenKfId, CreateTime)；超长、格式错误、缺少 <Encrypt>、验签失败时
+返回对应错误码，不抛异常
+'''
+
+
+@pytest.fixture
+def ctx():
+    return get_crypto_context(config.WEWORK_TOKEN, config.WEWORK_ENCODING_AES_KEY, config.WEWORK_CORPID)
+
+
+def _decode(ctx, body, params, **kwargs):
+    if isinstance(body, str):
+        body = body.encode()
+    return decode_callback(ctx, body, params["msg_signature"], params["timestamp"], params["nonce"], **kwargs)
+
+
+def _encrypted_inner(ctx, inner: str, wework_callback):
+    """把任意明文按回调格式加密并签名 (用于构造明文缺字段的回调)"""
+    _, params = wework_callback()
+    encrypt = ctx.encrypt(inner)
+    params = dict(params, msg_signature=ctx.signature(params["timestamp"], params["nonce"], encrypt))
+    return f"<xml><Encrypt><![CDATA[{encrypt}]]></Encrypt></xml>", params
+
+
+def test_valid_callback(ctx, wework_callback):
+    body, params = wework_callback(token="TOKEN-OK", open_kfid="wkEnvelope", create_time=1700000000)
+
+    assert _decode(ctx, body, params) == (0, CallbackEnvelope("TOKEN-OK", "wkEnvelope", 1700000000))
+
+
+def test_encrypt_without_cdata(ctx, wework_callback):
+    body, params = wework_callback(token="TOKEN-RAW")
+    body = body.replace("<Encrypt><![CDATA[", "<Encrypt>").replace("]]></Encrypt>", "</Encrypt>")
+
+    ret, envelope = _decode(ctx, body, params)
+
+    assert ret == 0
+    assert envelope.Token == "TOKEN-RAW"
+
+
+def test_oversized_body(ctx, wework_callback):
+    body, params = wework_callback()
+
+    assert _decode(ctx, body, params, max_bytes=64) == (ierror.WXBizMsgCrypt_IllegalBuffer, None)
+
+
+@pytest.mark.parametrize("body", [
+    "<xml></xml>",
+    "<xml><ToUserName><![CDATA[wx]]></ToUserName></xml>",
+    "<xml><Encrypt><![CDATA[abc",
+    "<xml><Encrypt></Encrypt></xml>",
+    "not xml at all",
+    "<xml><Encrypt>密文</Encrypt></xml>",
+])
+def test_malformed_or_missing_encrypt(ctx, wework_callback, body):
+    _, params = wework_callback()
+
+    assert _decode(ctx, body, params) == (ierror.WXBizMsgCrypt_ParseJson_Error, None)
+
+
+def test_bad_signature(ctx, wework_callback):
+    body, params = wework_callback()
+    params = dict(params, msg_signature="0" * 40)
+
+    assert _decode(ctx, body, params) == (ierror.WXBizMsgCrypt_ValidateSignature_Error, None)
+
+
+def test_tampered_ciphertext_fails_signature(ctx, wework_callback):
+    body, params = wework_callback()
+    body = body.replace("<Encrypt><![CDATA[", "<Encrypt><![CDATA[A")
+
+    assert _decode(ctx, body, params) == (ierror.WXBizMsgCrypt_ValidateSignature_Error, None)
+
+
+@pytest.mark.parametrize("inner", [
+    "<xml><OpenKfId><![CDATA[wk]]></OpenKfId><CreateTime>1700000000</CreateTime></xml>",
+    "<xml><Token><![CDATA[T]]></Token><CreateTime>1700000000</CreateTime></xml>",
+    "<xml><Token><![CDATA[T]]></Token><OpenKfId><![CDATA[wk]]></OpenKfId><CreateTime>abc</CreateTime></xml>",
+    "<xml><Token><![CDATA[T]]></Token><OpenKfId><![CDATA[wk]]></OpenKfId></xml>",
+])
+def test_decrypted_xml_missing_fields(ctx, wework_callback, inner):
+    body, params = _encrypted_inner(ctx, inner, wework_callback)
+
+    assert _decode(ctx, body, params) == (ierror.WXBizMsgCrypt_ParseJson_Error, None)